@@ -1,10 +1,22 @@
+from .archiving_scheduler import ArchivingScheduler, ArchivingStatus
+from .context_planner import ContextPlan
 from .dialog_manager import DialogManager
-from .exceptions import DialogManagerError, MessageIsNotFoundError, ThreadIsNotFoundError
+from .exceptions import (
+    ArchiveIsMalformedError, DialogManagerError, MessageAlreadyExistsError, MessageIsNotFoundError, ThreadIsBusyError,
+    ThreadIsNotFoundError, ThreadVersionConflictError
+)
 
 
 __all__ = [
+    'ArchiveIsMalformedError',
+    'ArchivingScheduler',
+    'ArchivingStatus',
+    'ContextPlan',
     'DialogManager',
     'DialogManagerError',
+    'MessageAlreadyExistsError',
     'MessageIsNotFoundError',
-    'ThreadIsNotFoundError'
+    'ThreadIsBusyError',
+    'ThreadIsNotFoundError',
+    'ThreadVersionConflictError'
 ]
@@ -0,0 +1,160 @@
+import asyncio
+from dataclasses import dataclass, field
+
+from llm_toolkit.llm_api import LLMAPI, LLMAPIError
+from llm_toolkit.pydantic_models import Message, Role
+from .dialog_manager import DialogManager
+from .exceptions import DialogManagerError
+
+
+@dataclass
+class ArchivingStatus:
+    scheduled: bool = False
+    # archives generated and waiting to be committed, without auto-commit only
+    pending: list[Message] = field(default_factory=list)
+    # the last archiving failure of the thread
+    error: str | None = None
+    # the last order handed to archiving, only messages after it count towards the threshold
+    archived_to: int = 0
+
+
+def pick_scenes(
+    messages: list[Message], tokens_numbers: list[int], scene_tokens: int, keep_recent_tokens: int
+) -> list[list[Message]]:
+    """Split raw messages into scenes of at least ``scene_tokens`` tokens, each ending before a user message so
+       exchanges stay whole. The last ``keep_recent_tokens`` tokens and an unfinished scene stay raw."""
+    scenes: list[list[Message]] = []
+    scene: list[Message] = []
+    scene_tokens_number = 0
+    remaining_tokens = sum(tokens_numbers)
+
+    for index, (message, tokens_number) in enumerate(zip(messages, tokens_numbers)):
+        remaining_tokens -= tokens_number
+        if remaining_tokens < keep_recent_tokens:
+            break
+
+        scene.append(message)
+        scene_tokens_number += tokens_number
+        ends_exchange = index + 1 < len(messages) and messages[index + 1].role == Role.user
+        if scene_tokens_number >= scene_tokens and ends_exchange:
+            scenes.append(scene)
+            scene, scene_tokens_number = [], 0
+
+    return scenes
+
+
+class ArchivingScheduler:
+    """Archives threads in the background once more than ``tokens_threshold`` tokens of their raw messages lie past
+       the last archive. ``notify`` is called after a thread changes; scenes of ``scene_tokens`` tokens are picked
+       from its raw messages, leaving the last ``keep_recent_tokens`` tokens raw, and archived one after another
+       by ``LLMAPI.get_archving_message``. At most ``max_concurrency`` threads are archived at once.
+
+       Archives are committed right away with ``auto_commit`` set, otherwise they are kept as pending suggestions
+       until ``commit_pending_archives`` or ``discard_pending_archives`` is called. The order 1 message opens
+       the thread and stays raw, as continuations pin it."""
+
+    def __init__(
+        self, dialog_manager: DialogManager, llm_api: LLMAPI, tokens_threshold: int = 8000,
+        scene_tokens: int = 2000, keep_recent_tokens: int = 2000, max_concurrency: int = 2, auto_commit: bool = False
+    ) -> None:
+        self._dialog_manager = dialog_manager
+        self._llm_api = llm_api
+        self._tokens_threshold = tokens_threshold
+        self._scene_tokens = scene_tokens
+        self._keep_recent_tokens = keep_recent_tokens
+        self._max_concurrency = max_concurrency
+        self._auto_commit = auto_commit
+        self._statuses: dict[str, ArchivingStatus] = {}
+        self._queue: asyncio.Queue[str | int] | None = None
+        self._workers: list[asyncio.Task[None]] = []
+
+    def get_status(self, thread_uid: str | int) -> ArchivingStatus:
+        return self._statuses.setdefault(str(thread_uid), ArchivingStatus())
+
+    async def _get_archivable_messages(self, thread_uid: str | int) -> tuple[list[Message], list[int]]:
+        messages, tokens_numbers = await self._dialog_manager.get_unarchived_messages(thread_uid)
+        archived_to = max(self.get_status(thread_uid).archived_to, 1)
+        start = next((index for index, message in enumerate(messages) if message.order > archived_to), len(messages))
+        return messages[start:], tokens_numbers[start:]
+
+    async def notify(self, thread_uid: str | int) -> None:
+        """Schedule the thread for archiving if its raw messages exceed the threshold. It never raises, a failed
+           check is kept in the thread's status like a failed archiving, as the change it follows is stored."""
+        status = self.get_status(thread_uid)
+        if status.scheduled:
+            return
+
+        try:
+            _, tokens_numbers = await self._get_archivable_messages(thread_uid)
+        except (Exception, DialogManagerError) as err:
+            status.error = f'{type(err).__name__}: {err}'
+            return
+        if sum(tokens_numbers) <= self._tokens_threshold:
+            return
+
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._workers = [
+                asyncio.create_task(self._archive_threads(self._queue)) for _ in range(self._max_concurrency)
+            ]
+
+        status.scheduled = True
+        self._queue.put_nowait(thread_uid)
+
+    async def close(self) -> None:
+        """Stop the workers, archives being generated are dropped."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._queue, self._workers = None, []
+
+    async def _archive_threads(self, queue: asyncio.Queue[str | int]) -> None:
+        while True:
+            thread_uid = await queue.get()
+            status = self.get_status(thread_uid)
+            try:
+                await self._archive_thread(thread_uid, status)
+                status.error = None
+            except (Exception, DialogManagerError, LLMAPIError) as err:
+                status.error = f'{type(err).__name__}: {err}'
+            finally:
+                status.scheduled = False
+                queue.task_done()
+
+    async def _archive_thread(self, thread_uid: str | int, status: ArchivingStatus) -> None:
+        messages, tokens_numbers = await self._get_archivable_messages(thread_uid)
+        scenes = pick_scenes(messages, tokens_numbers, self._scene_tokens, self._keep_recent_tokens)
+        if not scenes:
+            return
+
+        archiving_instruction = await self._dialog_manager.get_thread_archiving_instruction(thread_uid)
+        few_shots_threads = await self._dialog_manager.compile_few_shot_threads(thread_uid)
+        # scenes are archived in order, so with auto-commit every next one has the previous archives in its background
+        for scene in scenes:
+            scene_thread = await self._dialog_manager.compile_current_scene_thread(
+                thread_uid, [ message.order for message in scene ]
+            )
+            archive = await self._llm_api.get_archving_message(archiving_instruction, scene_thread, few_shots_threads)
+
+            if self._auto_commit:
+                await self._dialog_manager.set_archiving_messages([ archive ])
+            else:
+                status.pending.append(archive)
+            status.archived_to = scene[-1].order
+
+    async def commit_pending_archives(self, thread_uid: str | int) -> list[Message]:
+        status = self.get_status(thread_uid)
+        pending, status.pending = status.pending, []
+        try:
+            return await self._dialog_manager.set_archiving_messages(pending)
+        except DialogManagerError:
+            status.pending = pending + status.pending
+            raise
+
+    def discard_pending_archives(self, thread_uid: str | int) -> list[Message]:
+        """Drop the pending archives, the messages they were for count towards the threshold again."""
+        status = self.get_status(thread_uid)
+        pending, status.pending = status.pending, []
+        if pending:
+            status.archived_to = min(message.order for message in pending) - 1
+        return pending
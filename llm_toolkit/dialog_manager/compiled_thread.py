@@ -0,0 +1,186 @@
+import bisect
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, cast
+
+from llm_toolkit.pydantic_models import Message, Role
+
+
+# rendered background prefixes kept per compiled thread, neighbouring scenes extend the closest shorter one
+MAX_RENDERED_PREFIXES = 8
+# the separator LLM APIs join background messages with
+BACKGROUND_SEPARATOR = '\n\n'
+
+
+class ThreadCompiler:
+    """Compiles a thread from its messages and archives fed in the order brokers return them: the widest archive
+       starting at an order replaces the messages it covers and the thread ends at the first missing order. Compiled
+       threads start with order 1, the order 0 message isn't part of them."""
+
+    def __init__(self) -> None:
+        self.next_order = 1
+        # set once an order is missing, nothing fed after it is compiled
+        self.ended = False
+        # an archive waits until no wider one starting at the same order can follow it
+        self._pending_archive: Message | None = None
+
+    def feed(self, message: Message) -> list[Message]:
+        """Return the compiled messages completed by the fed one."""
+        compiled: list[Message] = []
+        if self.ended:
+            return compiled
+
+        if self._pending_archive is not None and not (
+            message.role == Role.archive and message.order == self._pending_archive.order
+        ):
+            compiled.extend(self.finish())
+
+        if message.order < self.next_order:
+            return compiled
+        if message.order > self.next_order:
+            self.ended = True
+            return compiled
+
+        if message.role == Role.archive:
+            self._pending_archive = message
+        else:
+            compiled.append(message)
+            self.next_order = message.order + 1
+
+        return compiled
+
+    def finish(self) -> list[Message]:
+        """Return the archive still waiting for a wider one, if any."""
+        if self._pending_archive is None:
+            return []
+
+        archive, self._pending_archive = self._pending_archive, None
+        assert archive.archive_for
+        self.next_order = max(archive.archive_for) + 1
+        return [ archive ]
+
+
+def get_last_covered_order(message: Message) -> int:
+    return max(cast(list[int], message.archive_for)) if message.role == Role.archive else message.order
+
+
+@dataclass
+class CompiledThread:
+    """Compiled messages of a thread at the broker's ``version`` of it, updated in place by stored messages
+       and archives while they extend or replace its messages in a way the compiler would.
+
+       Every prefix of the view is a background snapshot: with ``token_counter`` set the token numbers of prefixes
+       are kept as running totals, and rendered prefixes are cached for the scenes that follow them."""
+    version: int
+    token_counter: Callable[[Message], int] | None = None
+    messages: list[Message] = field(default_factory=list)
+    # the first order every compiled message covers, for bisecting
+    starts: list[int] = field(default_factory=list)
+    # token number of every compiled message and of messages[:index + 1], with a token counter only
+    tokens_numbers: list[int] = field(default_factory=list)
+    tokens_totals: list[int] = field(default_factory=list)
+    compiler: ThreadCompiler = field(default_factory=ThreadCompiler)
+    # rendered texts of the first messages by their number
+    _rendered_prefixes: OrderedDict[int, str] = field(default_factory=OrderedDict, repr=False)
+
+    def _count_tokens(self, message: Message) -> int:
+        assert self.token_counter is not None
+        return message.tokens_number if message.tokens_number is not None else self.token_counter(message)
+
+    def _push(self, compiled: list[Message]) -> None:
+        self.messages.extend(compiled)
+        self.starts.extend(message.order for message in compiled)
+        if self.token_counter is not None:
+            self.tokens_numbers.extend(self._count_tokens(message) for message in compiled)
+            self._accumulate_tokens()
+
+    def _accumulate_tokens(self) -> None:
+        total = self.tokens_totals[-1] if self.tokens_totals else 0
+        for tokens_number in self.tokens_numbers[len(self.tokens_totals):]:
+            total += tokens_number
+            self.tokens_totals.append(total)
+
+    def feed(self, message: Message) -> None:
+        self._push(self.compiler.feed(message))
+
+    def finish(self) -> None:
+        self._push(self.compiler.finish())
+
+    def find(self, order: int) -> int:
+        """Return the index of the compiled message covering the order, or of the first one after it."""
+        index = bisect.bisect_right(self.starts, order) - 1
+        if index < 0:
+            return 0
+        return index if get_last_covered_order(self.messages[index]) >= order else index + 1
+
+    def between(self, order_from: int = 0, order_to: int | None = None) -> list[Message]:
+        """Return the compiled messages covering any order between the orders, both included."""
+        end = len(self.starts) if order_to is None else bisect.bisect_right(self.starts, order_to)
+        return self.messages[self.find(order_from):end]
+
+    def get_prefix_length(self, to_order: int) -> int:
+        """Return the number of compiled messages starting before the order, the background of a scene from it."""
+        return bisect.bisect_left(self.starts, to_order)
+
+    def get_tokens_number(self, length: int) -> int | None:
+        """Return the token number of the first ``length`` compiled messages, ``None`` without a token counter."""
+        if self.token_counter is None:
+            return None
+        return self.tokens_totals[length - 1] if length else 0
+
+    def render(self, length: int) -> str:
+        """Return the texts of the first ``length`` compiled messages joined the way LLM APIs join background
+           messages, extending the longest rendered prefix shorter than it."""
+        if (rendered := self._rendered_prefixes.get(length)) is not None:
+            self._rendered_prefixes.move_to_end(length)
+            return rendered
+
+        base = max((cached for cached in self._rendered_prefixes if cached < length), default=0)
+        texts = [ self._rendered_prefixes[base] ] if base else []
+        texts.extend(message.text for message in self.messages[base:length])
+        rendered = BACKGROUND_SEPARATOR.join(texts)
+
+        self._rendered_prefixes[length] = rendered
+        while len(self._rendered_prefixes) > MAX_RENDERED_PREFIXES:
+            self._rendered_prefixes.popitem(last=False)
+        return rendered
+
+    def apply(self, message: Message) -> bool:
+        """Update the view with a message or an archive stored after it was compiled. Return ``False`` if the
+           view can't be updated in place and has to be compiled again."""
+        if self.compiler.ended:
+            return False
+
+        if message.role != Role.archive:
+            if message.order != self.compiler.next_order:
+                return False
+            self.feed(message)
+            return True
+
+        assert message.archive_for
+        order_to = max(message.archive_for)
+        start_index = bisect.bisect_left(self.starts, message.order)
+        if start_index == len(self.starts) or self.starts[start_index] != message.order:
+            return False
+
+        current = self.messages[start_index]
+        if current.role == Role.archive and get_last_covered_order(current) > order_to:
+            # a wider archive starting at the same order stays in place
+            return True
+
+        end_index = bisect.bisect_right(self.starts, order_to)
+        if get_last_covered_order(self.messages[end_index - 1]) > order_to:
+            return False
+        if order_to >= self.compiler.next_order:
+            return False
+
+        self.messages[start_index:end_index] = [ message ]
+        self.starts[start_index:end_index] = [ message.order ]
+        if self.token_counter is not None:
+            self.tokens_numbers[start_index:end_index] = [ self._count_tokens(message) ]
+            del self.tokens_totals[start_index:]
+            self._accumulate_tokens()
+        # prefixes ending after the archive's start rendered the messages it replaced
+        for length in [ length for length in self._rendered_prefixes if length > start_index ]:
+            del self._rendered_prefixes[length]
+        return True
@@ -0,0 +1,45 @@
+from dataclasses import dataclass, field
+
+from llm_toolkit.pydantic_models import Message, Role
+
+
+@dataclass
+class ContextPlan:
+    """Compiled messages picked to fit ``tokens_budget``, in thread order. ``tokens_number`` is the sum of token
+       numbers of the picked messages, ``omitted_orders`` are the first orders of compiled messages left out."""
+    tokens_budget: int
+    messages: list[Message] = field(default_factory=list)
+    tokens_number: int = 0
+    omitted_orders: list[int] = field(default_factory=list)
+
+
+def plan_context(messages: list[Message], tokens_numbers: list[int], tokens_budget: int) -> ContextPlan:
+    """Pick compiled messages with the given token numbers to fit the budget. Raw messages after the last archive
+       are taken first, newest first and without gaps. Archives and the messages between them cover the older
+       ranges and are taken oldest first, so the newest archives are dropped first and the oldest ones last."""
+    picked = [ False ] * len(messages)
+    tokens_number = 0
+
+    recent_start = len(messages)
+    while recent_start > 0 and messages[recent_start - 1].role != Role.archive:
+        if tokens_number + tokens_numbers[recent_start - 1] > tokens_budget:
+            break
+        recent_start -= 1
+        tokens_number += tokens_numbers[recent_start]
+        picked[recent_start] = True
+
+    # raw messages that didn't fit after the last archive aren't taken out of order
+    older_end = next((
+        index + 1 for index in range(recent_start - 1, -1, -1) if messages[index].role == Role.archive
+    ), 0)
+    for index in range(older_end):
+        if tokens_number + tokens_numbers[index] <= tokens_budget:
+            tokens_number += tokens_numbers[index]
+            picked[index] = True
+
+    return ContextPlan(
+        tokens_budget,
+        [ message for message, is_picked in zip(messages, picked) if is_picked ],
+        tokens_number,
+        [ message.order for message, is_picked in zip(messages, picked) if not is_picked ]
+    )
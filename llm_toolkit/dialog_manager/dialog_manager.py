@@ -1,20 +1,59 @@
-import asyncio
+from collections import OrderedDict
+from contextlib import aclosing, asynccontextmanager
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, cast
 
-from llm_toolkit.pydantic_models import Message, Role, SceneArchivingThread
+from llm_toolkit.pydantic_models import FewShotsBundle, Message, Role, SceneArchivingThread
 from llm_toolkit.message_broker import (
-    MessageBroker, MessageBrokerError, MessageIsNotFoundError as MessageBrokerMsgIsNotFoundError
+    MessageBroker, MessageBrokerError, MessagesOrders,
+    ThreadVersionConflictError as MessageBrokerThreadVersionConflictError
 )
-from .exceptions import convert_message_broker_error_to_dialog_error
+from .compiled_thread import CompiledThread, ThreadCompiler
+from .context_planner import ContextPlan, plan_context
+from .exceptions import (
+    DialogManagerError, ThreadIsBusyError, ThreadVersionConflictError, convert_message_broker_error_to_dialog_error
+)
+
+
+# messages read while a thread is compiled are counted in batches of this size by a batch token counter
+COUNT_BATCH_SIZE = 256
 
 
 class DialogManager:
+    """Compiled threads are kept for the ``max_compiled_threads`` most recently used threads and are updated in
+       place by messages and archives stored through the dialog manager, or compiled again once the broker's
+       version of the thread shows other changes.
+
+       Scene backgrounds are prefixes of compiled threads, with token numbers counted by ``token_counter`` and
+       rendered texts reused by scenes that follow each other. With ``batch_token_counter`` also set, messages
+       are counted by it in batches while a thread is compiled and by ``token_counter`` after that."""
 
-    def __init__(self, message_broker: MessageBroker) -> None:
+    def __init__(
+        self, message_broker: MessageBroker, max_compiled_threads: int = 64,
+        token_counter: Callable[[Message], int] | None = None,
+        batch_token_counter: Callable[[list[Message]], Awaitable[list[int]]] | None = None
+    ) -> None:
         self._message_broker = message_broker
+        self._max_compiled_threads = max_compiled_threads
+        self._token_counter = token_counter
+        self._batch_token_counter = batch_token_counter
+        self._compiled_threads: OrderedDict[str, CompiledThread] = OrderedDict()
+        # threads with a continuation being generated, see reserve_thread
+        self._reserved_threads: set[str] = set()
         return super().__init__()
 
     async def create_thread(self, thread_uid: str | int) -> list[Message]:
-        return await self._message_broker.get_messages_by_thread_uid(thread_uid)
+        try:
+            return await self._message_broker.get_messages_by_thread_uid(thread_uid)
+        except MessageBrokerError as err:
+            raise convert_message_broker_error_to_dialog_error(err)
+
+    async def iter_thread(self, thread_uid: str | int) -> AsyncGenerator[Message, None]:
+        try:
+            async with aclosing(self._message_broker.iter_messages_by_thread_uid(thread_uid)) as messages:
+                async for message in messages:
+                    yield message
+        except MessageBrokerError as err:
+            raise convert_message_broker_error_to_dialog_error(err)
 
     async def get_message_by_thread_uid_and_order(self, thread_uid: str | int, message_order: int) -> Message:
         try:
@@ -25,64 +64,143 @@ class DialogManager:
     async def get_thread_archiving_instruction(self, thread_uid: str | int) -> Message:
         return await self._message_broker.get_thread_archiving_instruction(thread_uid)
 
-    async def compile_few_shot_threads(self, thread_uid: str | int) -> list[SceneArchivingThread]:
+    async def compile_few_shot_threads(self, thread_uid: str | int) -> FewShotsBundle:
         return await self._message_broker.compile_few_shot_threads(thread_uid)
 
     async def compile_current_scene_thread(
         self, thread_uid: str | int, current_scene_orders: list[int]
     ) -> SceneArchivingThread:
-        background = await self.compile_background(thread_uid, min(current_scene_orders))
-        current_scene = await self.get_messages_by_orders_list(thread_uid, current_scene_orders)
-        return SceneArchivingThread(background=background, messages=current_scene, archive=None)
+        return (await self.compile_current_scene_threads(thread_uid, [ current_scene_orders ]))[0]
 
-    async def compile_background(self, thread_uid: str | int, to_order: int) -> list[Message]:
-        return [ msg for msg in (await self.compile_and_get_thread(thread_uid)) if msg.order < to_order ]
+    async def compile_current_scene_threads(
+        self, thread_uid: str | int, scenes_orders: list[list[int]]
+    ) -> list[SceneArchivingThread]:
+        """Compile a thread for every scene, with backgrounds taken from one snapshot of the compiled thread and
+           messages of all scenes read at once."""
+        compiled = await self._get_compiled_thread(thread_uid)
+        messages = { msg.order: msg for msg in await self.get_messages_by_orders_list(
+            thread_uid, sorted({ order for scene_orders in scenes_orders for order in scene_orders })
+        ) }
 
-    async def get_messages_by_orders_list(self, thread_uid: str | int, messages_orders: list[int]) -> list[Message]:
-        return [ msg for msg in (
-            await self._message_broker.get_messages_by_orders_list(thread_uid, messages_orders)
-        ) if msg.role != Role.archive ]
+        # taken together, so backgrounds, their renderings and token numbers come from one snapshot, rendered from
+        # the earliest scene on so every next background extends the previous one
+        scene_threads: list[SceneArchivingThread | None] = [ None ] * len(scenes_orders)
+        for index in sorted(range(len(scenes_orders)), key=lambda index: min(scenes_orders[index])):
+            length = compiled.get_prefix_length(min(scenes_orders[index]))
+            scene_threads[index] = SceneArchivingThread(
+                background=compiled.messages[:length],
+                messages=[ messages[order] for order in sorted(set(scenes_orders[index])) if order in messages ],
+                archive=None, rendered_background=compiled.render(length),
+                background_tokens_number=compiled.get_tokens_number(length)
+            )
 
-    async def _compile_message_by_thread_uid_and_order(
-        self, thread_uid: str | int, order: int
-    ) -> Message | None:
+        return cast(list[SceneArchivingThread], scene_threads)
+
+    async def compile_background(self, thread_uid: str | int, to_order: int) -> list[Message]:
+        compiled = await self._get_compiled_thread(thread_uid)
+        return compiled.messages[:compiled.get_prefix_length(to_order)]
+
+    async def get_messages_by_orders_list(
+        self, thread_uid: str | int, messages_orders: MessagesOrders
+    ) -> list[Message]:
         try:
-            return await self._message_broker.get_archive_by_thread_uid_and_order(thread_uid, order)
-        except MessageBrokerMsgIsNotFoundError:
-            try:
-                return await self._message_broker.get_message_by_thread_uid_and_order(thread_uid, order)
-            except MessageBrokerMsgIsNotFoundError:
-                return None
-
-    async def compile_and_get_thread(self, thread_uid: str | int) -> list[Message]:
-
-        compiled_messages: dict[int, Message] = {}
-        order = 0
-        async def generate():
-            nonlocal compiled_messages
-            nonlocal thread_uid
-            nonlocal order
-
-            loc_order = order
-            order += 1
-
-            compiled_message = await self._compile_message_by_thread_uid_and_order(thread_uid, loc_order)
-            if compiled_message is not None:
-                compiled_messages[loc_order] = compiled_message
-                await generate()
-
-        await asyncio.gather(*[ generate() for _ in range(30) ])
-
-        order = 0
-        thread: list[Message] = []
-        while ((order := order + 1) <= max(compiled_messages.keys())):
-            message = compiled_messages[order]
-            thread.append(message)
-            if message.role == Role.archive:
-                assert message.archive_for
-                order = max(message.archive_for)
-
-        return thread
+            messages = await self._message_broker.get_messages_by_orders_list(thread_uid, messages_orders)
+        except MessageBrokerError as err:
+            raise convert_message_broker_error_to_dialog_error(err)
+
+        return [ msg for msg in messages if msg.role != Role.archive ]
+
+    async def compile_and_get_thread(
+        self, thread_uid: str | int, order_from: int = 0, order_to: int | None = None
+    ) -> list[Message]:
+        """Return the compiled messages covering any order between ``order_from`` and ``order_to``, both included,
+           found by bisecting the compiled view."""
+        return (await self._get_compiled_thread(thread_uid)).between(order_from, order_to)
+
+    async def _get_counted_compiled_thread(self, thread_uid: str | int) -> CompiledThread:
+        if self._token_counter is None:
+            raise DialogManagerError('Counting thread tokens requires the dialog manager to have a token counter', 500)
+        return await self._get_compiled_thread(thread_uid)
+
+    async def plan_thread_context(self, thread_uid: str | int, tokens_budget: int) -> ContextPlan:
+        """Pick compiled messages of the thread fitting ``tokens_budget`` by their cached token numbers, preferring
+           recent raw messages and falling back to archives for older ranges."""
+        compiled = await self._get_counted_compiled_thread(thread_uid)
+        return plan_context(compiled.messages, compiled.tokens_numbers, tokens_budget)
+
+    async def get_unarchived_messages(self, thread_uid: str | int) -> tuple[list[Message], list[int]]:
+        """Return the compiled messages after the last archive of the thread and their token numbers."""
+        compiled = await self._get_counted_compiled_thread(thread_uid)
+        start = next((
+            index + 1 for index in range(len(compiled.messages) - 1, -1, -1)
+                if compiled.messages[index].role == Role.archive
+        ), 0)
+        return compiled.messages[start:], compiled.tokens_numbers[start:]
+
+    async def _get_compiled_thread(self, thread_uid: str | int) -> CompiledThread:
+        key = str(thread_uid)
+        version = await self.get_thread_version(thread_uid)
+
+        compiled = self._compiled_threads.get(key)
+        if compiled is not None and compiled.version == version:
+            self._compiled_threads.move_to_end(key)
+            return compiled
+
+        # compiled in one pass over the thread, changes made meanwhile give a newer version and compile it again
+        compiled = CompiledThread(version, self._token_counter)
+        async with aclosing(self.iter_thread(thread_uid)) as messages:
+            batch: list[Message] = []
+            async for message in messages:
+                batch.append(message)
+                if len(batch) >= COUNT_BATCH_SIZE:
+                    await self._feed_compiled_thread(compiled, batch)
+                    batch = []
+                    if compiled.compiler.ended:
+                        break
+            await self._feed_compiled_thread(compiled, batch)
+        compiled.finish()
+
+        self._compiled_threads[key] = compiled
+        self._compiled_threads.move_to_end(key)
+        while len(self._compiled_threads) > self._max_compiled_threads:
+            self._compiled_threads.popitem(last=False)
+
+        return compiled
+
+    async def _feed_compiled_thread(self, compiled: CompiledThread, batch: list[Message]) -> None:
+        uncounted = [ message for message in batch if message.tokens_number is None ]
+        if self._token_counter is not None and self._batch_token_counter is not None and uncounted:
+            for message, tokens_number in zip(uncounted, await self._batch_token_counter(uncounted)):
+                message.tokens_number = tokens_number
+
+        for message in batch:
+            compiled.feed(message)
+
+    async def _update_compiled_thread(self, thread_uid: str | int, stored_messages: list[Message]) -> None:
+        if (compiled := self._compiled_threads.get(str(thread_uid))) is None:
+            return
+
+        # the view is updated in place only if no one else changed the thread since it was compiled
+        version = await self.get_thread_version(thread_uid)
+        if version == compiled.version + len(stored_messages) and all(
+            compiled.apply(message) for message in stored_messages
+        ):
+            compiled.version = version
+        elif self._compiled_threads.get(str(thread_uid)) is compiled:
+            del self._compiled_threads[str(thread_uid)]
+
+    async def iter_compiled_thread(self, thread_uid: str | int) -> AsyncGenerator[Message, None]:
+        """Yield the same messages as ``compile_and_get_thread`` while the thread is still being read."""
+        compiler = ThreadCompiler()
+        async with aclosing(self.iter_thread(thread_uid)) as messages:
+            async for message in messages:
+                for compiled_message in compiler.feed(message):
+                    yield compiled_message
+                if compiler.ended:
+                    return
+
+        for compiled_message in compiler.finish():
+            yield compiled_message
 
     async def get_thread_analysis_instruction(self, thread_uid: str | int) -> Message:
         return await self._message_broker.get_thread_analysis_instruction(thread_uid)
@@ -90,7 +208,10 @@ class DialogManager:
     async def get_origin_thread(
         self, thread_uid: str | int, order_from: int = 0, order_to: int | None = None
     ) -> list[Message]:
-        return await self._message_broker.get_origin_thread(thread_uid, order_from, order_to)
+        try:
+            return await self._message_broker.get_origin_thread(thread_uid, order_from, order_to)
+        except MessageBrokerError as err:
+            raise convert_message_broker_error_to_dialog_error(err)
 
     async def get_thread_hidden_context_creation_instruction(self, thread_uid: str | int) -> Message:
         return await self._message_broker.get_thread_hidden_context_creation_instruction(thread_uid)
@@ -101,8 +222,62 @@ class DialogManager:
     async def get_hidden_context_message(self, thread_uid: str | int) -> Message:
         return await self._message_broker.get_hidden_context_message(thread_uid)
 
+    async def set_archiving_messages(self, archiving_messages: list[Message]) -> list[Message]:
+        try:
+            stored_messages = await self._message_broker.set_archiving_messages(archiving_messages)
+        except MessageBrokerError as err:
+            raise convert_message_broker_error_to_dialog_error(err)
+
+        for thread_uid in { str(msg.thread_uid) for msg in stored_messages }:
+            await self._update_compiled_thread(
+                thread_uid, [ msg for msg in stored_messages if str(msg.thread_uid) == thread_uid ]
+            )
+        return stored_messages
+
     async def add_message(self, message: Message) -> Message:
-        return await self._message_broker.add_message(message)
+        try:
+            stored_message = await self._message_broker.add_message(message)
+        except MessageBrokerError as err:
+            raise convert_message_broker_error_to_dialog_error(err)
+
+        await self._update_compiled_thread(message.thread_uid, [ stored_message ])
+        return stored_message
+
+    async def get_thread_version(self, thread_uid: str | int) -> int:
+        try:
+            return await self._message_broker.get_thread_version(thread_uid)
+        except MessageBrokerError as err:
+            raise convert_message_broker_error_to_dialog_error(err)
+
+    async def compare_and_append_message(self, message: Message, expected_version: int) -> Message:
+        try:
+            stored_message = await self._message_broker.compare_and_append_message(message, expected_version)
+        except MessageBrokerError as err:
+            raise convert_message_broker_error_to_dialog_error(err)
+
+        await self._update_compiled_thread(message.thread_uid, [ stored_message ])
+        return stored_message
+
+    @asynccontextmanager
+    async def reserve_thread(self, thread_uid: str | int, expected_version: int | None = None) -> AsyncIterator[int]:
+        """Reserve the thread for one request appending to it, e.g. while an LLM generates the continuation.
+           A concurrent reservation or a thread changed since ``expected_version`` fails at once, before any tokens
+           are spent. Yields the version to pass to ``compare_and_append_message``."""
+        key = str(thread_uid)
+        if key in self._reserved_threads:
+            raise ThreadIsBusyError(thread_uid)
+
+        self._reserved_threads.add(key)
+        try:
+            version = await self.get_thread_version(thread_uid)
+            if expected_version is not None and version != expected_version:
+                raise ThreadVersionConflictError(
+                    MessageBrokerThreadVersionConflictError(thread_uid, expected_version, version)
+                )
+
+            yield version
+        finally:
+            self._reserved_threads.discard(key)
 
     async def get_conversation_instruction(self, thread_uid: str | int) -> Message:
         return await self._message_broker.get_conversation_instruction(thread_uid)
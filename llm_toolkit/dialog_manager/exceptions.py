@@ -1,7 +1,10 @@
 from ..message_broker import (
+    ArchiveIsMalformedError as MessageBrokerArchiveIsMalformedError,
+    MessageAlreadyExistsError as MessageBrokerMsgAlreadyExistsError,
     MessageBrokerError,
     MessageIsNotFoundError as MessageBrokerMsgIsNotFoundError,
-    ThreadIsNotFoundError as MessageBrokerThreadIsNotFoundError
+    ThreadIsNotFoundError as MessageBrokerThreadIsNotFoundError,
+    ThreadVersionConflictError as MessageBrokerThreadVersionConflictError
 )
 
 
@@ -10,8 +13,15 @@ def convert_message_broker_error_to_dialog_error(msg_broker_err: MessageBrokerEr
         return MessageIsNotFoundError(msg_broker_err)
     elif isinstance(msg_broker_err, MessageBrokerThreadIsNotFoundError):
         return ThreadIsNotFoundError(msg_broker_err)
+    elif isinstance(msg_broker_err, MessageBrokerThreadVersionConflictError):
+        return ThreadVersionConflictError(msg_broker_err)
+    elif isinstance(msg_broker_err, MessageBrokerMsgAlreadyExistsError):
+        return MessageAlreadyExistsError(msg_broker_err)
+    elif isinstance(msg_broker_err, MessageBrokerArchiveIsMalformedError):
+        return ArchiveIsMalformedError(msg_broker_err)
     else:
-        raise Exception(f'{type(msg_broker_err)} message broker error has no handler in dialog manager converter')
+        # a broker failure the client can't do anything about, like a missing compression package
+        return DialogManagerError(str(msg_broker_err), 500)
 
 
 class DialogManagerError(BaseException):
@@ -28,3 +38,24 @@ class MessageIsNotFoundError(DialogManagerError):
 class ThreadIsNotFoundError(DialogManagerError):
     def __init__(self, msg_broker_err: MessageBrokerThreadIsNotFoundError):
         return super().__init__(str(msg_broker_err), 404)
+
+
+class MessageAlreadyExistsError(DialogManagerError):
+    def __init__(self, msg_broker_err: MessageBrokerMsgAlreadyExistsError):
+        return super().__init__(str(msg_broker_err), 409)
+
+
+class ArchiveIsMalformedError(DialogManagerError):
+    def __init__(self, msg_broker_err: MessageBrokerArchiveIsMalformedError):
+        return super().__init__(str(msg_broker_err), 400)
+
+
+class ThreadVersionConflictError(DialogManagerError):
+    def __init__(self, msg_broker_err: MessageBrokerThreadVersionConflictError):
+        self.version = msg_broker_err.version
+        return super().__init__(str(msg_broker_err), 409)
+
+
+class ThreadIsBusyError(DialogManagerError):
+    def __init__(self, thread_uid: str | int):
+        return super().__init__(f'{thread_uid} thread is being continued by another request', 409)
@@ -1,11 +1,18 @@
-from .exceptions import LLMAPIError
-from .llm_api import LLMAPI
+from .exceptions import LLMAPIError, PromptIsTooLargeError
+from .llm_api import LLMAPI, PromptCacheStats, PromptEstimate
 from .mock_llm_api import MockLLMAPI
 from .openai_api import OpenAIAPI
+from .response_cache import ResponseCache
+from .token_count_cache import TokenCountCache
 
 __all__ = [
     'LLMAPI',
     'LLMAPIError',
     'MockLLMAPI',
-    'OpenAIAPI'
+    'OpenAIAPI',
+    'PromptCacheStats',
+    'PromptEstimate',
+    'PromptIsTooLargeError',
+    'ResponseCache',
+    'TokenCountCache'
 ]
@@ -63,8 +63,12 @@ async def log_request(folder: str, request: httpx.Request):
 async def log_response(folder: str, response: httpx.Response):
     req_uid = response.request.extensions.get('log_id', 'LOST_REQUEST')
 
-    body = await response.aread()
-    response._content = body
+    if response.headers.get('content-type', '').startswith('text/event-stream'):
+        # reading a streamed body here would hold every chunk back until the last one arrives
+        body = b'<streamed>'
+    else:
+        body = await response.aread()
+        response._content = body
 
     await store_log(folder, req_uid, '\n\n\nRESPONSE:\n' + build_readible_response(
         response.status_code, response.headers, body.decode('utf-8', errors='ignore')
@@ -1,3 +1,12 @@
 
 class LLMAPIError(BaseException):
     pass
+
+
+class PromptIsTooLargeError(LLMAPIError):
+    def __init__(self, tokens_number: int, max_prompt_tokens: int):
+        self.tokens_number = tokens_number
+        self.max_prompt_tokens = max_prompt_tokens
+        return super().__init__(
+            f'Prompt of {tokens_number} tokens exceeds the {max_prompt_tokens} tokens the model takes'
+        )
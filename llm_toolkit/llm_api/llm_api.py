@@ -1,14 +1,17 @@
 import itertools
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Any, cast, ClassVar, Literal, TypedDict
+from typing import Any, AsyncGenerator, cast, ClassVar, Literal, TypedDict
 
-from llm_toolkit.pydantic_models import Message, Role, SceneArchivingThread
-from .exceptions import LLMAPIError
+from llm_toolkit.pydantic_models import FewShotsBundle, Message, Role, SceneArchivingThread
+from .exceptions import LLMAPIError, PromptIsTooLargeError
+from .response_cache import prompt_hash, ResponseCache, ResponseCacheStats
 
 
 LLMAPIRole = Literal['system', 'user', 'assistant']
 
+FewShots = FewShotsBundle | list[SceneArchivingThread]
+
 
 class _LLMMessage(TypedDict):
     role: LLMAPIRole
@@ -63,20 +66,64 @@ class HiddenContextConsistencyCheckResult:
     }
 
 
+@dataclass
+class PromptCacheStats:
+    # requests the model answered and the prompt tokens it took in them
+    requests: int = 0
+    prompt_tokens: int = 0
+    # prompt tokens the provider served from its prompt cache, billed at the cached rate
+    cached_tokens: int = 0
+    # price of the prompts in USD with the cached tokens at the cached rate
+    input_cost: float = 0.0
+
+
+@dataclass
+class PromptEstimate:
+    # tokens of the final LLM messages, with the per-message overhead
+    tokens_number: int
+    # tokens the model takes in a prompt, leaving room for the longest answer, None if it's unknown
+    max_prompt_tokens: int | None = None
+    # price of the prompt in USD if none of it is cached, None if it's unknown
+    input_cost: float | None = None
+
+    @property
+    def fits(self) -> bool:
+        return self.max_prompt_tokens is None or self.tokens_number <= self.max_prompt_tokens
+
+
 class LLMAPI(ABC):
+    """With ``_prefix_stable_layout`` set, prompts are laid out for provider-side prompt caching: the instruction,
+       few-shots, backgrounds and archives, which are the same or only grow between requests, come first as
+       separate messages, and the content that changes more often, like the current scene or the hidden context,
+       comes after them. Otherwise they're merged into fewer messages."""
+    _model: str
+    # responses of the methods called with ``use_cache`` are reused from it for equal prompts
+    _response_cache: ResponseCache | None = None
+    _prefix_stable_layout: bool = False
 
     @classmethod
-    def _compile_scene_thread(cls, scene_thread: SceneArchivingThread) -> list[_LLMMessage]:
-        scene_background_thread = cls.join_messages_seq_to_gpt_msg(scene_thread.background, Role.user)
+    def _compile_scene_thread(
+        cls, scene_thread: SceneArchivingThread, prefix_stable: bool = False
+    ) -> list[_LLMMessage]:
+        scene_background = scene_thread.rendered_background if scene_thread.rendered_background is not None \
+            else cls.join_messages_seq_to_gpt_msg(scene_thread.background, Role.user)['content']
         current_scene_thread = cls.join_messages_seq_to_gpt_msg(scene_thread.messages, Role.user)
 
-        result: list[_LLMMessage] = [
-            {
-                'role': Role.user.value,
-                'content': ('=== BACKGROUND ===\n' + scene_background_thread['content'] +
-                            '\n\n=== CURRENT SCENE ===\n' + current_scene_thread['content'])
-            }
-        ]
+        result: list[_LLMMessage]
+        if prefix_stable:
+            # the background of the next scene starts with this one, so the provider caches it
+            result = [
+                { 'role': Role.user.value, 'content': '=== BACKGROUND ===\n' + scene_background },
+                { 'role': Role.user.value, 'content': '=== CURRENT SCENE ===\n' + current_scene_thread['content'] }
+            ]
+        else:
+            result = [
+                {
+                    'role': Role.user.value,
+                    'content': ('=== BACKGROUND ===\n' + scene_background +
+                                '\n\n=== CURRENT SCENE ===\n' + current_scene_thread['content'])
+                }
+            ]
         if scene_thread.archive is not None:
             result.append(cls.msg_to_gpt_dict(scene_thread.archive))
 
@@ -86,17 +133,115 @@ class LLMAPI(ABC):
     def count_single_message_tokens(self, msg: Message) -> int:
         pass
 
+    @abstractmethod
+    async def handle_response(self, llm_messages: list[_LLMMessage], response_format: Any = None) -> _LLMResponse:
+        pass
+
+    async def get_response(
+        self, llm_messages: list[_LLMMessage], response_format: Any = None, use_cache: bool = False
+    ) -> _LLMResponse:
+        """Return the response to the prompt, the cached one with ``use_cache`` set if the model already answered
+           an equal prompt."""
+        if not use_cache or self._response_cache is None:
+            return await self.handle_response(llm_messages, response_format)
+
+        key = prompt_hash(self._model, cast(list[Any], llm_messages), response_format)
+        if (cached := await self._response_cache.get(key)) is not None:
+            return cast(_LLMResponse, cached)
+
+        response = await self.handle_response(llm_messages, response_format)
+        await self._response_cache.put(key, response)
+        return response
+
+    def get_response_cache_stats(self) -> ResponseCacheStats | None:
+        return self._response_cache.stats if self._response_cache is not None else None
+
+    def get_prompt_cache_stats(self) -> PromptCacheStats | None:
+        """Return the provider's prompt cache usage reported with responses, ``None`` if it's not reported."""
+        return None
+
+    @abstractmethod
+    def estimate_prompt(self, llm_messages: list[_LLMMessage]) -> PromptEstimate:
+        """Count the exact prompt tokens of the LLM messages and estimate their price against the model's limits."""
+        pass
+
+    def preflight(self, llm_messages: list[_LLMMessage]) -> PromptEstimate:
+        """Estimate the prompt before it's sent, raising ``PromptIsTooLargeError`` if the model won't take it."""
+        estimate = self.estimate_prompt(llm_messages)
+        if not estimate.fits:
+            raise PromptIsTooLargeError(estimate.tokens_number, cast(int, estimate.max_prompt_tokens))
+        return estimate
+
+    # estimates of the prompts the methods generating messages would send, for dry runs
+
+    def estimate_archiving_message(
+        self, archiving_instruction: Message, archiving_thread: SceneArchivingThread,
+        few_shots_threads: FewShots | None
+    ) -> PromptEstimate:
+        return self.estimate_prompt(
+            self._make_archiving_gpt_dicts_msgs(
+                archiving_instruction, archiving_thread, few_shots_threads, self._prefix_stable_layout
+            )
+        )
+
+    def estimate_thread_response(self, thread: list[Message]) -> PromptEstimate:
+        return self.estimate_prompt(self.convert_thread_into_llm_msgs(thread))
+
+    def estimate_hidden_context_message(
+        self, hidden_context_creation_instruction: Message, thread: list[Message], context_message: Message
+    ) -> PromptEstimate:
+        return self.estimate_prompt(self._make_hidden_context_creation_gpt_msgs(
+            hidden_context_creation_instruction, thread, context_message
+        ))
+
+    def estimate_hidden_context_check(
+        self, hidden_context_consistency_check_instruciton: Message, current_thread: list[Message],
+        hidden_context: Message
+    ) -> PromptEstimate:
+        return self.estimate_prompt(self._make_hidden_context_consistancy_check_gpt_msgs(
+            hidden_context_consistency_check_instruciton, current_thread, hidden_context
+        ))
+
+    def estimate_conversation_continuation_message(
+        self, narration_instruction: Message, hidden_context: Message, archive_subthread: list[Message],
+        conversation_subthread: list[Message]
+    ) -> PromptEstimate:
+        return self.estimate_prompt(self._make_conversation_continuation_gpt_msgs(
+            narration_instruction, hidden_context, archive_subthread, conversation_subthread, self._prefix_stable_layout
+        ))
+
+    # text deltas of generated messages as they arrive, the whole text at once unless an LLM API streams it
+
+    async def stream_thread_response(self, thread: list[Message]) -> AsyncGenerator[str, None]:
+        yield (await self.get_thread_response(thread)).text
+
+    async def stream_conversation_continuation_message(
+        self, narration_instruction: Message, hidden_context: Message, archive_subthread: list[Message],
+        conversation_subthread: list[Message]
+    ) -> AsyncGenerator[str, None]:
+        yield (await self.make_conversation_continuation_message(
+            narration_instruction, hidden_context, archive_subthread, conversation_subthread
+        )).text
+
+    async def count_messages_tokens(self, messages: list[Message]) -> list[int]:
+        """Count tokens of every message at once, one by one unless an LLM API batches it."""
+        return [ self.count_single_message_tokens(msg) for msg in messages ]
+
+    async def close(self) -> None:
+        """Persist what the LLM API caches, called once on shutdown."""
+        pass
+
     @abstractmethod
     async def get_archving_message(
         self, archiving_instruction: Message, archiving_thread: SceneArchivingThread,
-        few_shots_threads: list[SceneArchivingThread] | None
+        few_shots_threads: FewShots | None, use_cache: bool = False
     ) -> Message:
         """Generate archving message based on given instruciton message and background subthread with optional
            few-shots"""
         pass
 
     @abstractmethod
-    async def get_thread_response(self, thread: list[Message]) -> Message:
+    async def get_thread_response(self, thread: list[Message], use_cache: bool = False) -> Message:
         pass
 
     @abstractmethod
@@ -108,19 +253,35 @@ class LLMAPI(ABC):
     def convert_thread_into_llm_msgs(self, thread: list[Message]) -> list[_LLMMessage]:
         return [ self.msg_to_gpt_dict(msg) for msg in thread ]
 
+    @classmethod
+    def _make_few_shots_gpt_msgs(
+        cls, few_shots_threads: FewShots | None, prefix_stable: bool = False
+    ) -> list[_LLMMessage]:
+        if few_shots_threads is None:
+            return []
+
+        if not isinstance(few_shots_threads, FewShotsBundle):
+            return sum([ cls._compile_scene_thread(thread, prefix_stable) for thread in few_shots_threads ], [])
+
+        # a bundle is immutable, so it's rendered once per layout and reused by every following request
+        rendered_key = f'{cls.__name__}/prefix_stable' if prefix_stable else cls.__name__
+        if rendered_key not in few_shots_threads.rendered:
+            few_shots_threads.rendered[rendered_key] = cast(list[dict[str, str]], sum([
+                cls._compile_scene_thread(thread, prefix_stable) for thread in few_shots_threads.threads
+            ], []))
+        return cast(list[_LLMMessage], few_shots_threads.rendered[rendered_key])
+
     @classmethod
     def _make_archiving_gpt_dicts_msgs(
         cls, archiving_instruction: Message, archiving_thread: SceneArchivingThread,
-        few_shots_threads: list[SceneArchivingThread] | None
+        few_shots_threads: FewShots | None, prefix_stable: bool = False
     ) -> list[_LLMMessage]:
         archiving_openai_instruction_msg = cls.msg_to_gpt_dict(archiving_instruction)
 
-        few_shots_openai_msgs: list[_LLMMessage] = sum([
-            cls._compile_scene_thread(thread) for thread in few_shots_threads
-        ], []) if few_shots_threads else []
+        few_shots_openai_msgs = cls._make_few_shots_gpt_msgs(few_shots_threads, prefix_stable)
 
-        archving_openai_msgs = cls._compile_scene_thread(archiving_thread)
-        assert len(archving_openai_msgs) == 1, (
+        archving_openai_msgs = cls._compile_scene_thread(archiving_thread, prefix_stable)
+        assert archiving_thread.archive is None, (
             'for some reason archiving thread in _make_archiving_gpt_dicts_msgs already has archive message'
         )
 
@@ -157,7 +318,7 @@ class LLMAPI(ABC):
     @abstractmethod
     async def make_hidden_context_check(
         self, hidden_context_consistency_check_instruciton: Message, current_thread: list[Message],
-        hidden_context: Message
+        hidden_context: Message, use_cache: bool = False
     ) -> HiddenContextConsistencyCheckResult:
         pass
 
@@ -185,10 +346,18 @@ class LLMAPI(ABC):
     @classmethod
     def _make_conversation_continuation_gpt_msgs(
         cls, narration_instruction: Message, hidden_context: Message, archive_subthread: list[Message],
-        conversation_subthread: list[Message]
+        conversation_subthread: list[Message], prefix_stable: bool = False
     ) -> list[_LLMMessage]:
         conversation_instruction_msg = cls.msg_to_gpt_dict(narration_instruction)
-        conversation_instruction_msg['content'] += '\n\n=== CURRENT QUEST ===\n\n' + hidden_context.text
         archive_msg = cls.join_messages_seq_to_gpt_msg(archive_subthread, Role.user, '=== ARCHIVE ===\n\n')
         conversation_msgs = [ cls.msg_to_gpt_dict(msg) for msg in conversation_subthread ]
+
+        if prefix_stable:
+            # archives only grow at their end, the hidden context is regenerated more often than them
+            hidden_context_msg = cls.msg_to_gpt_dict(
+                hidden_context, Role(conversation_instruction_msg['role']), prefix='=== CURRENT QUEST ===\n\n'
+            )
+            return [ conversation_instruction_msg, archive_msg, hidden_context_msg ] + conversation_msgs
+
+        conversation_instruction_msg['content'] += '\n\n=== CURRENT QUEST ===\n\n' + hidden_context.text
         return [ conversation_instruction_msg ] + [ archive_msg ] + conversation_msgs
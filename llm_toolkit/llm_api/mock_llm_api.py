@@ -1,15 +1,28 @@
+import json
 import uuid
+from typing import Any
 
 from llm_toolkit.pydantic_models import Message, Role, SceneArchivingThread
 
-from .llm_api import _LLMMessage, HiddenContextConsistencyCheckResult, LLMAPI
+from .llm_api import _LLMMessage, _LLMResponse, FewShots, HiddenContextConsistencyCheckResult, LLMAPI, PromptEstimate
+from .response_cache import ResponseCache
 
 
 class MockLLMAPI(LLMAPI):
+    _model = 'mock'
+
+    def __init__(self, response_cache: ResponseCache | None = None, prefix_stable_layout: bool = False) -> None:
+        self._response_cache = response_cache
+        self._prefix_stable_layout = prefix_stable_layout
+        # prompts that reached the mocked model, so cache hit rates can be measured
+        self.responses_number = 0
 
     def count_single_message_tokens(self, msg: Message) -> int:
         return 12
 
+    def estimate_prompt(self, llm_messages: list[_LLMMessage]) -> PromptEstimate:
+        return PromptEstimate(tokens_number=12 * len(llm_messages))
+
     @staticmethod
     def print_msg(msg: _LLMMessage) -> None:
         print(f"{'=' * 40}\n\nROLE: {msg['role']}")
@@ -19,32 +32,43 @@ class MockLLMAPI(LLMAPI):
     def print_text(text: str) -> None:
         print(text)
 
+    async def handle_response(self, llm_messages: list[_LLMMessage], response_format: Any = None) -> _LLMResponse:
+        self.responses_number += 1
+        self.print_text(f"{'=' * 40}")
+        for msg in llm_messages:
+            self.print_msg(msg)
+
+        if response_format is not None:
+            # every required field of the JSON schema gets a made up score
+            properties = response_format['json_schema']['schema']['required']
+            return { 'role': Role.assistant.value, 'content': json.dumps({ name: 0.5 for name in properties }) }
+
+        return { 'role': Role.assistant.value, 'content': f'Some generated {uuid.uuid4()}' }
+
     async def get_archving_message(
         self, archiving_instruction: Message, archiving_thread: SceneArchivingThread,
-        few_shots_threads: list[SceneArchivingThread] | None
+        few_shots_threads: FewShots | None, use_cache: bool = False
     ) -> Message:
         archive_for = [ msg.order for msg in archiving_thread.messages ]
 
-        self.print_text(f"{'=' * 40}")
-        for msg in self._make_archiving_gpt_dicts_msgs(
-            archiving_instruction, archiving_thread, few_shots_threads
-        ):
-            self.print_msg(msg)
+        llm_response = await self.get_response(
+            self._make_archiving_gpt_dicts_msgs(
+                archiving_instruction, archiving_thread, few_shots_threads, self._prefix_stable_layout
+            ),
+            use_cache=use_cache
+        )
 
         return Message(
             thread_uid=archiving_thread.messages[0].thread_uid, order=archiving_thread.messages[0].order,
-            role=Role.archive, text=f'Some generated {uuid.uuid4()} for {archive_for}', archive_for=archive_for
+            role=Role.archive, text=f"{llm_response['content']} for {archive_for}", archive_for=archive_for
         )
 
-    async def get_thread_response(self, thread: list[Message]) -> Message:
-
-        self.print_text(f"{'=' * 40}")
-        for msg in self.convert_thread_into_llm_msgs(thread):
-            self.print_msg(msg)
+    async def get_thread_response(self, thread: list[Message], use_cache: bool = False) -> Message:
+        llm_response = await self.get_response(self.convert_thread_into_llm_msgs(thread), use_cache=use_cache)
 
         return Message(
             thread_uid=thread[0].thread_uid, order=thread[0].order,
-            role=Role.archive, text=f'Some generated {uuid.uuid4()} for thread'
+            role=Role.archive, text=f"{llm_response['content']} for thread"
         )
 
     async def make_hidden_context_message(
@@ -64,27 +88,24 @@ class MockLLMAPI(LLMAPI):
 
     async def make_hidden_context_check(
         self, hidden_context_consistency_check_instruciton: Message, current_thread: list[Message],
-        hidden_context: Message
+        hidden_context: Message, use_cache: bool = False
     ) -> HiddenContextConsistencyCheckResult:
-
-        self.print_text(f"{'=' * 40}")
-        for msg in self._make_hidden_context_consistancy_check_gpt_msgs(
-            hidden_context_consistency_check_instruciton, current_thread, hidden_context
-        ):
-            self.print_msg(msg)
-
-        return HiddenContextConsistencyCheckResult(
-            consistency_score=0.85, hook_alignment_score=0.58, logical_coherence_score = 0.92,
-            token_efficiency_score=0.69
+        llm_response = await self.get_response(
+            self._make_hidden_context_consistancy_check_gpt_msgs(
+                hidden_context_consistency_check_instruciton, current_thread, hidden_context
+            ), response_format=HiddenContextConsistencyCheckResult.json_schema, use_cache=use_cache
         )
 
+        return HiddenContextConsistencyCheckResult(**json.loads(llm_response['content']))
+
     async def make_conversation_continuation_message(
         self, narration_instruction: Message, hidden_context: Message, archive_subthread: list[Message],
         conversation_subthread: list[Message]
     ) -> Message:
         self.print_text(f"{'=' * 40}")
         for msg in self._make_conversation_continuation_gpt_msgs(
-            narration_instruction, hidden_context, archive_subthread, conversation_subthread
+            narration_instruction, hidden_context, archive_subthread, conversation_subthread,
+            self._prefix_stable_layout
         ):
             self.print_msg(msg)
 
@@ -1,12 +1,14 @@
+import asyncio
 import httpx
 import itertools
 import json
 import tiktoken
 import yaml
+from dataclasses import asdict
 from datetime import datetime as dt
 from functools import partial, reduce
 from pathlib import Path
-from typing import Any, cast, Iterable, TypedDict
+from typing import Any, AsyncGenerator, cast, Iterable, TypedDict
 
 
 # from models.dnd_time import DnDTime, MonthFR
@@ -14,18 +16,49 @@ from typing import Any, cast, Iterable, TypedDict
 # from llm_api import LLMAPI, LLMMessage, LLMResponse
 import dacite
 from openai import AsyncOpenAI
+from openai.types import CompletionUsage
 # from .model_prices import MODEL_PRICES
 
 from llm_toolkit.pydantic_models import Message, Role, SceneArchivingThread
 from .exceptions import LLMAPIError
 from ._llm_requests_logging import log_request, log_response
+from .response_cache import ResponseCache
+from .token_count_cache import TokenCountCache, text_hash
 
-from .llm_api import HiddenContextConsistencyCheckResult, LLMAPI, _LLMMessage, _LLMResponse
+from .llm_api import (
+    FewShots, HiddenContextConsistencyCheckResult, LLMAPI, PromptCacheStats, PromptEstimate, _LLMMessage, _LLMResponse
+)
+
+
+# tokens the chat format adds around every message and to prime the answer
+MESSAGE_OVERHEAD_TOKENS = 3
+REPLY_PRIMING_TOKENS = 3
+
+
+def get_model_price(model_prices: dict[str, str | int], kind: str) -> float:
+    """Return the price of the kind of tokens from the model's model_prices.yml entry, checked to be a number."""
+    price = model_prices.get(kind)
+    assert price is not None, f'model_prices.yml has no {kind} price for the model'
+    return float(price)
 
 
 class OpenAIAPI(LLMAPI):
+    """Token numbers of message texts are cached in ``token_count_cache``, an in-memory one if it isn't given.
+       ``count_messages_tokens`` encodes the texts missing from it in one batch on ``tokenizer_threads`` threads
+       off the event loop.
+
+       Prompts are counted exactly before they're sent and rejected with ``PromptIsTooLargeError`` if they don't
+       leave room for the longest answer within the model's context window from ``model_prices.yml``.
+
+       Responses of the methods called with ``use_cache`` are kept in ``response_cache`` if it's given.
+
+       ``prefix_stable_layout`` lays prompts out for OpenAI's prompt caching, the cached prompt tokens reported
+       with responses are summed up by ``get_prompt_cache_stats``."""
+
     def __init__(self, api_key: str, model: str = 'gpt-5', url: str = '',
-                 store_logs: str | None = 'http_full_logs', proxy_uri: str | None = None) -> None:
+                 store_logs: str | None = 'http_full_logs', proxy_uri: str | None = None,
+                 token_count_cache: TokenCountCache | None = None, tokenizer_threads: int = 4,
+                 response_cache: ResponseCache | None = None, prefix_stable_layout: bool = False) -> None:
 
         custom_client = httpx.AsyncClient(
             event_hooks={
@@ -45,26 +78,31 @@ class OpenAIAPI(LLMAPI):
         with open(Path(__file__).parent / 'model_prices.yml', 'r') as cfg_fopen:
             MODEL_PRICES: dict[str, dict[str, str | int]] = yaml.safe_load(cfg_fopen.read())
         self._model = model
-        self._model_price_for_one_token_input = MODEL_PRICES.get(self._model, {}).get('input')
-        self._model_price_for_one_token_cached = MODEL_PRICES.get(self._model, {}).get('cached')
-        self._model_price_for_one_token_output = MODEL_PRICES.get(self._model, {}).get('output')
+        self._model_price_for_one_token_input = get_model_price(MODEL_PRICES.get(self._model, {}), 'input')
+        self._model_price_for_one_token_cached = get_model_price(MODEL_PRICES.get(self._model, {}), 'cached')
+        self._model_price_for_one_token_output = get_model_price(MODEL_PRICES.get(self._model, {}), 'output')
         self._tokenization_encoding_rule_for_model = MODEL_PRICES.get(self._model, {}).get('tokenization')
-        assert self._model_price_for_one_token_input is not None
-        assert self._model_price_for_one_token_cached is not None
-        assert self._model_price_for_one_token_output is not None
+        context_window = MODEL_PRICES.get(self._model, {}).get('context_window')
+        max_output_tokens = MODEL_PRICES.get(self._model, {}).get('max_output_tokens', 0)
+        self._max_prompt_tokens = int(context_window) - int(max_output_tokens) if context_window is not None else None
         assert self._tokenization_encoding_rule_for_model is not None
         self._encoding = tiktoken.get_encoding(str(self._tokenization_encoding_rule_for_model))
+        self._token_count_cache = token_count_cache if token_count_cache is not None else TokenCountCache()
+        self._tokenizer_threads = tokenizer_threads
+        self._response_cache = response_cache
+        self._prefix_stable_layout = prefix_stable_layout
+        self._prompt_cache_stats = PromptCacheStats()
 
     async def get_archving_message(
         self, archiving_instruction: Message, archiving_thread: SceneArchivingThread,
-        few_shots_threads: list[SceneArchivingThread] | None
+        few_shots_threads: FewShots | None, use_cache: bool = False
     ) -> Message:
         """Generate archving message based on given instruciton message and background subthread with optional
            few-shots"""
         openai_msgs = self._make_archiving_gpt_dicts_msgs(
-            archiving_instruction, archiving_thread, few_shots_threads
+            archiving_instruction, archiving_thread, few_shots_threads, self._prefix_stable_layout
         )
-        result = await self.handle_response(openai_msgs)
+        result = await self.get_response(openai_msgs, use_cache=use_cache)
 
         archive_for = [ msg.order for msg in archiving_thread.messages ]
 
@@ -78,8 +116,8 @@ class OpenAIAPI(LLMAPI):
             archive_for=archive_for
         )
 
-    async def get_thread_response(self, thread: list[Message]) -> Message:
-        llm_response = await self.handle_response(self.convert_thread_into_llm_msgs(thread))
+    async def get_thread_response(self, thread: list[Message], use_cache: bool = False) -> Message:
+        llm_response = await self.get_response(self.convert_thread_into_llm_msgs(thread), use_cache=use_cache)
         return Message(
             thread_uid=thread[0].thread_uid, order=max(msg.order for msg in thread) + 1,
             role=Role(llm_response['role']), text=llm_response['content']
@@ -99,12 +137,12 @@ class OpenAIAPI(LLMAPI):
 
     async def make_hidden_context_check(
         self, hidden_context_consistency_check_instruciton: Message, current_thread: list[Message],
-        hidden_context: Message
+        hidden_context: Message, use_cache: bool = False
     ) -> HiddenContextConsistencyCheckResult:
-        llm_response = await self.handle_response(
+        llm_response = await self.get_response(
             self._make_hidden_context_consistancy_check_gpt_msgs(
                 hidden_context_consistency_check_instruciton, current_thread, hidden_context
-            ), response_format=HiddenContextConsistencyCheckResult.json_schema
+            ), response_format=HiddenContextConsistencyCheckResult.json_schema, use_cache=use_cache
         )
         return dacite.from_dict(
             data_class=HiddenContextConsistencyCheckResult, data=json.loads(llm_response['content']),
@@ -117,7 +155,8 @@ class OpenAIAPI(LLMAPI):
     ) -> Message:
         llm_response = await self.handle_response(
             self._make_conversation_continuation_gpt_msgs(
-                narration_instruction, hidden_context, archive_subthread, conversation_subthread
+                narration_instruction, hidden_context, archive_subthread, conversation_subthread,
+                self._prefix_stable_layout
             )
         )
         return Message(
@@ -125,11 +164,67 @@ class OpenAIAPI(LLMAPI):
             role=Role(llm_response['role']), text=llm_response['content']
         )
 
+    async def stream_thread_response(self, thread: list[Message]) -> AsyncGenerator[str, None]:
+        async for delta in self.handle_stream_response(self.convert_thread_into_llm_msgs(thread)):
+            yield delta
+
+    async def stream_conversation_continuation_message(
+        self, narration_instruction: Message, hidden_context: Message, archive_subthread: list[Message],
+        conversation_subthread: list[Message]
+    ) -> AsyncGenerator[str, None]:
+        async for delta in self.handle_stream_response(
+            self._make_conversation_continuation_gpt_msgs(
+                narration_instruction, hidden_context, archive_subthread, conversation_subthread,
+                self._prefix_stable_layout
+            )
+        ):
+            yield delta
+
+    async def handle_stream_response(self, gpt_messages: list[_LLMMessage]) -> AsyncGenerator[str, None]:
+        """Yield text deltas of the answer as the chat completion streams them, skipping empty ones."""
+        assert gpt_messages
+        # fails before anything is uploaded
+        self.preflight(gpt_messages)
+
+        stream = await self._client.chat.completions.create(
+            model=self._model, messages=gpt_messages, service_tier="flex", stream=True,
+            # the usage comes in the last chunk, which has no choices
+            stream_options={ 'include_usage': True }
+        )
+        # the connection is released even if the stream isn't read to the end
+        async with stream:
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    self._record_usage(chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    def _record_usage(self, usage: CompletionUsage) -> None:
+        details = usage.prompt_tokens_details
+        cached_tokens = (details.cached_tokens or 0) if details is not None else 0
+
+        self._prompt_cache_stats.requests += 1
+        self._prompt_cache_stats.prompt_tokens += usage.prompt_tokens
+        self._prompt_cache_stats.cached_tokens += cached_tokens
+        self._prompt_cache_stats.input_cost += self._get_input_cost(usage.prompt_tokens, cached_tokens)
+
+    def _get_input_cost(self, prompt_tokens: int, cached_tokens: int = 0) -> float:
+        """Return the price in USD of a prompt with ``cached_tokens`` of its tokens read from the prompt cache."""
+        return (
+            self._model_price_for_one_token_cached * cached_tokens
+            + self._model_price_for_one_token_input * (prompt_tokens - cached_tokens)
+        ) / 1_000_000
+
+    def get_prompt_cache_stats(self) -> PromptCacheStats:
+        return PromptCacheStats(**asdict(self._prompt_cache_stats))
+
     async def handle_response(
         self, gpt_messages: list[_LLMMessage], response_format: Any = None# , functions: dict[str, Any] | None = None,
         # function_call: dict[str, str] | None = None
     ) -> _LLMResponse:
         assert gpt_messages
+        # fails before anything is uploaded
+        self.preflight(gpt_messages)
 
         response = await self._client.chat.completions.create(  # type: ignore[arg-type]
             model=self._model, messages=gpt_messages,
@@ -137,6 +232,9 @@ class OpenAIAPI(LLMAPI):
             # , functions=functions, function_call=function_call
         )
 
+        if response.usage is not None:
+            self._record_usage(response.usage)
+
         assert len(response.choices) == 1
         choice = response.choices[0]
         gpt_msg = choice.message
@@ -215,9 +313,51 @@ class OpenAIAPI(LLMAPI):
 #             thread_uid, role, text, order, last_scene=scene, count_message_tokens_function=self.count_single_message_tokens, scene=scene.scene_number, **kwargs
 #         )
 
+    def _count_text_tokens(self, text: str) -> int:
+        key = text_hash(text)
+        if (tokens_number := self._token_count_cache.get(self._encoding.name, key)) is None:
+            tokens_number = len(self._encoding.encode(text))
+            self._token_count_cache.put(self._encoding.name, key, tokens_number)
+        return tokens_number
+
     def count_single_message_tokens(self, msg: Message) -> int:
         msg_gpt = self.msg_to_gpt_dict(msg, role=Role.user)
-        return len(self._encoding.encode(msg_gpt['role'])) + len(self._encoding.encode(msg_gpt['content'])) + 2
+        return len(self._encoding.encode(msg_gpt['role'])) + self._count_text_tokens(msg_gpt['content']) + 2
+
+    def estimate_prompt(self, llm_messages: list[_LLMMessage]) -> PromptEstimate:
+        tokens_number = sum(
+            MESSAGE_OVERHEAD_TOKENS + len(self._encoding.encode(llm_msg['role']))
+            + self._count_text_tokens(llm_msg['content']) for llm_msg in llm_messages
+        ) + (REPLY_PRIMING_TOKENS if llm_messages else 0)
+
+        return PromptEstimate(
+            tokens_number=tokens_number, max_prompt_tokens=self._max_prompt_tokens,
+            input_cost=self._get_input_cost(tokens_number)
+        )
+
+    async def count_messages_tokens(self, messages: list[Message]) -> list[int]:
+        contents = [ self.msg_to_gpt_dict(msg, role=Role.user)['content'] for msg in messages ]
+        keys = [ text_hash(content) for content in contents ]
+
+        missing = {
+            key: content for key, content in zip(keys, contents)
+                if self._token_count_cache.get(self._encoding.name, key) is None
+        }
+        if missing:
+            encoded = await asyncio.to_thread(
+                self._encoding.encode_batch, list(missing.values()), num_threads=self._tokenizer_threads
+            )
+            for key, tokens in zip(missing, encoded):
+                self._token_count_cache.put(self._encoding.name, key, len(tokens))
+            await asyncio.to_thread(self._token_count_cache.save)
+
+        role_tokens_number = len(self._encoding.encode(Role.user.value))
+        return [
+            role_tokens_number + cast(int, self._token_count_cache.get(self._encoding.name, key)) + 2 for key in keys
+        ]
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self._token_count_cache.save)
 
 #     def count_messages_request_tokens(self, messages: list[Message]) -> int:
 #         return sum(
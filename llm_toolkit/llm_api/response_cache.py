@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+
+def prompt_hash(model: str, llm_messages: list[Any], response_format: Any = None) -> str:
+    """Hash the prompt in a canonical form, so equal prompts get the same key whatever order their keys are in."""
+    canonical = json.dumps(
+        { 'model': model, 'messages': llm_messages, 'response_format': response_format },
+        sort_keys=True, separators=(',', ':'), ensure_ascii=False
+    )
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+@dataclass
+class ResponseCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # entries found older than the TTL, counted as misses too
+    expirations: int = 0
+    evictions: int = 0
+    # number and total size in bytes of the entries on disk at the moment
+    entries: int = 0
+    size: int = 0
+
+
+class ResponseCache:
+    """LLM responses stored in ``path`` as ``<key>.json`` files, keyed by ``prompt_hash``. Entries older than
+       ``ttl`` seconds are misses and get removed, the least recently used ones are evicted once their total size
+       in bytes exceeds ``max_bytes``, ``None`` means no bound for both. A hit touches the file, so the order of
+       use survives restarts. Files are read and written off the event loop."""
+
+    def __init__(self, path: Path, ttl: float | None = 24 * 60 * 60, max_bytes: int | None = 64 * 2**20) -> None:
+        self._path = path
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        # sizes of the entries on disk by their keys, least recently used first, loaded on the first access
+        self._entries: OrderedDict[str, int] | None = None
+        self._size = 0
+        self._stats = ResponseCacheStats()
+
+    def _get_entry_path(self, key: str) -> Path:
+        return self._path / f'{key}.json'
+
+    def _scan(self) -> OrderedDict[str, int]:
+        if not self._path.is_dir():
+            return OrderedDict()
+
+        stats = [ (entry_path.stem, entry_path.stat()) for entry_path in self._path.glob('*.json') ]
+        stats.sort(key=lambda item: item[1].st_mtime_ns)
+        return OrderedDict((key, stat.st_size) for key, stat in stats)
+
+    async def _get_entries(self) -> OrderedDict[str, int]:
+        if self._entries is None:
+            entries = await asyncio.to_thread(self._scan)
+            # a concurrent first access may have loaded them meanwhile
+            if self._entries is None:
+                self._entries = entries
+                self._size = sum(entries.values())
+        return self._entries
+
+    def _read(self, key: str) -> dict[str, Any] | None:
+        entry_path = self._get_entry_path(key)
+        try:
+            with open(entry_path, 'r', encoding='utf-8') as fopen:
+                entry = json.load(fopen)
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def _write(self, key: str, body: bytes) -> None:
+        self._path.mkdir(parents=True, exist_ok=True)
+        # a reader never sees a partly written entry, and concurrent stores of one key don't share a temporary file
+        with tempfile.NamedTemporaryFile(dir=self._path, prefix=f'.{key}.', suffix='.tmp', delete=False) as fopen:
+            fopen.write(body)
+        try:
+            os.replace(fopen.name, self._get_entry_path(key))
+        except OSError:
+            os.unlink(fopen.name)
+            raise
+
+    def _remove(self, keys: list[str]) -> None:
+        for key in keys:
+            self._get_entry_path(key).unlink(missing_ok=True)
+
+    def _discard(self, entries: OrderedDict[str, int], key: str) -> None:
+        if (size := entries.pop(key, None)) is not None:
+            self._size -= size
+
+    async def get(self, key: str) -> Any:
+        """Return the response stored with the key, ``None`` if there's none or it expired."""
+        entries = await self._get_entries()
+        entry = await asyncio.to_thread(self._read, key) if key in entries else None
+        if entry is None:
+            self._stats.misses += 1
+            return None
+
+        if self._ttl is not None and time.time() - entry['created'] > self._ttl:
+            self._discard(entries, key)
+            await asyncio.to_thread(self._remove, [ key ])
+            self._stats.expirations += 1
+            self._stats.misses += 1
+            return None
+
+        self._stats.hits += 1
+        entries.move_to_end(key)
+        return entry['response']
+
+    async def put(self, key: str, response: Any) -> None:
+        body = json.dumps({ 'created': time.time(), 'response': response }, ensure_ascii=False).encode('utf-8')
+        if self._max_bytes is not None and len(body) > self._max_bytes:
+            return
+
+        entries = await self._get_entries()
+        await asyncio.to_thread(self._write, key, body)
+        self._discard(entries, key)
+        entries[key] = len(body)
+        self._size += len(body)
+
+        evicted = []
+        while self._max_bytes is not None and self._size > self._max_bytes:
+            evicted_key, evicted_size = entries.popitem(last=False)
+            self._size -= evicted_size
+            evicted.append(evicted_key)
+        if evicted:
+            self._stats.evictions += len(evicted)
+            await asyncio.to_thread(self._remove, evicted)
+
+    @property
+    def stats(self) -> ResponseCacheStats:
+        return ResponseCacheStats(
+            self._stats.hits, self._stats.misses, self._stats.expirations, self._stats.evictions,
+            len(self._entries or ()), self._size
+        )
@@ -0,0 +1,51 @@
+import hashlib
+from pathlib import Path
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class TokenCountCache:
+    """Token numbers of texts keyed by the encoding and the hash of the text, so equal texts are encoded once.
+
+       With ``path`` set, counts are loaded from it when the cache is created and the ones added since are appended
+       to it by ``save`` as ``<encoding>\\t<hash>\\t<count>`` lines. Unreadable lines, e.g. one cut by a crash, are
+       skipped and counted again."""
+
+    def __init__(self, path: Path | None = None) -> None:
+        self._path = path
+        self._counts: dict[tuple[str, str], int] = {}
+        # entries added since the last save
+        self._unsaved: list[tuple[str, str, int]] = []
+
+        if path is not None and path.is_file():
+            with open(path, 'r', encoding='utf-8') as fopen:
+                for line in fopen:
+                    try:
+                        encoding, key, count = line.rstrip('\n').split('\t')
+                        self._counts[(encoding, key)] = int(count)
+                    except ValueError:
+                        continue
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def get(self, encoding: str, key: str) -> int | None:
+        return self._counts.get((encoding, key))
+
+    def put(self, encoding: str, key: str, count: int) -> None:
+        if (encoding, key) not in self._counts:
+            self._unsaved.append((encoding, key, count))
+        self._counts[(encoding, key)] = count
+
+    def save(self) -> None:
+        """Append the counts added since the last save, may be called from a worker thread."""
+        # the list is swapped first, so counts put meanwhile are left for the next save
+        unsaved, self._unsaved = self._unsaved, []
+        if self._path is None or not unsaved:
+            return
+
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self._path, 'a', encoding='utf-8') as fopen:
+            fopen.writelines(f'{encoding}\t{key}\t{count}\n' for encoding, key, count in unsaved)
@@ -1,12 +1,27 @@
-from .exceptions import MessageBrokerError, MessageIsNotFoundError, ThreadIsNotFoundError
+from .compression import Compression
+from .exceptions import (
+    ArchiveIsMalformedError, MessageAlreadyExistsError, MessageBrokerError, MessageIsNotFoundError,
+    ThreadIsNotFoundError, ThreadVersionConflictError
+)
 from .file_message_broker import FileMessageBroker
-from .message_broker import MessageBroker
+from .message_broker import MessageBroker, MessagesOrders
+from .segment_log_message_broker import SegmentLogMessageBroker
+from .sqlite_message_broker import SQLiteMessageBroker
+from .write_pipeline import Durability
 
 
 __all__ = [
+    'ArchiveIsMalformedError',
+    'Compression',
+    'Durability',
     'FileMessageBroker',
     'MessageBroker',
+    'MessageAlreadyExistsError',
     'MessageBrokerError',
     'MessageIsNotFoundError',
-    'ThreadIsNotFoundError'
+    'MessagesOrders',
+    'SegmentLogMessageBroker',
+    'SQLiteMessageBroker',
+    'ThreadIsNotFoundError',
+    'ThreadVersionConflictError'
 ]
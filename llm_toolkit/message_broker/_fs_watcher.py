@@ -0,0 +1,214 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+from abc import ABC, abstractmethod
+from enum import StrEnum
+from pathlib import Path
+from typing import Callable
+
+
+class FileEvent(StrEnum):
+    changed = 'changed'
+    deleted = 'deleted'
+    # events were lost, everything in the directory has to be reread
+    overflow = 'overflow'
+
+
+FileEventCallback = Callable[[Path, FileEvent], None]
+
+
+class FileSystemWatcher(ABC):
+    """Reports changes of files directly inside watched directories to the callback in the event loop thread."""
+
+    def __init__(self, callback: FileEventCallback) -> None:
+        self._callback = callback
+        return super().__init__()
+
+    @abstractmethod
+    async def start(self) -> None:
+        pass
+
+    @abstractmethod
+    async def stop(self) -> None:
+        pass
+
+    @abstractmethod
+    def watch(self, directory: Path) -> None:
+        pass
+
+    @abstractmethod
+    def unwatch(self, directory: Path) -> None:
+        pass
+
+
+class InotifyWatcher(FileSystemWatcher):
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, callback: FileEventCallback) -> None:
+        super().__init__(callback)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._libc.inotify_init1.argtypes = [ ctypes.c_int ]
+        self._libc.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+        self._libc.inotify_rm_watch.argtypes = [ ctypes.c_int, ctypes.c_int ]
+
+        self._fd = self._open()
+        self._directories_by_wd: dict[int, Path] = {}
+        # watched directories keep -1 while the watcher is stopped and get their watches again on start
+        self._wds_by_directory: dict[Path, int] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def _open(self) -> int:
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        return fd
+
+    def _add_watch(self, directory: Path) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {directory}')
+
+        self._directories_by_wd[wd] = directory
+        self._wds_by_directory[directory] = wd
+
+    async def start(self) -> None:
+        if self._fd < 0:
+            # stop closed the descriptor and the watches with it
+            self._fd = self._open()
+            for directory in list(self._wds_by_directory):
+                self._add_watch(directory)
+
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self._fd, self._read_events)
+
+    async def stop(self) -> None:
+        if self._loop is not None:
+            self._loop.remove_reader(self._fd)
+            self._loop = None
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+            self._directories_by_wd.clear()
+            self._wds_by_directory = dict.fromkeys(self._wds_by_directory, -1)
+
+    def watch(self, directory: Path) -> None:
+        if directory in self._wds_by_directory:
+            return
+
+        if self._fd < 0:
+            self._wds_by_directory[directory] = -1
+        else:
+            self._add_watch(directory)
+
+    def unwatch(self, directory: Path) -> None:
+        if (wd := self._wds_by_directory.pop(directory, None)) is not None and wd >= 0:
+            del self._directories_by_wd[wd]
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _read_events(self) -> None:
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_length = self.EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + self.EVENT_HEADER.size:offset + self.EVENT_HEADER.size + name_length]
+            offset += self.EVENT_HEADER.size + name_length
+
+            if mask & self.IN_Q_OVERFLOW:
+                for watched_directory in list(self._wds_by_directory):
+                    self._callback(watched_directory, FileEvent.overflow)
+                continue
+
+            directory = self._directories_by_wd.get(wd)
+            if directory is None or mask & self.IN_ISDIR or not name.rstrip(b'\0'):
+                continue
+
+            path = directory / os.fsdecode(name.rstrip(b'\0'))
+            if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                self._callback(path, FileEvent.changed)
+            elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                self._callback(path, FileEvent.deleted)
+
+
+class PollingWatcher(FileSystemWatcher):
+
+    def __init__(self, callback: FileEventCallback, poll_interval: float = 1.0) -> None:
+        super().__init__(callback)
+        self._poll_interval = poll_interval
+        # directories watched since the last scan have no snapshot yet, the next one only takes it
+        self._snapshots: dict[Path, dict[str, tuple[int, int]] | None] = {}
+        # set by watch to scan a new directory at once instead of after the poll interval
+        self._directory_watched = asyncio.Event()
+        self._task: asyncio.Task[None] | None = None
+
+    @staticmethod
+    def _take_snapshot(directory: Path) -> dict[str, tuple[int, int]]:
+        try:
+            with os.scandir(directory) as entries:
+                return {
+                    entry.name: (entry.stat().st_mtime_ns, entry.stat().st_size)
+                    for entry in entries if entry.is_file()
+                }
+        except FileNotFoundError:
+            return {}
+
+    async def _poll(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._directory_watched.wait(), self._poll_interval)
+            except TimeoutError:
+                pass
+            self._directory_watched.clear()
+
+            for directory, snapshot in list(self._snapshots.items()):
+                new_snapshot = await asyncio.to_thread(self._take_snapshot, directory)
+                if directory not in self._snapshots:
+                    continue
+                self._snapshots[directory] = new_snapshot
+                if snapshot is None:
+                    continue
+
+                for name, stat in new_snapshot.items():
+                    if snapshot.get(name) != stat:
+                        self._callback(directory / name, FileEvent.changed)
+                for name in snapshot.keys() - new_snapshot.keys():
+                    self._callback(directory / name, FileEvent.deleted)
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def watch(self, directory: Path) -> None:
+        # scanned in a worker thread by the poll task, not here in the event loop
+        if directory not in self._snapshots:
+            self._snapshots[directory] = None
+            self._directory_watched.set()
+
+    def unwatch(self, directory: Path) -> None:
+        self._snapshots.pop(directory, None)
+
+
+def make_file_system_watcher(callback: FileEventCallback, poll_interval: float = 1.0) -> FileSystemWatcher:
+    """Return an inotify watcher where it's available and a polling one otherwise."""
+    try:
+        return InotifyWatcher(callback)
+    except (OSError, AttributeError):
+        return PollingWatcher(callback, poll_interval)
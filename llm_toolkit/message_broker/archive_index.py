@@ -0,0 +1,84 @@
+import bisect
+from typing import Generic, Iterator, TypeVar
+
+
+T = TypeVar('T')
+
+
+class ArchiveIndex(Generic[T]):
+    """Archives of a thread keyed by the ``(order_from, order_to)`` range they cover, which may nest (archives of
+       archives) or overlap. Ranges are kept sorted together with the running maximum of their ``order_to``, which
+       never decreases, so the archive covering an order is found by two bisections instead of a scan."""
+
+    def __init__(self) -> None:
+        self._archives: dict[tuple[int, int], T] = {}
+        self._ranges: list[tuple[int, int]] = []
+        # the greatest order_to of ranges[:index + 1]
+        self._max_orders_to: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self._ranges)
+
+    def __contains__(self, archive_range: tuple[int, int]) -> bool:
+        return archive_range in self._archives
+
+    def __getitem__(self, archive_range: tuple[int, int]) -> T:
+        return self._archives[archive_range]
+
+    def __iter__(self) -> Iterator[tuple[int, int]]:
+        return iter(self._ranges)
+
+    def _update_max_orders_to(self, index: int) -> None:
+        # the maximums before the changed range stay, the ones after it only until they match again
+        previous = self._max_orders_to[index - 1] if index else -1
+        for i in range(index, len(self._ranges)):
+            max_order_to = max(previous, self._ranges[i][1])
+            if i > index and self._max_orders_to[i] == max_order_to:
+                return
+            self._max_orders_to[i] = max_order_to
+            previous = max_order_to
+
+    def add(self, order_from: int, order_to: int, archive: T) -> None:
+        archive_range = (order_from, order_to)
+        if archive_range not in self._archives:
+            index = bisect.bisect_left(self._ranges, archive_range)
+            self._ranges.insert(index, archive_range)
+            self._max_orders_to.insert(index, order_to)
+            self._update_max_orders_to(index)
+        self._archives[archive_range] = archive
+
+    def remove(self, order_from: int, order_to: int) -> T | None:
+        archive_range = (order_from, order_to)
+        if (archive := self._archives.pop(archive_range, None)) is None:
+            return None
+
+        index = bisect.bisect_left(self._ranges, archive_range)
+        del self._ranges[index]
+        del self._max_orders_to[index]
+        if index < len(self._ranges):
+            self._update_max_orders_to(index)
+        return archive
+
+    def covering(self, order: int) -> tuple[int, int] | None:
+        """Return the range of the outermost archive covering the order: the first starting one, the widest
+           of those starting with it, or ``None`` if no archive covers it."""
+        # the first range whose order_to or an earlier one's reaches the order is the first one covering it
+        index = bisect.bisect_left(self._max_orders_to, order)
+        if index == len(self._ranges) or self._ranges[index][0] > order:
+            return None
+
+        order_from = self._ranges[index][0]
+        return self._ranges[bisect.bisect_left(self._ranges, (order_from + 1, )) - 1]
+
+    def starting_between(self, order_from: int, order_to: int) -> list[tuple[int, int]]:
+        """Return the sorted ranges of archives starting between the orders, both included."""
+        return self._ranges[
+            bisect.bisect_left(self._ranges, (order_from, )):bisect.bisect_left(self._ranges, (order_to + 1, ))
+        ]
+
+    def overlapping(self, order_from: int, order_to: int) -> list[tuple[int, int]]:
+        """Return the sorted ranges of archives covering any order between the orders, both included."""
+        # ranges before the first one reaching order_from all end before it
+        start = bisect.bisect_left(self._max_orders_to, order_from)
+        end = bisect.bisect_left(self._ranges, (order_to + 1, ))
+        return [ archive_range for archive_range in self._ranges[start:end] if archive_range[1] >= order_from ]
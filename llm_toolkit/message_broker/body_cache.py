@@ -0,0 +1,61 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+
+
+def content_hash(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+@dataclass
+class BodyCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    # number and total size in bytes of the bodies cached at the moment
+    entries: int = 0
+    size: int = 0
+
+
+class BodyCache:
+    """LRU cache of message bodies keyed by their content hash, so equal bodies are cached once and a changed
+       message never gets a stale body. The least recently used bodies are evicted once their total size in
+       bytes exceeds ``max_bytes``, ``None`` means no bound."""
+
+    def __init__(self, max_bytes: int | None) -> None:
+        self._max_bytes = max_bytes
+        self._bodies: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._size = 0
+        self._stats = BodyCacheStats()
+
+    def get(self, key: str) -> str | None:
+        if key not in self._bodies:
+            self._stats.misses += 1
+            return None
+
+        self._stats.hits += 1
+        self._bodies.move_to_end(key)
+        return self._bodies[key][0]
+
+    def put(self, key: str, text: str, size: int) -> None:
+        if self._max_bytes is not None and size > self._max_bytes:
+            return
+
+        self.discard(key)
+        self._bodies[key] = (text, size)
+        self._size += size
+
+        while self._max_bytes is not None and self._size > self._max_bytes:
+            _, (_, evicted_size) = self._bodies.popitem(last=False)
+            self._size -= evicted_size
+            self._stats.evictions += 1
+
+    def discard(self, key: str) -> None:
+        if (entry := self._bodies.pop(key, None)) is not None:
+            self._size -= entry[1]
+
+    @property
+    def stats(self) -> BodyCacheStats:
+        return BodyCacheStats(
+            self._stats.hits, self._stats.misses, self._stats.evictions, len(self._bodies), self._size
+        )
@@ -0,0 +1,57 @@
+import zlib
+from enum import StrEnum
+from typing import Callable
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is optional, zlib from the standard library is always available
+    zstandard = None  # type: ignore[assignment]
+
+from .exceptions import MessageBrokerError
+
+
+class Compression(StrEnum):
+    """Codec of a compressed message body, also used as the suffix of its file, e.g. ``000012_user.txt.zstd``."""
+    zlib = 'zlib'
+    zstd = 'zstd'
+
+
+def check_compression_available(compression: Compression) -> None:
+    if compression == Compression.zstd and zstandard is None:
+        raise MessageBrokerError('zstd compression requires the zstandard package')
+
+
+def train_dictionary(samples: list[bytes], size: int) -> tuple[int, bytes] | None:
+    """Return the id and the content of a zstd dictionary trained over the samples, or ``None`` if there are
+       too few of them to train one."""
+    assert zstandard is not None
+    try:
+        dictionary = zstandard.train_dictionary(size, samples)
+    except zstandard.ZstdError:
+        return None
+
+    return dictionary.dict_id(), dictionary.as_bytes()
+
+
+def compress_body(compression: Compression, body: bytes, dictionary: bytes | None = None) -> bytes:
+    if compression == Compression.zlib:
+        return zlib.compress(body)
+
+    assert zstandard is not None
+    return zstandard.ZstdCompressor(
+        dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary is not None else None
+    ).compress(body)
+
+
+def decompress_body(compression: Compression, data: bytes, get_dictionary: Callable[[int], bytes]) -> bytes:
+    """Decompress the body, ``get_dictionary`` is called with the id of the zstd dictionary it was compressed with."""
+    if compression == Compression.zlib:
+        return zlib.decompress(data)
+
+    check_compression_available(compression)
+    assert zstandard is not None
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+    return zstandard.ZstdDecompressor(
+        dict_data=zstandard.ZstdCompressionDict(get_dictionary(dict_id)) if dict_id else None
+    ).decompress(data)
@@ -11,3 +11,23 @@ class MessageIsNotFoundError(MessageBrokerError):
 class ThreadIsNotFoundError(MessageBrokerError):
     def __init__(self, thread_uid: str | int):
         return super().__init__(f"There's no {thread_uid} thread")
+
+
+class MessageAlreadyExistsError(MessageBrokerError):
+    def __init__(self, thread_uid: str | int, order: int):
+        return super().__init__(f'Message with order {order} already exists in {thread_uid} thread')
+
+
+class ArchiveIsMalformedError(MessageBrokerError):
+    def __init__(self, thread_uid: str | int, order: int):
+        return super().__init__(f"Archive message {order} of {thread_uid} thread has null in 'archive_for'")
+
+
+class ThreadVersionConflictError(MessageBrokerError):
+    def __init__(self, thread_uid: str | int, expected_version: int, version: int):
+        self.thread_uid = thread_uid
+        self.expected_version = expected_version
+        self.version = version
+        return super().__init__(
+            f'{thread_uid} thread is at version {version}, but version {expected_version} was expected'
+        )
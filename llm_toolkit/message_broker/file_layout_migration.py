@@ -0,0 +1,49 @@
+"""Move the thread of a flat FileMessageBroker ``dialog/`` directory into its own thread directory.
+
+   Usage: python -m llm_toolkit.message_broker.file_layout_migration DIALOG_DIR THREAD_UID
+
+   Before threads got their own directories, message files and the hidden context of the only thread lay directly
+   in DIALOG_DIR. They're moved into DIALOG_DIR/THREAD_UID/, instructions and few shots stay in DIALOG_DIR, where
+   every thread still finds them."""
+import argparse
+from pathlib import Path
+
+
+FLAT_THREAD_FILENAMES = ( 'hidden_context.txt', )
+
+def find_flat_thread_files(dialog_path: Path) -> list[Path]:
+    """Return the message and hidden context files lying directly in the directory."""
+    if not dialog_path.is_dir():
+        return []
+
+    return sorted(
+        f for f in dialog_path.iterdir()
+            if f.is_file() and (f.name[:6].isdigit() or f.name in FLAT_THREAD_FILENAMES)
+    )
+
+
+def migrate(dialog_path: Path, thread_uid: str) -> int:
+    """Move the flat thread files into the thread directory and return their number. Nothing is moved if the
+       thread directory already has a file of the same name."""
+    files = find_flat_thread_files(dialog_path)
+    thread_path = dialog_path / thread_uid
+    if clashing := [ f.name for f in files if (thread_path / f.name).exists() ]:
+        raise ValueError(f'{thread_path} already has {", ".join(clashing)}')
+
+    thread_path.mkdir(exist_ok=True)
+    for f in files:
+        f.rename(thread_path / f.name)
+    return len(files)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Move the thread of a flat FileMessageBroker directory into its own')
+    parser.add_argument('dialog_path', type=Path)
+    parser.add_argument('thread_uid')
+    args = parser.parse_args()
+
+    print(f'{migrate(args.dialog_path, args.thread_uid)} files moved')
+
+
+if __name__ == '__main__':
+    main()
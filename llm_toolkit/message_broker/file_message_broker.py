@@ -1,65 +1,65 @@
 import asyncio
-import itertools
-from dataclasses import dataclass
+import bisect
+import heapq
+import time
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import AsyncIterator
+from typing import AsyncGenerator, Iterable, cast
 
-import aiofiles
 from aiopath import AsyncPath
 
-from ..pydantic_models import Message, Role, SceneArchivingThread
-from .message_broker import MessageBroker
-from .exceptions import MessageBrokerError, MessageIsNotFoundError
+from ..pydantic_models import FewShotsBundle, Message, Role
+from .message_broker import MessageBroker, MessagesOrders, split_messages_orders
+from ._fs_watcher import FileEvent, make_file_system_watcher
+from .archive_index import ArchiveIndex
+from .body_cache import BodyCache, BodyCacheStats, content_hash
+from .compression import Compression, check_compression_available, compress_body, decompress_body, train_dictionary
+from .exceptions import (
+    ArchiveIsMalformedError, MessageAlreadyExistsError, MessageBrokerError, MessageIsNotFoundError,
+    ThreadIsNotFoundError, ThreadVersionConflictError
+)
+from .prompt_asset_cache import PromptAssetCache, TokenCounter
+from .write_pipeline import Durability, WritePipeline, write_file_atomically
+
+
+ZSTD_DICTIONARY_FILENAME = 'zstd_dictionary_{}.bin'
+# messages a thread dictionary is trained over, the most recent ones
+DICTIONARY_MAX_SAMPLES = 1000
+COMPRESSIONS_BY_SUFFIX = { compression.value: compression for compression in Compression }
+
+
+@dataclass(slots=True)
+class MessageMeta:
+    order: int
+    role: Role
+    # size of the UTF-8 encoded body in bytes
+    size: int
+    content_hash: str
+    # last archived order, for archives only
+    order_to: int | None = None
+    compression: Compression | None = None
 
 
 @dataclass
-class MessageNode:
-    message: Message | None = None
-    archive: Message | None = None
+class ThreadCache:
+    # stored (non-archive) messages by their orders
+    messages: dict[int, MessageMeta] = field(default_factory=dict)
+    # sorted orders of stored messages
+    orders: list[int] = field(default_factory=list)
+    archives: ArchiveIndex[MessageMeta] = field(default_factory=ArchiveIndex)
 
 
 class FileMessageBroker(MessageBroker):
+    """Stores every thread in its own ``storage_path / <thread_uid>`` directory, one file per message, e.g.
+       ``000012_user.txt``. Instructions and few-shots in ``storage_path`` are shared by all threads."""
 
-    def _build_fiesystem_cache(self, thread_uid: str | int) -> dict[int, MessageNode]:
-        result: dict[int, MessageNode] = {}
-
-        for f in self._storage_path.iterdir():
-            if f.is_file() and f.name[:6].isdigit():
-                order, *args, role_raw = f.name.split('_')
-                int_order = int(order)
-                role = Role(role_raw.split('.')[0])
-
-                if role == Role.archive:
-                    order_to, *_ = args
-                    archive_for = [ o for o in range(int_order, int(order_to) + 1) ]
-                else:
-                    archive_for = None
-
-                with open(f, 'r') as fopen:
-                    message = Message(
-                        thread_uid=thread_uid, order=int_order, role=Role(role), text=fopen.read(),
-                        archive_for=archive_for
-                    )
-                    if role == Role.archive:
-                        assert message.archive_for
-                        for index in message.archive_for:
-                            node = result.get(index, MessageNode())
-                            node.archive = message
-                            result[index] = node
-                    else:
-                        node = result.get(int_order, MessageNode())
-                        node.message = message
-                        result[int_order] = node
-        return result
-
-    def __init__(self, storage_path: Path) -> None:
-        self._storage_path = storage_path
-        self._filesystem_cache: dict[int, MessageNode] = self._build_fiesystem_cache('')
-        return super().__init__()
-
-    async def _get_message_from_file(self, thread_uid: str | int, filepath: Path) -> Message:
-        order, *args, role = filepath.name.split('.')[0].split('_')
+    @staticmethod
+    def _parse_message_filename(filename: str) -> tuple[int, Role, list[int] | None]:
+        order, *args, role_raw = filename.split('.')[0].split('_')
         int_order = int(order)
+        role = Role(role_raw)
 
         if role == Role.archive:
             order_to, *_ = args
@@ -67,24 +67,455 @@ class FileMessageBroker(MessageBroker):
         else:
             archive_for = None
 
-        async with aiofiles.open(filepath, 'r') as fopen:
-            return Message(
-                thread_uid=thread_uid, order=int_order, role=Role(role), text=await fopen.read(),
-                archive_for=archive_for
+        return int_order, role, archive_for
+
+    @staticmethod
+    def _get_filename_compression(filename: str) -> Compression | None:
+        _, *suffixes = filename.split('.')
+        return COMPRESSIONS_BY_SUFFIX.get(suffixes[-1]) if len(suffixes) > 1 else None
+
+    @staticmethod
+    def _is_message_filename(filename: str) -> bool:
+        """Tell message files from stray files next to them, e.g. ``000012_user.txt.orig`` left by an editor."""
+        _, *suffixes = filename.split('.')
+        return filename[:6].isdigit() and suffixes[:1] == [ 'txt' ] and (
+            len(suffixes) == 1 or len(suffixes) == 2 and suffixes[1] in COMPRESSIONS_BY_SUFFIX
+        )
+
+    @staticmethod
+    def _make_message_meta(
+        order: int, role: Role, text: str, order_to: int | None = None, compression: Compression | None = None
+    ) -> MessageMeta:
+        body = text.encode('utf-8')
+        return MessageMeta(order, role, len(body), content_hash(body), order_to, compression)
+
+    @classmethod
+    def _make_message_meta_for_message(cls, message: Message) -> MessageMeta:
+        return cls._make_message_meta(
+            message.order, message.role, message.text,
+            max(message.archive_for) if message.role == Role.archive and message.archive_for else None
+        )
+
+    @staticmethod
+    def _index_message(cache: ThreadCache, meta: MessageMeta) -> None:
+        if meta.role == Role.archive:
+            assert meta.order_to is not None
+            cache.archives.add(meta.order, meta.order_to, meta)
+        else:
+            if meta.order not in cache.messages:
+                bisect.insort(cache.orders, meta.order)
+            cache.messages[meta.order] = meta
+
+    @staticmethod
+    def _get_indexed_meta(cache: ThreadCache, meta: MessageMeta) -> MessageMeta | None:
+        if meta.role == Role.archive:
+            archive_range = (meta.order, cast(int, meta.order_to))
+            return cache.archives[archive_range] if archive_range in cache.archives else None
+        return cache.messages.get(meta.order)
+
+    @staticmethod
+    def _unindex_message(cache: ThreadCache, order: int, role: Role, archive_for: list[int] | None) -> None:
+        if role == Role.archive:
+            assert archive_for
+            cache.archives.remove(order, max(archive_for))
+        elif cache.messages.pop(order, None) is not None:
+            del cache.orders[bisect.bisect_left(cache.orders, order)]
+
+    def _build_fiesystem_cache(self, thread_uid: str | int) -> ThreadCache:
+        thread_path = self._get_thread_path(thread_uid)
+        if not thread_path.is_dir():
+            raise ThreadIsNotFoundError(thread_uid)
+
+        result = ThreadCache()
+
+        for f in thread_path.iterdir():
+            if f.is_file() and self._is_message_filename(f.name):
+                # bodies are only hashed here, they are read again on demand
+                self._index_message(result, self._read_message_meta(thread_uid, f))
+        return result
+
+    def _load_compression_dictionary(self, thread_uid: str | int, dict_id: int) -> bytes:
+        key = (str(thread_uid), dict_id)
+        if key not in self._compression_dictionaries:
+            self._compression_dictionaries[key] = (
+                self._get_thread_path(thread_uid) / ZSTD_DICTIONARY_FILENAME.format(dict_id)
+            ).read_bytes()
+
+        return self._compression_dictionaries[key]
+
+    def _read_message_file(self, thread_uid: str | int, filepath: Path, compression: Compression | None) -> str:
+        if compression is None:
+            with open(filepath, 'r') as fopen:
+                return fopen.read()
+
+        with open(filepath, 'rb') as fopen:
+            return decompress_body(
+                compression, fopen.read(), lambda dict_id: self._load_compression_dictionary(thread_uid, dict_id)
+            ).decode('utf-8')
+
+    def _read_message_meta(self, thread_uid: str | int, filepath: Path) -> MessageMeta:
+        int_order, role, archive_for = self._parse_message_filename(filepath.name)
+        compression = self._get_filename_compression(filepath.name)
+
+        return self._make_message_meta(
+            int_order, role, self._read_message_file(thread_uid, filepath, compression),
+            max(archive_for) if archive_for else None, compression
+        )
+
+    def _find_message_file(
+        self, thread_uid: str | int, order: int, role: Role, order_to: int | None = None,
+        compression: Compression | None = None
+    ) -> tuple[Path, Compression | None] | None:
+        for candidate in dict.fromkeys((compression, None, *Compression)):
+            filepath = self._get_filepath_for_order_and_role(thread_uid, order, role, order_to, candidate)
+            if filepath.is_file():
+                return filepath, candidate
+
+        return None
+
+    def _read_body(self, thread_uid: str | int, thread_cache: ThreadCache, meta: MessageMeta) -> str:
+        # the body may have been compressed since its metadata was taken, so its other files are tried too
+        for compression in dict.fromkeys((meta.compression, None, *Compression)):
+            filepath = self._get_filepath_for_order_and_role(
+                thread_uid, meta.order, meta.role, meta.order_to, compression
+            )
+            try:
+                return self._read_message_file(thread_uid, filepath, compression)
+            except FileNotFoundError:
+                pass
+
+        raise FileNotFoundError(self._get_filepath_for_order_and_role(
+            thread_uid, meta.order, meta.role, meta.order_to, meta.compression
+        ))
+
+    def _get_thread_compression_dictionary(
+        self, thread_uid: str | int, thread_cache: ThreadCache, samples: list[MessageMeta]
+    ) -> bytes | None:
+        assert self._compression_dictionary_size is not None
+        thread_path = self._get_thread_path(thread_uid)
+        for dictionary_path in thread_path.glob(ZSTD_DICTIONARY_FILENAME.format('*')):
+            return self._load_compression_dictionary(thread_uid, int(dictionary_path.stem.rsplit('_', 1)[1]))
+
+        # trained once per thread, bodies compressed before there were enough samples stay without a dictionary
+        trained = train_dictionary(
+            [ self._read_body(thread_uid, thread_cache, meta).encode('utf-8') for meta in samples ],
+            self._compression_dictionary_size
+        )
+        if trained is None:
+            return None
+
+        dict_id, dictionary = trained
+        write_file_atomically(
+            thread_path / ZSTD_DICTIONARY_FILENAME.format(dict_id), dictionary,
+            self._write_pipeline.durability != Durability.none
+        )
+
+        self._compression_dictionaries[(str(thread_uid), dict_id)] = dictionary
+        return dictionary
+
+    def _compress_message_files(
+        self, thread_uid: str | int, thread_cache: ThreadCache, metas: list[MessageMeta], samples: list[MessageMeta]
+    ) -> list[MessageMeta]:
+        assert self._compression is not None
+        dictionary = self._get_thread_compression_dictionary(thread_uid, thread_cache, samples) \
+            if self._compression == Compression.zstd and self._compression_dictionary_size else None
+
+        compressed: list[MessageMeta] = []
+        for meta in metas:
+            filepath = self._get_filepath_for_order_and_role(thread_uid, meta.order, meta.role, meta.order_to)
+            try:
+                body = self._read_message_file(thread_uid, filepath, None).encode('utf-8')
+            except FileNotFoundError:
+                continue
+
+            # the plain file is removed only once the compressed one is as durable as any other write
+            write_file_atomically(
+                filepath.with_name(f'{filepath.name}.{self._compression.value}'),
+                compress_body(self._compression, body, dictionary), self._write_pipeline.durability != Durability.none
+            )
+            filepath.unlink()
+            compressed.append(meta)
+
+        return compressed
+
+    async def _compress_archived_messages(
+        self, thread_uid: str | int, thread_cache: ThreadCache, archive_for: list[int]
+    ) -> None:
+        """Compress the messages covered by a newly set archive in place, e.g. ``000012_user.txt`` becomes
+           ``000012_user.txt.zstd``. zstd bodies use a dictionary trained over the thread if
+           ``compression_dictionary_size`` is given. Compressed bodies are decompressed transparently on read."""
+        metas = [
+            meta for order in archive_for
+                if (meta := thread_cache.messages.get(order)) is not None and meta.compression is None
+        ]
+        if not metas:
+            return
+
+        samples = [
+            thread_cache.messages[order] for order in thread_cache.orders[-DICTIONARY_MAX_SAMPLES:]
+        ] if self._compression == Compression.zstd and self._compression_dictionary_size else []
+
+        for meta in await asyncio.to_thread(
+            self._compress_message_files, thread_uid, thread_cache, metas, samples
+        ):
+            meta.compression = self._compression
+
+    def _read_bodies(
+        self, thread_uid: str | int, thread_cache: ThreadCache, metas: list[MessageMeta]
+    ) -> list[tuple[str, bool]]:
+        # a body changed after it was indexed is returned but not cached, the watcher brings its new metadata
+        result = []
+        for meta in metas:
+            try:
+                text = self._read_body(thread_uid, thread_cache, meta)
+            except FileNotFoundError:
+                raise MessageIsNotFoundError(thread_uid, meta.order, meta.role == Role.archive)
+            result.append((text, content_hash(text.encode('utf-8')) == meta.content_hash))
+        return result
+
+    async def _load_messages(
+        self, thread_uid: str | int, thread_cache: ThreadCache, metas: Iterable[MessageMeta]
+    ) -> list[Message]:
+        # bodies are read on demand, the index only has their metadata
+        metas = list(metas)
+        texts = [ self._body_cache.get(meta.content_hash) for meta in metas ]
+
+        missing = [ index for index, text in enumerate(texts) if text is None ]
+        if missing:
+            read_bodies = await asyncio.to_thread(
+                self._read_bodies, thread_uid, thread_cache, [ metas[i] for i in missing ]
+            )
+            for index, (text, is_fresh) in zip(missing, read_bodies):
+                texts[index] = text
+                if is_fresh:
+                    self._body_cache.put(metas[index].content_hash, text, metas[index].size)
+
+        return [
+            Message(
+                thread_uid=thread_uid, order=meta.order, role=meta.role, text=cast(str, text),
+                archive_for=[ o for o in range(meta.order, meta.order_to + 1) ] if meta.order_to is not None else None
             )
+            for meta, text in zip(metas, texts)
+        ]
 
-    async def _get_iterator_for_message_pathfiles(self, thread_uid: str | int) -> AsyncIterator[Path]:
-        async for f in AsyncPath(self._storage_path).iterdir():
-            if await f.is_file() and f.name[:6].isdigit():
-                yield Path(f)
+    def _store_body(self, message: Message) -> MessageMeta:
+        meta = self._make_message_meta_for_message(message)
+        self._body_cache.put(meta.content_hash, message.text, meta.size)
+        return meta
+
+    def __init__(
+        self, storage_path: Path, max_cached_threads: int | None = 16,
+        max_cached_bytes: int | None = 16 * 1024 * 1024,
+        token_counter: TokenCounter | None = None, prompt_assets_recheck_interval: float = 1.0,
+        watch: bool = False, watch_poll_interval: float = 1.0,
+        stream_batch_size: int = 64, stream_prefetch_batches: int = 2,
+        compression: Compression | None = None, compression_dictionary_size: int | None = None,
+        durability: Durability = Durability.batch, max_pending_writes: int = 256
+    ) -> None:
+        if compression is not None:
+            check_compression_available(compression)
+
+        self._storage_path = storage_path
+        self._compression = compression
+        self._compression_dictionary_size = compression_dictionary_size
+        self._compression_dictionaries: dict[tuple[str, int], bytes] = {}
+        self._write_pipeline = WritePipeline(durability, max_pending_writes)
+        # changes of a thread are serialized by its lock
+        self._thread_locks: dict[str, asyncio.Lock] = {}
+        # versions are kept in memory and start from the creation time in milliseconds, so a version from before
+        # a restart never matches again
+        self._thread_versions: dict[str, int] = {}
+        self._initial_thread_version = time.time_ns() // 1_000_000
+        self._stream_batch_size = stream_batch_size
+        self._stream_prefetch_batches = stream_prefetch_batches
+        self._prompt_asset_cache = PromptAssetCache(token_counter, prompt_assets_recheck_interval)
+        self._max_cached_threads = max_cached_threads
+        self._body_cache = BodyCache(max_cached_bytes)
+        self._threads_cache: OrderedDict[str, ThreadCache] = OrderedDict()
+        self._threads_loading: dict[str, asyncio.Task[ThreadCache]] = {}
+        self._watcher = make_file_system_watcher(self._on_file_event, watch_poll_interval) if watch else None
+        self._file_events: asyncio.Queue[tuple[Path, FileEvent]] = asyncio.Queue()
+        self._file_events_task: asyncio.Task[None] | None = None
+        return super().__init__()
+
+    def get_body_cache_stats(self) -> BodyCacheStats:
+        """Return the counters of the cache of message bodies bounded by ``max_cached_bytes``."""
+        return self._body_cache.stats
+
+    def _get_thread_path(self, thread_uid: str | int) -> Path:
+        # a thread is a directory right in storage_path, anything but a plain name could point outside of it
+        key = str(thread_uid)
+        if key in ('', '.', '..') or any(separator in key for separator in ('/', '\\', '\0')):
+            raise ThreadIsNotFoundError(thread_uid)
+        return self._storage_path / key
+
+    async def _get_asset_message(self, thread_uid: str | int, filename: str) -> Message:
+        # the thread directory is looked in first, so a thread can override a shared instruction
+        return await self._prompt_asset_cache.get_message(
+            thread_uid, (self._get_thread_path(thread_uid) / filename, self._storage_path / filename)
+        )
+
+    def _evict_threads_cache(self) -> None:
+        # the most recently used thread is never evicted, even if it alone exceeds the budget
+        while (
+            len(self._threads_cache) > 1 and
+            self._max_cached_threads is not None and len(self._threads_cache) > self._max_cached_threads
+        ):
+            evicted_key, _ = self._threads_cache.popitem(last=False)
+            if self._watcher is not None:
+                self._watcher.unwatch(self._get_thread_path(evicted_key))
+
+    async def _get_thread_cache(self, thread_uid: str | int, create: bool = False) -> ThreadCache:
+        """Return the metadata index of the thread, loaded on first access. The least recently used indexes are
+           evicted once there are more than ``max_cached_threads``."""
+        key = str(thread_uid)
+
+        if key in self._threads_cache:
+            self._threads_cache.move_to_end(key)
+            return self._threads_cache[key]
+
+        if create:
+            await AsyncPath(self._get_thread_path(thread_uid)).mkdir(parents=True, exist_ok=True)
+
+        # concurrent first accesses share a single load instead of racing each other
+        if key not in self._threads_loading:
+            self._threads_loading[key] = asyncio.create_task(
+                asyncio.to_thread(self._build_fiesystem_cache, thread_uid)
+            )
+        try:
+            cache = await asyncio.shield(self._threads_loading[key])
+        finally:
+            if key in self._threads_loading and self._threads_loading[key].done():
+                del self._threads_loading[key]
+
+        if key not in self._threads_cache:
+            self._threads_cache[key] = cache
+            if self._watcher is not None:
+                self._watcher.watch(self._get_thread_path(thread_uid))
+            self._evict_threads_cache()
+
+        return self._threads_cache.get(key, cache)
+
+    async def resync(self, thread_uid: str | int) -> None:
+        """Drop the in-memory index of the thread and rebuild it from its directory in a worker thread."""
+        # an append in between would be indexed into the dropped index and lost
+        async with self._get_thread_lock(thread_uid):
+            self._threads_cache.pop(str(thread_uid), None)
+            await self._get_thread_cache(thread_uid)
+            self._bump_thread_version(thread_uid)
+
+    def _get_thread_lock(self, thread_uid: str | int) -> asyncio.Lock:
+        return self._thread_locks.setdefault(str(thread_uid), asyncio.Lock())
+
+    def _bump_thread_version(self, thread_uid: str | int) -> None:
+        key = str(thread_uid)
+        self._thread_versions[key] = self._thread_versions.get(key, self._initial_thread_version) + 1
+
+    async def close(self) -> None:
+        """Stop watching the storage directory and wait for the queued writes."""
+        await self.stop_watching()
+        await self._write_pipeline.close()
+
+    async def start_watching(self) -> None:
+        """Start applying changes made to the storage directory by other programs (e.g. messages edited by hand) to
+           the loaded indexes and prompt assets, if the broker has a watcher. It uses inotify or polls every
+           ``watch_poll_interval`` seconds where inotify isn't available."""
+        if self._watcher is None or self._file_events_task is not None:
+            return
+
+        await AsyncPath(self._storage_path).mkdir(parents=True, exist_ok=True)
+        self._watcher.watch(self._storage_path)
+        for key in self._threads_cache:
+            self._watcher.watch(self._get_thread_path(key))
+
+        await self._watcher.start()
+        self._file_events_task = asyncio.create_task(self._handle_file_events())
+
+    async def stop_watching(self) -> None:
+        if self._watcher is None or self._file_events_task is None:
+            return
+
+        await self._watcher.stop()
+        self._file_events_task.cancel()
+        self._file_events_task = None
+
+    def _on_file_event(self, path: Path, event: FileEvent) -> None:
+        self._file_events.put_nowait((path, event))
+
+    async def _handle_file_events(self) -> None:
+        # events are applied one by one, so a late read of a file never overwrites a newer one
+        while True:
+            path, event = await self._file_events.get()
+            try:
+                await self._apply_file_event(path, event)
+            except (OSError, ValueError, MessageBrokerError):
+                # the file vanished or is being written, the following event brings the final state
+                pass
+
+    async def _apply_file_event(self, path: Path, event: FileEvent) -> None:
+        if event == FileEvent.overflow:
+            if path == self._storage_path:
+                self._prompt_asset_cache.invalidate()
+            elif path.name in self._threads_cache:
+                await self.resync(path.name)
+            return
+
+        self._prompt_asset_cache.invalidate(path)
+
+        if path.parent.parent != self._storage_path or not self._is_message_filename(path.name):
+            return
+        # an append holds the lock until its file is indexed, so the event of the broker's own write comes after it
+        async with self._get_thread_lock(path.parent.name):
+            await self._apply_message_file_event(path, event)
+
+    async def _apply_message_file_event(self, path: Path, event: FileEvent) -> None:
+        thread_cache = self._threads_cache.get(path.parent.name)
+        if thread_cache is None:
+            return
+
+        order, role, archive_for = self._parse_message_filename(path.name)
+        if event == FileEvent.deleted:
+            # a compressed file replaces the plain one, the message is gone only if none of its files is left
+            found = await asyncio.to_thread(
+                self._find_message_file, path.parent.name, order, role, max(archive_for) if archive_for else None
+            )
+            if found is None:
+                self._unindex_message(thread_cache, order, role, archive_for)
+                self._bump_thread_version(path.parent.name)
+                return
+            path, _ = found
+
+        meta = await asyncio.to_thread(self._read_message_meta, path.parent.name, path)
+        indexed = self._get_indexed_meta(thread_cache, meta)
+        if indexed is not None and (indexed.role, indexed.size, indexed.content_hash) == (
+            meta.role, meta.size, meta.content_hash
+        ):
+            # the broker's own writes and compressions come back as events too, they don't change the thread
+            indexed.compression = meta.compression
+            return
+
+        self._index_message(thread_cache, meta)
+        self._bump_thread_version(path.parent.name)
+
+    async def _get_message_from_file(self, thread_uid: str | int, filepath: Path) -> Message:
+        int_order, role, archive_for = self._parse_message_filename(filepath.name)
+
+        return Message(
+            thread_uid=thread_uid, order=int_order, role=role, archive_for=archive_for,
+            text=await asyncio.to_thread(
+                self._read_message_file, thread_uid, filepath, self._get_filename_compression(filepath.name)
+            )
+        )
 
     def _get_filepath_for_order_and_role(
-        self, thread_uid: str | int, order: int, role: Role, order_to: int | None = None
+        self, thread_uid: str | int, order: int, role: Role, order_to: int | None = None,
+        compression: Compression | None = None
     ) -> Path:
+        suffix = f'.{compression.value}' if compression is not None else ''
         if role != role.archive:
-            return Path(self._storage_path / f'{order:06d}_{role.value}.txt')
+            return Path(self._get_thread_path(thread_uid) / f'{order:06d}_{role.value}.txt{suffix}')
         else:
-            return Path(self._storage_path / f'{order:06d}_{order_to:06d}_{role.value}.txt')
+            return Path(self._get_thread_path(thread_uid) / f'{order:06d}_{order_to:06d}_{role.value}.txt{suffix}')
 
     def _get_filepath_for_message(self, message: Message) -> Path:
         # if message.role == Role.archive and message.archive_for is None:
@@ -95,21 +526,63 @@ class FileMessageBroker(MessageBroker):
             max(message.archive_for) if message.archive_for else None
         )
 
+    async def _message_exists(self, message: Message) -> bool:
+        return await asyncio.to_thread(
+            self._find_message_file, message.thread_uid, message.order, message.role,
+            max(message.archive_for) if message.archive_for else None
+        ) is not None
+
     async def _force_store_message(self, message: Message):
-        async with aiofiles.open(self._get_filepath_for_message(message), 'w') as fopen:
-            await fopen.write(message.text)
+        await self._write_pipeline.write(self._get_filepath_for_message(message), message.text.encode('utf-8'))
+
+    @staticmethod
+    def _merge_messages_and_archives(
+        cache: ThreadCache, orders: list[int], archive_ranges: list[tuple[int, int]]
+    ) -> list[MessageMeta]:
+        # the same order as sorted message filenames give: by order, an archive before the message it starts with
+        archives = ((archive_range, cache.archives[archive_range]) for archive_range in archive_ranges)
+        messages = (((order, -1), cache.messages[order]) for order in orders)
+
+        return [ meta for _, meta in heapq.merge(
+            archives, messages, key=lambda item: (item[0][0], item[0][1] < 0, item[0][1])
+        ) ]
 
     async def get_messages_by_thread_uid(self, thread_uid: str | int) -> list[Message]:
-        files = sorted(f for f in [ f async for f in self._get_iterator_for_message_pathfiles(thread_uid) ])
-        return await asyncio.gather(*[ self._get_message_from_file(thread_uid, filepath) for filepath in files ])
+        thread_cache = await self._get_thread_cache(thread_uid)
+        return await self._load_messages(thread_uid, thread_cache, self._merge_messages_and_archives(
+            thread_cache, thread_cache.orders, list(thread_cache.archives)
+        ))
+
+    async def iter_messages_by_thread_uid(self, thread_uid: str | int) -> AsyncGenerator[Message, None]:
+        """Yield messages read in batches of ``stream_batch_size``, with at most ``stream_prefetch_batches`` batches
+           read ahead of the consumer."""
+        thread_cache = await self._get_thread_cache(thread_uid)
+        metas = self._merge_messages_and_archives(thread_cache, thread_cache.orders, list(thread_cache.archives))
+
+        # every batch is read file by file in one worker thread, so the number of open files stays bounded
+        reading: deque[asyncio.Task[list[Message]]] = deque()
+        try:
+            for start in range(0, len(metas), self._stream_batch_size):
+                reading.append(asyncio.create_task(self._load_messages(
+                    thread_uid, thread_cache, metas[start:start + self._stream_batch_size]
+                )))
+                if len(reading) >= self._stream_prefetch_batches:
+                    for message in await reading.popleft():
+                        yield message
+
+            while reading:
+                for message in await reading.popleft():
+                    yield message
+        finally:
+            for task in reading:
+                task.cancel()
 
     async def get_message_by_thread_uid_and_order(self, thread_uid: str | int, order: int) -> Message:
-        if (order not in self._filesystem_cache):
-            raise MessageIsNotFoundError(thread_uid, order, True)
+        thread_cache = await self._get_thread_cache(thread_uid)
+        if (meta := thread_cache.messages.get(order)) is None:
+            raise MessageIsNotFoundError(thread_uid, order)
 
-        msg = self._filesystem_cache[order].message
-        assert msg is not None
-        return msg
+        return (await self._load_messages(thread_uid, thread_cache, [ meta ]))[0]
 
         # for role in Role:
         #     if role == Role.archive:
@@ -125,13 +598,12 @@ class FileMessageBroker(MessageBroker):
         # raise MessageIsNotFoundError(thread_uid, order)
 
     async def get_archive_by_thread_uid_and_order(self, thread_uid: str | int, order: int) -> Message:
-
-        if (order not in self._filesystem_cache) or (self._filesystem_cache[order].archive is None):
+        thread_cache = await self._get_thread_cache(thread_uid)
+        # the outermost archive covering the order wins
+        if (archive_range := thread_cache.archives.covering(order)) is None:
             raise MessageIsNotFoundError(thread_uid, order, True)
 
-        msg = self._filesystem_cache[order].archive
-        assert msg is not None
-        return msg
+        return (await self._load_messages(thread_uid, thread_cache, [ thread_cache.archives[archive_range] ]))[0]
 
         # async for f in self._get_iterator_for_message_pathfiles(thread_uid):
         #     if f.name.startswith(f'{order:06d}') and f.name[:6].isdigit() and f.name[7:13].isdigit():
@@ -141,43 +613,45 @@ class FileMessageBroker(MessageBroker):
         # raise MessageIsNotFoundError(thread_uid, order, True)
 
     async def get_thread_archiving_instruction(self, thread_uid: str | int) -> Message:
-        async with aiofiles.open(self._storage_path / 'archiving_instruction.txt', 'r') as fopen:
-            return Message(thread_uid=thread_uid, order=0, role=Role.system, text=await fopen.read())
+        return await self._get_asset_message(thread_uid, 'archiving_instruction.txt')
 
     async def get_origin_thread(
         self, thread_uid: str | int, order_from: int = 0, order_to: int | None = None
     ) -> list[Message]:
-        return [
-            msg for msg in await self.get_messages_by_thread_uid(thread_uid)
-                if msg.role != Role.archive and msg.order >= order_from and
-                (order_to is None or msg.order <= order_to)
+        thread_cache = await self._get_thread_cache(thread_uid)
+        orders = thread_cache.orders[
+            bisect.bisect_left(thread_cache.orders, order_from):
+            len(thread_cache.orders) if order_to is None else bisect.bisect_right(thread_cache.orders, order_to)
         ]
+        return await self._load_messages(
+            thread_uid, thread_cache, (thread_cache.messages[order] for order in orders)
+        )
 
     async def get_thread_analysis_instruction(self, thread_uid: str | int) -> Message:
-        async with aiofiles.open(self._storage_path / 'analysis_instruction.txt', 'r') as fopen:
-            return Message(thread_uid=thread_uid, order=0, role=Role.system, text=await fopen.read())
+        return await self._get_asset_message(thread_uid, 'analysis_instruction.txt')
 
     async def get_thread_hidden_context_creation_instruction(self, thread_uid: str | int) -> Message:
-        async with aiofiles.open(self._storage_path / 'hidden_context_creation_instruction.txt', 'r') as fopen:
-            return Message(thread_uid=thread_uid, order=0, role=Role.system, text=await fopen.read())
+        return await self._get_asset_message(thread_uid, 'hidden_context_creation_instruction.txt')
 
     async def get_thread_hidden_context_consistency_check_instruciton(self, thread_uid: str | int) -> Message:
-        async with aiofiles.open(
-            self._storage_path / 'hidden_context_consistency_check_instruction.txt', 'r'
-        ) as fopen:
-            return Message(thread_uid=thread_uid, order=0, role=Role.system, text=await fopen.read())
+        return await self._get_asset_message(thread_uid, 'hidden_context_consistency_check_instruction.txt')
 
     async def store_hidden_context_message(self, hidden_context_message: Message) -> None:
-        async with aiofiles.open(self._storage_path / 'hidden_context.txt', 'w') as fopen:
-            await fopen.write(hidden_context_message.text)
+        thread_path = self._get_thread_path(hidden_context_message.thread_uid)
+        await AsyncPath(thread_path).mkdir(parents=True, exist_ok=True)
+        await self._write_pipeline.write(
+            thread_path / 'hidden_context.txt', hidden_context_message.text.encode('utf-8')
+        )
+
+        self._prompt_asset_cache.invalidate(thread_path / 'hidden_context.txt')
 
     async def get_hidden_context_message(self, thread_uid: str | int) -> Message:
-        async with aiofiles.open(self._storage_path / 'hidden_context.txt', 'r') as fopen:
-            return Message(thread_uid=thread_uid, order=0, role=Role.hidden, text=await fopen.read())
+        return await self._prompt_asset_cache.get_message(
+            thread_uid, (self._get_thread_path(thread_uid) / 'hidden_context.txt', ), Role.hidden
+        )
 
     async def get_conversation_instruction(self, thread_uid: str | int) -> Message:
-        async with aiofiles.open(self._storage_path / 'conversation_instruction.txt', 'r') as fopen:
-            return Message(thread_uid=thread_uid, order=0, role=Role.system, text=await fopen.read())
+        return await self._get_asset_message(thread_uid, 'conversation_instruction.txt')
 
     # async def compile_background(self, thread_uid: str | int, to_order: int) -> list[Message]:
     #     files = sorted(f for f in self._storage_path.iterdir() if f.is_file()
@@ -185,87 +659,96 @@ class FileMessageBroker(MessageBroker):
 
     #     return await asyncio.gather(*[ self._get_message_from_file(thread_uid, filepath) for filepath in files ])
 
-    async def get_messages_by_orders_list(self, thread_uid: str | int, messages_orders: list[int]) -> list[Message]:
-        files = sorted(f for f in self._storage_path.iterdir() if f.is_file()
-                            and f.name[:6].isdigit() and int(f.name[:6]) in messages_orders)
+    async def get_messages_by_orders_list(
+        self, thread_uid: str | int, messages_orders: MessagesOrders
+    ) -> list[Message]:
+        thread_cache = await self._get_thread_cache(thread_uid)
+        points, bounds = split_messages_orders(messages_orders)
 
-        return await asyncio.gather(*[ self._get_message_from_file(thread_uid, filepath) for filepath in files ])
+        orders = { order for order in points if order in thread_cache.messages }
+        for first, last in bounds:
+            orders.update(thread_cache.orders[
+                bisect.bisect_left(thread_cache.orders, first):bisect.bisect_right(thread_cache.orders, last)
+            ])
 
-    async def set_archiving_message(self, archiving_message: Message) -> Message:
+        archive_ranges: set[tuple[int, int]] = set()
+        for first, last in [ (order, order) for order in points ] + bounds:
+            archive_ranges.update(thread_cache.archives.starting_between(first, last))
 
-        msg_by_id_hash: dict[int, Message] = {}
+        return await self._load_messages(thread_uid, thread_cache, self._merge_messages_and_archives(
+            thread_cache, sorted(orders), sorted(archive_ranges)
+        ))
 
+    async def _store_archiving_message(self, archiving_message: Message) -> ThreadCache:
+        # the caller holds the thread lock
         if archiving_message.archive_for is None:
-            raise MessageBrokerError("Trying to make archive message with null in 'archive_for'")
-        
-        # check if message we archive exist
+            raise ArchiveIsMalformedError(archiving_message.thread_uid, archiving_message.order)
+
+        # check if message we archive exist, without reading their bodies
+        thread_cache = await self._get_thread_cache(archiving_message.thread_uid)
         for msg_id in archiving_message.archive_for:
-            # if not, MessageIsNotFoundError is raised here
-            msg_by_id_hash[msg_id] = await self.get_message_by_thread_uid_and_order(
-                archiving_message.thread_uid, msg_id
-            )
+            if msg_id not in thread_cache.messages:
+                raise MessageIsNotFoundError(archiving_message.thread_uid, msg_id)
 
         await self._force_store_message(archiving_message)
+        self._index_message(thread_cache, self._store_body(archiving_message))
+        self._bump_thread_version(archiving_message.thread_uid)
+        return thread_cache
 
-        self._filesystem_cache = self._build_fiesystem_cache(archiving_message.thread_uid)
-
-        return archiving_message
+    async def set_archiving_message(self, archiving_message: Message) -> Message:
+        return (await self.set_archiving_messages([ archiving_message ]))[0]
+
+    async def set_archiving_messages(self, archiving_messages: list[Message]) -> list[Message]:
+        async with AsyncExitStack() as locks:
+            # locks are taken in one order, so concurrent calls for several threads never deadlock
+            for key in sorted({ str(archiving_message.thread_uid) for archiving_message in archiving_messages }):
+                await locks.enter_async_context(self._get_thread_lock(key))
+
+            # archives are stored concurrently, so they're committed by the write pipeline as one group
+            thread_caches = await asyncio.gather(*[
+                self._store_archiving_message(archiving_message) for archiving_message in archiving_messages
+            ])
+
+        if self._compression is not None:
+            for archiving_message, thread_cache in zip(archiving_messages, thread_caches):
+                await self._compress_archived_messages(
+                    archiving_message.thread_uid, thread_cache, cast(list[int], archiving_message.archive_for)
+                )
+
+        return archiving_messages
+
+    async def compile_few_shot_threads(self, thread_uid: str | int) -> FewShotsBundle:
+        return await self._prompt_asset_cache.get_few_shots_bundle(
+            thread_uid, (self._get_thread_path(thread_uid), self._storage_path)
+        )
 
-    async def compile_few_shot_thread_by_index(
-        self, thread_uid: str | int, few_shots_index: int
-    ) -> SceneArchivingThread:
-        background: list[Message] = []
+    async def _append_message(self, message: Message) -> Message:
+        # the caller holds the thread lock, so nothing is stored between the existence check and the write
+        thread_cache = await self._get_thread_cache(message.thread_uid, create=True)
 
-        try:
-            for i in itertools.count(1):
-                async with aiofiles.open(
-                    self._storage_path / f'few_shots_background_{few_shots_index}_{i}.txt', 'r'
-                ) as fopen:
-                    background.append(Message(
-                        thread_uid=thread_uid, order=0, role=Role.assistant, text=await fopen.read()
-                    ))
-        except FileNotFoundError:
-            pass
-
-        current_scene: list[Message] = []
-        try:
-            for i in itertools.count(1):
-                async with aiofiles.open(
-                    self._storage_path / f'few_shots_request_{few_shots_index}_{i}.txt', 'r'
-                ) as fopen:
-                    current_scene.append(Message(
-                        thread_uid=thread_uid, order=0, role=Role.user, text=await fopen.read()
-                    ))
-
-                async with aiofiles.open(
-                    self._storage_path / f'few_shots_response_{few_shots_index}_{i}.txt', 'r'
-                ) as fopen:
-                    current_scene.append(Message(
-                        thread_uid=thread_uid, order=0, role=Role.assistant, text=await fopen.read()
-                    ))
-        except FileNotFoundError:
-            pass
-
-        async with aiofiles.open(
-            self._storage_path / f'few_shots_archive_{few_shots_index}.txt', 'r'
-        ) as fopen:
-            return SceneArchivingThread(
-                background=background,
-                messages=current_scene,
-                archive=Message(thread_uid=thread_uid, order=0, role=Role.archive, text=await fopen.read())
-            )
+        if await self._message_exists(message):
+            raise MessageAlreadyExistsError(message.thread_uid, message.order)
 
-    async def compile_few_shot_threads(self, thread_uid: str | int) -> list[SceneArchivingThread]:
-        return [
-            await self.compile_few_shot_thread_by_index(thread_uid, i) for i in range(1, 2)
-            # TODO: check how much shots do i actually have
-        ]
+        await self._force_store_message(message)
+        self._index_message(thread_cache, self._store_body(message))
+        self._bump_thread_version(message.thread_uid)
+        return message
 
     async def add_message(self, message: Message) -> Message:
+        async with self._get_thread_lock(message.thread_uid):
+            return await self._append_message(message)
 
-        if await AsyncPath(self._get_filepath_for_message(message)).exists():
-            raise MessageBrokerError(f'Message with order {message.order} already exists')
+    def _get_thread_version(self, thread_uid: str | int) -> int:
+        return self._thread_versions.get(str(thread_uid), self._initial_thread_version)
 
-        await self._force_store_message(message)
-        self._filesystem_cache = self._build_fiesystem_cache(message.thread_uid)
-        return message
+    async def get_thread_version(self, thread_uid: str | int) -> int:
+        # loading the thread index raises ThreadIsNotFoundError for an unknown thread
+        await self._get_thread_cache(thread_uid)
+        return self._get_thread_version(thread_uid)
+
+    async def compare_and_append_message(self, message: Message, expected_version: int) -> Message:
+        async with self._get_thread_lock(message.thread_uid):
+            if (version := self._get_thread_version(message.thread_uid)) != expected_version:
+                raise ThreadVersionConflictError(message.thread_uid, expected_version, version)
+
+            return await self._append_message(message)
@@ -1,6 +1,28 @@
 from abc import ABC, abstractmethod
+from typing import AsyncGenerator, Iterable
 
-from ..pydantic_models import Message, SceneArchivingThread
+from ..pydantic_models import FewShotsBundle, Message
+
+
+# a list or a set of orders, a contiguous range of them or a mix of both
+MessagesOrders = Iterable[int | range] | range
+
+
+def split_messages_orders(messages_orders: MessagesOrders) -> tuple[set[int], list[tuple[int, int]]]:
+    """Split orders selection into single orders and inclusive ``(first, last)`` bounds of contiguous ranges."""
+    points: set[int] = set()
+    bounds: list[tuple[int, int]] = []
+
+    for item in ([ messages_orders ] if isinstance(messages_orders, range) else messages_orders):
+        if not isinstance(item, range):
+            points.add(item)
+        elif item.step == 1:
+            if item:
+                bounds.append((item.start, item.stop - 1))
+        else:
+            points.update(item)
+
+    return points, bounds
 
 
 class MessageBroker(ABC):
@@ -10,6 +32,12 @@ class MessageBroker(ABC):
         """Return all messages in the thread."""
         pass
 
+    async def iter_messages_by_thread_uid(self, thread_uid: str | int) -> AsyncGenerator[Message, None]:
+        """Yield all messages in the thread in the same order as ``get_messages_by_thread_uid`` returns them.
+           Brokers override it to read bodies in batches instead of loading the whole thread first."""
+        for message in await self.get_messages_by_thread_uid(thread_uid):
+            yield message
+
     @abstractmethod
     async def get_message_by_thread_uid_and_order(
         self, thread_uid: str | int, message_order: int
@@ -43,17 +71,24 @@ class MessageBroker(ABC):
     #     pass
 
     @abstractmethod
-    async def compile_few_shot_threads(self, thread_uid: str | int) -> list[SceneArchivingThread]:
+    async def compile_few_shot_threads(self, thread_uid: str | int) -> FewShotsBundle:
         pass
 
     @abstractmethod
-    async def get_messages_by_orders_list(self, thread_uid: str | int, messages_orders: list[int]) -> list[Message]:
+    async def get_messages_by_orders_list(
+        self, thread_uid: str | int, messages_orders: MessagesOrders
+    ) -> list[Message]:
+        """Return messages and archives starting with the given orders, sorted by order."""
         pass
 
     @abstractmethod
     async def set_archiving_message(self, archiving_message: Message) -> Message:
         pass
 
+    async def set_archiving_messages(self, archiving_messages: list[Message]) -> list[Message]:
+        """Store several archives at once. Brokers able to write them in a single transaction override this."""
+        return [ await self.set_archiving_message(msg) for msg in archiving_messages ]
+
     @abstractmethod
     async def store_hidden_context_message(self, hidden_context_message: Message) -> None:
         pass
@@ -70,6 +105,18 @@ class MessageBroker(ABC):
     async def add_message(self, message: Message) -> Message:
         pass
 
+    @abstractmethod
+    async def get_thread_version(self, thread_uid: str | int) -> int:
+        """Return the version of the thread, which every change of its messages or archives increases. Raise
+           ``ThreadIsNotFoundError`` for an unknown thread."""
+        pass
+
+    @abstractmethod
+    async def compare_and_append_message(self, message: Message, expected_version: int) -> Message:
+        """Add the message only if its thread is still at ``expected_version``, otherwise raise
+           ``ThreadVersionConflictError``."""
+        pass
+
     @abstractmethod
     async def get_conversation_instruction(self, thread_uid: str | int) -> Message:
         pass
@@ -0,0 +1,189 @@
+import asyncio
+import itertools
+import re
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+from ..pydantic_models import FewShotsBundle, Message, Role, SceneArchivingThread
+
+
+TokenCounter = Callable[[Message], int]
+
+FEW_SHOTS_FILENAME = re.compile(r'few_shots_(background|request|response|archive)_(\d+)(?:_(\d+))?\.txt')
+
+
+@dataclass
+class PromptAsset:
+    path: Path
+    text: str
+    mtime_ns: int
+    size: int
+    tokens_number: int | None
+    checked_at: float
+
+
+@dataclass
+class FewShotsEntry:
+    signature: tuple[tuple[Path, int, int], ...]
+    bundle: FewShotsBundle
+    checked_at: float
+
+
+class PromptAssetCache:
+    """Keeps instruction-like files and few-shots in memory together with their token numbers.
+
+       An asset is looked up by a tuple of candidate paths, the first existing one wins. Entries are revalidated by
+       stat at most once per ``recheck_interval`` seconds and reloaded when the resolved path, its mtime or its size
+       changes. Few-shots files are discovered in a tuple of directories, where files of earlier directories
+       override files with the same name in later ones."""
+
+    def __init__(self, token_counter: TokenCounter | None = None, recheck_interval: float = 1.0) -> None:
+        self._token_counter = token_counter
+        self._recheck_interval = recheck_interval
+        self._assets: dict[tuple[Path, ...], PromptAsset] = {}
+        self._few_shots: dict[tuple[str, tuple[Path, ...]], FewShotsEntry] = {}
+        return super().__init__()
+
+    @staticmethod
+    def _resolve(candidates: tuple[Path, ...]) -> tuple[Path, int, int]:
+        for path in candidates:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+
+            return path, stat.st_mtime_ns, stat.st_size
+
+        raise FileNotFoundError(f"There's no {candidates[-1].name} file")
+
+    def _load(self, candidates: tuple[Path, ...], role: Role) -> PromptAsset:
+        path, mtime_ns, size = self._resolve(candidates)
+        text = path.read_text()
+
+        return PromptAsset(
+            path=path, text=text, mtime_ns=mtime_ns, size=size, checked_at=time.monotonic(),
+            tokens_number=self._token_counter(Message(thread_uid='', order=0, role=role, text=text))
+                if self._token_counter else None
+        )
+
+    async def get_message(
+        self, thread_uid: str | int, candidates: tuple[Path, ...], role: Role = Role.system
+    ) -> Message:
+        asset = self._assets.get(candidates)
+
+        if asset is not None and time.monotonic() - asset.checked_at >= self._recheck_interval:
+            try:
+                path, mtime_ns, size = await asyncio.to_thread(self._resolve, candidates)
+            except FileNotFoundError:
+                del self._assets[candidates]
+                raise
+
+            if (path, mtime_ns, size) == (asset.path, asset.mtime_ns, asset.size):
+                asset.checked_at = time.monotonic()
+            else:
+                asset = None
+
+        if asset is None:
+            asset = self._assets[candidates] = await asyncio.to_thread(self._load, candidates, role)
+
+        message = Message(thread_uid=thread_uid, order=0, role=role, text=asset.text)
+        message.tokens_number = asset.tokens_number
+        return message
+
+    def invalidate(self, path: Path | None = None) -> None:
+        """Forget every asset looked up at the path and few-shots discovered next to it, or everything without
+           a path."""
+        for candidates in list(self._assets):
+            if path is None or path in candidates:
+                del self._assets[candidates]
+
+        for key in list(self._few_shots):
+            if path is None or (path.name.startswith('few_shots_') and path.parent in key[1]):
+                del self._few_shots[key]
+
+    @staticmethod
+    def _scan_few_shots(directories: tuple[Path, ...]) -> tuple[tuple[Path, int, int], ...]:
+        files: dict[str, tuple[Path, int, int]] = {}
+
+        for directory in reversed(directories):
+            for path in directory.glob('few_shots_*.txt'):
+                if FEW_SHOTS_FILENAME.fullmatch(path.name):
+                    stat = path.stat()
+                    files[path.name] = (path, stat.st_mtime_ns, stat.st_size)
+
+        return tuple(sorted(files.values()))
+
+    @staticmethod
+    def _read_few_shots_thread(
+        thread_uid: str | int, few_shots_index: int, paths: dict[tuple[str, int, int], Path]
+    ) -> SceneArchivingThread:
+        def read_parts(kind: str, role: Role) -> list[Message]:
+            # parts are numbered from 1, the first gap ends the sequence
+            return [
+                Message(thread_uid=thread_uid, order=0, role=role, text=paths[(kind, few_shots_index, i)].read_text())
+                for i in itertools.takewhile(lambda i: (kind, few_shots_index, i) in paths, itertools.count(1))
+            ]
+
+        current_scene: list[Message] = []
+        for request, response in itertools.zip_longest(
+            read_parts('request', Role.user), read_parts('response', Role.assistant)
+        ):
+            if request is None:
+                break
+            current_scene.append(request)
+            if response is None:
+                break
+            current_scene.append(response)
+
+        return SceneArchivingThread(
+            background=read_parts('background', Role.assistant),
+            messages=current_scene,
+            archive=Message(
+                thread_uid=thread_uid, order=0, role=Role.archive,
+                text=paths[('archive', few_shots_index, 0)].read_text()
+            )
+        )
+
+    async def _load_few_shots_bundle(
+        self, thread_uid: str | int, signature: tuple[tuple[Path, int, int], ...]
+    ) -> FewShotsBundle:
+        paths: dict[tuple[str, int, int], Path] = {}
+        for path, _, _ in signature:
+            match = FEW_SHOTS_FILENAME.fullmatch(path.name)
+            assert match
+            kind, few_shots_index, part = match.groups()
+            paths[(kind, int(few_shots_index), int(part or 0))] = path
+
+        few_shots_indexes = sorted(index for kind, index, _ in paths if kind == 'archive')
+        threads = await asyncio.gather(*[
+            asyncio.to_thread(self._read_few_shots_thread, thread_uid, few_shots_index, paths)
+            for few_shots_index in few_shots_indexes
+        ])
+
+        tokens_number = sum(
+            self._token_counter(msg) for thread in threads
+                for msg in thread.background + thread.messages + ([ thread.archive ] if thread.archive else [])
+        ) if self._token_counter else None
+
+        return FewShotsBundle(threads=tuple(threads), tokens_number=tokens_number)
+
+    async def get_few_shots_bundle(self, thread_uid: str | int, directories: tuple[Path, ...]) -> FewShotsBundle:
+        """Return few-shots threads of every ``few_shots_archive_<index>.txt`` file found, sorted by index."""
+        key = (str(thread_uid), directories)
+        entry = self._few_shots.get(key)
+
+        if entry is not None and time.monotonic() - entry.checked_at < self._recheck_interval:
+            return entry.bundle
+
+        signature = await asyncio.to_thread(self._scan_few_shots, directories)
+        if entry is None or entry.signature != signature:
+            entry = self._few_shots[key] = FewShotsEntry(
+                signature=signature, bundle=await self._load_few_shots_bundle(thread_uid, signature),
+                checked_at=time.monotonic()
+            )
+        else:
+            entry.checked_at = time.monotonic()
+
+        return entry.bundle
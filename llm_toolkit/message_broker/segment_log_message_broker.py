@@ -0,0 +1,210 @@
+import asyncio
+import mmap
+import os
+import struct
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import BinaryIO
+
+from ..pydantic_models import Message, Role
+from .exceptions import MessageIsNotFoundError, ThreadIsNotFoundError
+from .body_cache import content_hash
+from .file_message_broker import FileMessageBroker, MessageMeta, ThreadCache
+from .prompt_asset_cache import TokenCounter
+from .write_pipeline import Durability
+
+
+ROLES = list(Role)
+
+# segment number, body offset, body length, order, last archived order (0 for non-archive), role
+INDEX_ENTRY = struct.Struct('<IQIIIB')
+
+
+@dataclass
+class IndexEntry:
+    segment: int
+    offset: int
+    length: int
+    order: int
+    order_to: int
+    role: Role
+
+
+def close_segments(segments: dict[int, mmap.mmap]) -> None:
+    for segment_mmap in segments.values():
+        segment_mmap.close()
+
+
+@dataclass
+class SegmentThreadCache(ThreadCache):
+    entries: dict[tuple[int, int, Role], IndexEntry] = field(default_factory=dict)
+    tail_segment: int = 1
+    tail_size: int = 0
+
+
+class SegmentLogMessageBroker(FileMessageBroker):
+    """Stores every thread as append-only ``segments/NNNNNN.log`` files with message bodies and an ``index.bin``
+       file of fixed-size entries pointing into them, so loading a thread is one read of the index plus memory
+       mapped segments instead of a file open per message. The latest entry for the same message or archive range
+       wins. Unless ``durability`` is ``none``, every appended body and index entry is fsynced before the write
+       completes."""
+
+    def __init__(
+        self, storage_path: Path, max_cached_threads: int | None = 16,
+        max_cached_bytes: int | None = 16 * 1024 * 1024, token_counter: TokenCounter | None = None,
+        prompt_assets_recheck_interval: float = 1.0, watch: bool = False, watch_poll_interval: float = 1.0,
+        stream_batch_size: int = 64, stream_prefetch_batches: int = 2, durability: Durability = Durability.batch,
+        segment_max_bytes: int = 64 * 1024 * 1024
+    ) -> None:
+        self._segment_max_bytes = segment_max_bytes
+        self._append_locks: dict[str, asyncio.Lock] = {}
+        return super().__init__(
+            storage_path, max_cached_threads, max_cached_bytes, token_counter, prompt_assets_recheck_interval,
+            watch, watch_poll_interval, stream_batch_size, stream_prefetch_batches, durability=durability
+        )
+
+    def _get_segment_path(self, thread_uid: str | int, segment: int) -> Path:
+        return self._get_thread_path(thread_uid) / 'segments' / f'{segment:06d}.log'
+
+    def _get_index_path(self, thread_uid: str | int) -> Path:
+        return self._get_thread_path(thread_uid) / 'index.bin'
+
+    def _read_index(self, thread_uid: str | int) -> list[IndexEntry]:
+        try:
+            with open(self._get_index_path(thread_uid), 'rb') as fopen:
+                raw_index = fopen.read()
+        except FileNotFoundError:
+            return []
+
+        # a torn entry at the end of the index is left by an interrupted append and is ignored
+        raw_index = raw_index[:len(raw_index) - len(raw_index) % INDEX_ENTRY.size]
+
+        return [
+            IndexEntry(segment, offset, length, order, order_to, ROLES[role_index])
+            for segment, offset, length, order, order_to, role_index in INDEX_ENTRY.iter_unpack(raw_index)
+        ]
+
+    def _build_fiesystem_cache(self, thread_uid: str | int) -> SegmentThreadCache:
+        if not self._get_thread_path(thread_uid).is_dir():
+            raise ThreadIsNotFoundError(thread_uid)
+
+        result = SegmentThreadCache()
+        for entry in self._read_index(thread_uid):
+            result.entries[(entry.order, entry.order_to, entry.role)] = entry
+            if entry.segment > result.tail_segment:
+                result.tail_segment, result.tail_size = entry.segment, entry.offset + entry.length
+            elif entry.segment == result.tail_segment:
+                result.tail_size = max(result.tail_size, entry.offset + entry.length)
+
+        segments: dict[int, mmap.mmap] = {}
+        try:
+            for segment in sorted({ entry.segment for entry in result.entries.values() if entry.length }):
+                with open(self._get_segment_path(thread_uid, segment), 'rb') as fopen:
+                    segments[segment] = mmap.mmap(fopen.fileno(), 0, access=mmap.ACCESS_READ)
+
+            for entry in sorted(result.entries.values(), key=lambda entry: (entry.order, entry.role != Role.archive)):
+                # bodies are only hashed here, they are read again on demand
+                if entry.length:
+                    with memoryview(segments[entry.segment]) as segment_view:
+                        body_hash = content_hash(segment_view[entry.offset:entry.offset + entry.length])
+                else:
+                    body_hash = content_hash(b'')
+
+                self._index_message(result, MessageMeta(
+                    entry.order, entry.role, entry.length, body_hash,
+                    entry.order_to if entry.role == Role.archive else None
+                ))
+        finally:
+            close_segments(segments)
+
+        return result
+
+    def _slice_body(
+        self, thread_uid: str | int, thread_cache: ThreadCache, meta: MessageMeta, segments: dict[int, mmap.mmap]
+    ) -> bytes:
+        """Return the body sliced from its memory mapped segment, mapping it into ``segments`` if it isn't yet.
+           Segments only grow, so a mapping covers every entry indexed before it was made."""
+        assert isinstance(thread_cache, SegmentThreadCache)
+        entry = thread_cache.entries.get((meta.order, meta.order_to or 0, meta.role))
+        if entry is None:
+            raise FileNotFoundError(self._get_index_path(thread_uid))
+        if not entry.length:
+            return b''
+
+        if entry.segment not in segments:
+            with open(self._get_segment_path(thread_uid, entry.segment), 'rb') as fopen:
+                segments[entry.segment] = mmap.mmap(fopen.fileno(), 0, access=mmap.ACCESS_READ)
+        return segments[entry.segment][entry.offset:entry.offset + entry.length]
+
+    def _read_body(self, thread_uid: str | int, thread_cache: ThreadCache, meta: MessageMeta) -> str:
+        segments: dict[int, mmap.mmap] = {}
+        try:
+            return str(self._slice_body(thread_uid, thread_cache, meta, segments), 'utf-8')
+        finally:
+            close_segments(segments)
+
+    def _read_bodies(
+        self, thread_uid: str | int, thread_cache: ThreadCache, metas: list[MessageMeta]
+    ) -> list[tuple[str, bool]]:
+        # every segment is mapped once for the whole batch
+        segments: dict[int, mmap.mmap] = {}
+        result = []
+        try:
+            for meta in metas:
+                try:
+                    body = self._slice_body(thread_uid, thread_cache, meta, segments)
+                except FileNotFoundError:
+                    raise MessageIsNotFoundError(thread_uid, meta.order, meta.role == Role.archive)
+                result.append((str(body, 'utf-8'), content_hash(body) == meta.content_hash))
+        finally:
+            close_segments(segments)
+
+        return result
+
+    def _sync_file(self, fopen: BinaryIO) -> None:
+        if self._write_pipeline.durability != Durability.none:
+            fopen.flush()
+            os.fsync(fopen.fileno())
+
+    def _append_entry(self, thread_uid: str | int, thread_cache: SegmentThreadCache, message: Message) -> None:
+        body = message.text.encode('utf-8')
+
+        if thread_cache.tail_size and thread_cache.tail_size + len(body) > self._segment_max_bytes:
+            thread_cache.tail_segment += 1
+            thread_cache.tail_size = 0
+
+        segment_path = self._get_segment_path(thread_uid, thread_cache.tail_segment)
+        segment_path.parent.mkdir(exist_ok=True)
+        with open(segment_path, 'ab') as fopen:
+            offset = fopen.tell()
+            fopen.write(body)
+            self._sync_file(fopen)
+
+        entry = IndexEntry(
+            thread_cache.tail_segment, offset, len(body), message.order,
+            max(message.archive_for) if message.role == Role.archive and message.archive_for else 0, message.role
+        )
+        # the index entry is appended only after its body, so the index never points past the segment end
+        with open(self._get_index_path(thread_uid), 'ab') as fopen:
+            # a torn entry left by an interrupted append is cut off, or every entry after it would be misaligned
+            if torn_size := fopen.tell() % INDEX_ENTRY.size:
+                fopen.truncate(fopen.tell() - torn_size)
+            fopen.write(INDEX_ENTRY.pack(
+                entry.segment, entry.offset, entry.length, entry.order, entry.order_to, ROLES.index(entry.role)
+            ))
+            self._sync_file(fopen)
+
+        thread_cache.tail_size = offset + len(body)
+        thread_cache.entries[(entry.order, entry.order_to, entry.role)] = entry
+
+    async def _message_exists(self, message: Message) -> bool:
+        thread_cache = await self._get_thread_cache(message.thread_uid)
+        return message.order in thread_cache.messages
+
+    async def _force_store_message(self, message: Message):
+        thread_cache = await self._get_thread_cache(message.thread_uid, create=True)
+        assert isinstance(thread_cache, SegmentThreadCache)
+
+        lock = self._append_locks.setdefault(str(message.thread_uid), asyncio.Lock())
+        async with lock:
+            await asyncio.to_thread(self._append_entry, message.thread_uid, thread_cache, message)
@@ -0,0 +1,376 @@
+import asyncio
+import itertools
+import json
+from pathlib import Path
+from typing import AsyncGenerator
+
+import aiosqlite
+
+from ..pydantic_models import FewShotsBundle, Message, Role, SceneArchivingThread
+from .message_broker import MessageBroker, MessagesOrders, split_messages_orders
+from .exceptions import (
+    ArchiveIsMalformedError, MessageAlreadyExistsError, MessageIsNotFoundError, ThreadIsNotFoundError,
+    ThreadVersionConflictError
+)
+
+
+# instructions and few-shots stored with an empty thread_uid are shared by all threads
+SHARED_THREAD_UID = ''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS threads (
+    thread_uid TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS messages (
+    thread_uid TEXT NOT NULL,
+    "order" INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (thread_uid, "order")
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS archives (
+    thread_uid TEXT NOT NULL,
+    order_from INTEGER NOT NULL,
+    order_to INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (thread_uid, order_from, order_to)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS archives_coverage ON archives (thread_uid, order_to, order_from);
+
+CREATE TABLE IF NOT EXISTS instructions (
+    thread_uid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (thread_uid, name)
+) WITHOUT ROWID;
+'''
+
+
+class SQLiteMessageBroker(MessageBroker):
+    """Keeps messages, archive coverage ranges and instructions of all threads in one SQLite database.
+
+       Instructions and few-shots use the file broker names without the ``.txt`` suffix, e.g.
+       ``archiving_instruction`` or ``few_shots_request_1_2``, and are looked up for the thread first and for
+       ``SHARED_THREAD_UID`` after. ``iter_messages_by_thread_uid`` fetches rows in batches of ``stream_batch_size``."""
+
+    def __init__(self, database_path: Path, stream_batch_size: int = 64) -> None:
+        self._database_path = database_path
+        self._stream_batch_size = stream_batch_size
+        self._connection: aiosqlite.Connection | None = None
+        self._connection_lock = asyncio.Lock()
+        # all coroutines share one connection, so write transactions must not interleave
+        self._write_lock = asyncio.Lock()
+        return super().__init__()
+
+    async def _get_connection(self) -> aiosqlite.Connection:
+        async with self._connection_lock:
+            if self._connection is None:
+                connection = await aiosqlite.connect(self._database_path)
+                await connection.execute('PRAGMA journal_mode=WAL')
+                await connection.executescript(SCHEMA)
+                # databases created before threads got versions
+                async with connection.execute('PRAGMA table_info(threads)') as cursor:
+                    if 'version' not in [ row[1] for row in await cursor.fetchall() ]:
+                        await connection.execute('ALTER TABLE threads ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+                await connection.commit()
+                self._connection = connection
+
+        return self._connection
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    @staticmethod
+    def _message_from_row(thread_uid: str | int, order: int, role: str, text: str) -> Message:
+        return Message(thread_uid=thread_uid, order=order, role=Role(role), text=text)
+
+    @staticmethod
+    def _archive_from_row(thread_uid: str | int, order_from: int, order_to: int, text: str) -> Message:
+        return Message(
+            thread_uid=thread_uid, order=order_from, role=Role.archive, text=text,
+            archive_for=[ o for o in range(order_from, order_to + 1) ]
+        )
+
+    async def _check_thread_exists(self, connection: aiosqlite.Connection, thread_uid: str | int) -> None:
+        async with connection.execute('SELECT 1 FROM threads WHERE thread_uid = ?', (str(thread_uid),)) as cursor:
+            if await cursor.fetchone() is None:
+                raise ThreadIsNotFoundError(thread_uid)
+
+    async def _get_instruction(self, thread_uid: str | int, name: str, role: Role = Role.system) -> Message:
+        connection = await self._get_connection()
+        async with connection.execute(
+            'SELECT text FROM instructions WHERE thread_uid IN (?, ?) AND name = ? '
+            'ORDER BY thread_uid = ? LIMIT 1',
+            (str(thread_uid), SHARED_THREAD_UID, name, SHARED_THREAD_UID)
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        if row is None:
+            raise FileNotFoundError(f"There's no {name} instruction for {thread_uid} thread")
+
+        return Message(thread_uid=thread_uid, order=0, role=role, text=row[0])
+
+    async def get_messages_by_thread_uid(self, thread_uid: str | int) -> list[Message]:
+        return [ message async for message in self.iter_messages_by_thread_uid(thread_uid) ]
+
+    async def iter_messages_by_thread_uid(self, thread_uid: str | int) -> AsyncGenerator[Message, None]:
+        connection = await self._get_connection()
+        await self._check_thread_exists(connection, thread_uid)
+
+        async with connection.execute(
+            'SELECT "order", 0, role, text, NULL FROM messages WHERE thread_uid = ? '
+            'UNION ALL SELECT order_from, -1, ?, text, order_to FROM archives WHERE thread_uid = ? '
+            # the same order as the file broker gives: by order, an archive before the message it starts with
+            'ORDER BY 1, 2, 5',
+            (str(thread_uid), Role.archive.value, str(thread_uid))
+        ) as cursor:
+            cursor.arraysize = self._stream_batch_size
+            async for order, _, role, text, order_to in cursor:
+                yield self._archive_from_row(thread_uid, order, order_to, text) if role == Role.archive \
+                    else self._message_from_row(thread_uid, order, role, text)
+
+    async def get_message_by_thread_uid_and_order(self, thread_uid: str | int, message_order: int) -> Message:
+        connection = await self._get_connection()
+        async with connection.execute(
+            'SELECT role, text FROM messages WHERE thread_uid = ? AND "order" = ?', (str(thread_uid), message_order)
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        if row is None:
+            # a missing thread is reported as such, like the file brokers do
+            await self._check_thread_exists(connection, thread_uid)
+            raise MessageIsNotFoundError(thread_uid, message_order)
+
+        return self._message_from_row(thread_uid, message_order, *row)
+
+    async def get_archive_by_thread_uid_and_order(self, thread_uid: str | int, order: int) -> Message:
+        connection = await self._get_connection()
+        # the outermost archive covering the order wins: the first starting one, the widest of those starting with it
+        async with connection.execute(
+            'SELECT order_from, order_to, text FROM archives '
+            'WHERE thread_uid = ? AND order_to >= ? AND order_from <= ? '
+            'ORDER BY order_from, order_to DESC LIMIT 1',
+            (str(thread_uid), order, order)
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        if row is None:
+            await self._check_thread_exists(connection, thread_uid)
+            raise MessageIsNotFoundError(thread_uid, order, True)
+
+        return self._archive_from_row(thread_uid, *row)
+
+    async def get_thread_archiving_instruction(self, thread_uid: str | int) -> Message:
+        return await self._get_instruction(thread_uid, 'archiving_instruction')
+
+    async def get_thread_analysis_instruction(self, thread_uid: str | int) -> Message:
+        return await self._get_instruction(thread_uid, 'analysis_instruction')
+
+    async def get_thread_hidden_context_creation_instruction(self, thread_uid: str | int) -> Message:
+        return await self._get_instruction(thread_uid, 'hidden_context_creation_instruction')
+
+    async def get_thread_hidden_context_consistency_check_instruciton(self, thread_uid: str | int) -> Message:
+        return await self._get_instruction(thread_uid, 'hidden_context_consistency_check_instruction')
+
+    async def get_conversation_instruction(self, thread_uid: str | int) -> Message:
+        return await self._get_instruction(thread_uid, 'conversation_instruction')
+
+    async def get_hidden_context_message(self, thread_uid: str | int) -> Message:
+        return await self._get_instruction(thread_uid, 'hidden_context', Role.hidden)
+
+    async def store_hidden_context_message(self, hidden_context_message: Message) -> None:
+        connection = await self._get_connection()
+        async with self._write_lock:
+            await connection.execute(
+                'INSERT OR REPLACE INTO instructions (thread_uid, name, text) VALUES (?, ?, ?)',
+                (str(hidden_context_message.thread_uid), 'hidden_context', hidden_context_message.text)
+            )
+            await connection.commit()
+
+    async def get_origin_thread(
+        self, thread_uid: str | int, order_from: int = 0, order_to: int | None = None
+    ) -> list[Message]:
+        connection = await self._get_connection()
+        await self._check_thread_exists(connection, thread_uid)
+
+        async with connection.execute(
+            'SELECT "order", role, text FROM messages WHERE thread_uid = ? AND "order" >= ? '
+            'AND (? IS NULL OR "order" <= ?) ORDER BY "order"',
+            (str(thread_uid), order_from, order_to, order_to)
+        ) as cursor:
+            return [ self._message_from_row(thread_uid, *row) for row in await cursor.fetchall() ]
+
+    async def get_messages_by_orders_list(
+        self, thread_uid: str | int, messages_orders: MessagesOrders
+    ) -> list[Message]:
+        connection = await self._get_connection()
+        await self._check_thread_exists(connection, thread_uid)
+        points, bounds = split_messages_orders(messages_orders)
+        points_json, bounds_json = json.dumps(sorted(points)), json.dumps(bounds)
+
+        async with connection.execute(
+            'SELECT "order", 0, role, text, NULL FROM messages WHERE thread_uid = ? AND ('
+            '"order" IN (SELECT value FROM json_each(?)) OR EXISTS (SELECT 1 FROM json_each(?) AS bounds '
+            """WHERE "order" BETWEEN json_extract(bounds.value, '$[0]') AND json_extract(bounds.value, '$[1]'))) """
+            'UNION ALL SELECT order_from, -1, ?, text, order_to FROM archives WHERE thread_uid = ? AND ('
+            'order_from IN (SELECT value FROM json_each(?)) OR EXISTS (SELECT 1 FROM json_each(?) AS bounds '
+            """WHERE order_from BETWEEN json_extract(bounds.value, '$[0]') AND json_extract(bounds.value, '$[1]'))) """
+            'ORDER BY 1, 2, 5',
+            (
+                str(thread_uid), points_json, bounds_json,
+                Role.archive.value, str(thread_uid), points_json, bounds_json
+            )
+        ) as cursor:
+            return [
+                self._archive_from_row(thread_uid, order, order_to, text) if role == Role.archive
+                    else self._message_from_row(thread_uid, order, role, text)
+                for order, _, role, text, order_to in await cursor.fetchall()
+            ]
+
+    async def _insert_archive(self, connection: aiosqlite.Connection, archiving_message: Message) -> None:
+        if archiving_message.archive_for is None:
+            raise ArchiveIsMalformedError(archiving_message.thread_uid, archiving_message.order)
+
+        # check if messages we archive exist
+        async with connection.execute(
+            'SELECT value FROM json_each(?) WHERE value NOT IN '
+            '(SELECT "order" FROM messages WHERE thread_uid = ? AND "order" BETWEEN ? AND ?) LIMIT 1',
+            (
+                json.dumps(archiving_message.archive_for), str(archiving_message.thread_uid),
+                min(archiving_message.archive_for), max(archiving_message.archive_for)
+            )
+        ) as cursor:
+            missing = await cursor.fetchone()
+
+        if missing is not None:
+            raise MessageIsNotFoundError(archiving_message.thread_uid, missing[0])
+
+        await connection.execute(
+            'INSERT OR REPLACE INTO archives (thread_uid, order_from, order_to, text) VALUES (?, ?, ?, ?)',
+            (
+                str(archiving_message.thread_uid), archiving_message.order, max(archiving_message.archive_for),
+                archiving_message.text
+            )
+        )
+        await connection.execute(
+            'UPDATE threads SET version = version + 1 WHERE thread_uid = ?', (str(archiving_message.thread_uid),)
+        )
+
+    async def set_archiving_message(self, archiving_message: Message) -> Message:
+        return (await self.set_archiving_messages([ archiving_message ]))[0]
+
+    async def set_archiving_messages(self, archiving_messages: list[Message]) -> list[Message]:
+        connection = await self._get_connection()
+        async with self._write_lock:
+            try:
+                for archiving_message in archiving_messages:
+                    await self._insert_archive(connection, archiving_message)
+            except BaseException:
+                await connection.rollback()
+                raise
+
+            await connection.commit()
+
+        return archiving_messages
+
+    @staticmethod
+    def _compile_few_shot_thread(
+        thread_uid: str | int, few_shots_index: int, few_shots: dict[str, str]
+    ) -> SceneArchivingThread:
+        background: list[Message] = []
+        for i in itertools.count(1):
+            if (text := few_shots.get(f'few_shots_background_{few_shots_index}_{i}')) is None:
+                break
+            background.append(Message(thread_uid=thread_uid, order=0, role=Role.assistant, text=text))
+
+        current_scene: list[Message] = []
+        for i in itertools.count(1):
+            if (request := few_shots.get(f'few_shots_request_{few_shots_index}_{i}')) is None:
+                break
+            current_scene.append(Message(thread_uid=thread_uid, order=0, role=Role.user, text=request))
+
+            if (response := few_shots.get(f'few_shots_response_{few_shots_index}_{i}')) is None:
+                break
+            current_scene.append(Message(thread_uid=thread_uid, order=0, role=Role.assistant, text=response))
+
+        return SceneArchivingThread(
+            background=background,
+            messages=current_scene,
+            archive=Message(
+                thread_uid=thread_uid, order=0, role=Role.archive,
+                text=few_shots[f'few_shots_archive_{few_shots_index}']
+            )
+        )
+
+    async def compile_few_shot_threads(self, thread_uid: str | int) -> FewShotsBundle:
+        connection = await self._get_connection()
+        async with connection.execute(
+            "SELECT name, text FROM instructions WHERE thread_uid IN (?, ?) AND name GLOB 'few_shots_*' "
+            'ORDER BY thread_uid = ?',
+            (str(thread_uid), SHARED_THREAD_UID, SHARED_THREAD_UID)
+        ) as cursor:
+            # thread specific few-shots go first, so setdefault keeps them over the shared ones
+            few_shots: dict[str, str] = {}
+            for name, text in await cursor.fetchall():
+                few_shots.setdefault(name, text)
+
+        few_shots_indexes = sorted(
+            int(name.removeprefix('few_shots_archive_')) for name in few_shots
+                if name.startswith('few_shots_archive_') and name.removeprefix('few_shots_archive_').isdigit()
+        )
+        return FewShotsBundle(threads=tuple(
+            self._compile_few_shot_thread(thread_uid, few_shots_index, few_shots)
+            for few_shots_index in few_shots_indexes
+        ))
+
+    async def _insert_message(self, connection: aiosqlite.Connection, message: Message) -> None:
+        # the caller holds the write lock
+        try:
+            await connection.execute(
+                'INSERT INTO messages (thread_uid, "order", role, text) VALUES (?, ?, ?, ?)',
+                (str(message.thread_uid), message.order, message.role.value, message.text)
+            )
+            await connection.execute(
+                'INSERT INTO threads (thread_uid, version) VALUES (?, 1) '
+                'ON CONFLICT (thread_uid) DO UPDATE SET version = version + 1',
+                (str(message.thread_uid),)
+            )
+        except aiosqlite.IntegrityError:
+            await connection.rollback()
+            raise MessageAlreadyExistsError(message.thread_uid, message.order)
+
+        await connection.commit()
+
+    async def add_message(self, message: Message) -> Message:
+        connection = await self._get_connection()
+        async with self._write_lock:
+            await self._insert_message(connection, message)
+
+        return message
+
+    async def _get_thread_version(self, connection: aiosqlite.Connection, thread_uid: str | int) -> int:
+        async with connection.execute('SELECT version FROM threads WHERE thread_uid = ?', (str(thread_uid),)) as cursor:
+            row = await cursor.fetchone()
+
+        return row[0] if row is not None else 0
+
+    async def get_thread_version(self, thread_uid: str | int) -> int:
+        connection = await self._get_connection()
+        await self._check_thread_exists(connection, thread_uid)
+        return await self._get_thread_version(connection, thread_uid)
+
+    async def compare_and_append_message(self, message: Message, expected_version: int) -> Message:
+        connection = await self._get_connection()
+        async with self._write_lock:
+            if (version := await self._get_thread_version(connection, message.thread_uid)) != expected_version:
+                raise ThreadVersionConflictError(message.thread_uid, expected_version, version)
+
+            await self._insert_message(connection, message)
+
+        return message
@@ -0,0 +1,107 @@
+"""Bulk import of a FileMessageBroker ``dialog/`` directory into a SQLiteMessageBroker database.
+
+   Usage: python -m llm_toolkit.message_broker.sqlite_migration DIALOG_DIR DATABASE [--flat-thread-uid UID]
+
+   Every subdirectory is imported as a thread. Message files lying directly in DIALOG_DIR (the layout used before
+   threads got their own directories) are imported into the --flat-thread-uid thread if it's given. Other ``.txt``
+   files are imported as instructions, shared ones for DIALOG_DIR and thread specific ones for subdirectories.
+   Compressed message files are imported decompressed."""
+import argparse
+import sqlite3
+from pathlib import Path
+
+from ..pydantic_models import Role
+from .compression import Compression, decompress_body
+from .file_message_broker import ZSTD_DICTIONARY_FILENAME, FileMessageBroker
+from .sqlite_message_broker import SCHEMA, SHARED_THREAD_UID
+
+
+COMPRESSED_SUFFIXES = tuple(f'.txt.{compression.value}' for compression in Compression)
+
+def collect_directory_rows(
+    directory: Path, thread_uid: str, instructions_thread_uid: str
+) -> tuple[list[tuple], list[tuple], list[tuple]]:
+    messages: list[tuple] = []
+    archives: list[tuple] = []
+    instructions: list[tuple] = []
+
+    for f in sorted(directory.iterdir()):
+        is_compressed_message = f.name[:6].isdigit() and f.name.endswith(COMPRESSED_SUFFIXES)
+        if not f.is_file() or (f.suffix != '.txt' and not is_compressed_message):
+            continue
+
+        if (compression := FileMessageBroker._get_filename_compression(f.name)) is not None:
+            text = decompress_body(
+                compression, f.read_bytes(),
+                lambda dict_id: (directory / ZSTD_DICTIONARY_FILENAME.format(dict_id)).read_bytes()
+            ).decode('utf-8')
+        else:
+            text = f.read_text()
+
+        if f.name[:6].isdigit():
+            order, role, archive_for = FileMessageBroker._parse_message_filename(f.name)
+            if role == Role.archive:
+                assert archive_for
+                archives.append((thread_uid, order, max(archive_for), text))
+            else:
+                messages.append((thread_uid, order, role.value, text))
+        else:
+            instructions.append((instructions_thread_uid, f.stem, text))
+
+    return messages, archives, instructions
+
+
+def migrate(dialog_path: Path, database_path: Path, flat_thread_uid: str | None = None) -> dict[str, int]:
+    directories = [ (dialog_path, flat_thread_uid or SHARED_THREAD_UID, SHARED_THREAD_UID) ] + [
+        (d, d.name, d.name) for d in sorted(dialog_path.iterdir()) if d.is_dir()
+    ]
+
+    stats = { 'threads': 0, 'messages': 0, 'archives': 0, 'instructions': 0 }
+    connection = sqlite3.connect(database_path)
+    try:
+        connection.executescript(SCHEMA)
+        # the whole import is one transaction, so a failed run leaves the database untouched
+        with connection:
+            for directory, thread_uid, instructions_thread_uid in directories:
+                messages, archives, instructions = collect_directory_rows(
+                    directory, thread_uid, instructions_thread_uid
+                )
+                if (messages or archives) and thread_uid == SHARED_THREAD_UID:
+                    raise ValueError(f'{directory} has message files, pass --flat-thread-uid to import them')
+
+                if messages or archives or directory is not dialog_path:
+                    connection.execute('INSERT OR IGNORE INTO threads (thread_uid) VALUES (?)', (thread_uid,))
+                    stats['threads'] += 1
+
+                connection.executemany(
+                    'INSERT OR REPLACE INTO messages (thread_uid, "order", role, text) VALUES (?, ?, ?, ?)', messages
+                )
+                connection.executemany(
+                    'INSERT OR REPLACE INTO archives (thread_uid, order_from, order_to, text) VALUES (?, ?, ?, ?)',
+                    archives
+                )
+                connection.executemany(
+                    'INSERT OR REPLACE INTO instructions (thread_uid, name, text) VALUES (?, ?, ?)', instructions
+                )
+                stats['messages'] += len(messages)
+                stats['archives'] += len(archives)
+                stats['instructions'] += len(instructions)
+    finally:
+        connection.close()
+
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Import a FileMessageBroker directory into a SQLite database')
+    parser.add_argument('dialog_path', type=Path)
+    parser.add_argument('database_path', type=Path)
+    parser.add_argument('--flat-thread-uid', default=None)
+    args = parser.parse_args()
+
+    stats = migrate(args.dialog_path, args.database_path, args.flat_thread_uid)
+    print(', '.join(f'{number} {name}' for name, number in stats.items()) + ' imported')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import asyncio
+import os
+from dataclasses import dataclass
+from enum import StrEnum
+from pathlib import Path
+
+
+class Durability(StrEnum):
+    # a write completes once it's renamed into place, the OS flushes it to disk later
+    none = 'none'
+    # every file of a group commit is fsynced before the group completes
+    batch = 'batch'
+    # every write is fsynced on its own, as soon as it's written
+    write = 'write'
+
+
+def get_temp_path(path: Path) -> Path:
+    # the leading dot keeps temp files out of message indexes, whose filenames start with an order
+    return path.with_name(f'.{path.name}.tmp')
+
+
+def fsync_directory(directory: Path) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file_atomically(path: Path, data: bytes, sync: bool) -> None:
+    """Write the file under a temp name and rename it into place, so readers never see it half-written."""
+    temp_path = get_temp_path(path)
+    with open(temp_path, 'wb') as fopen:
+        fopen.write(data)
+        if sync:
+            fopen.flush()
+            os.fsync(fopen.fileno())
+
+    os.replace(temp_path, path)
+    if sync:
+        fsync_directory(path.parent)
+
+
+@dataclass
+class PendingWrite:
+    path: Path
+    data: bytes
+    done: asyncio.Future[None]
+
+
+class WritePipeline:
+    """Writes files atomically in a worker thread. Writes queued while a group is being written are committed
+       together as the next group of at most ``max_group_size`` files, with the ``batch`` durability level all
+       files of a group are fsynced back to back and every directory once. A write to the same path queued again
+       in a group supersedes the earlier one.
+
+       ``write`` returns once the file is durable to the ``durability`` level and waits for a free place when
+       ``max_pending`` writes are queued already."""
+
+    def __init__(
+        self, durability: Durability = Durability.batch, max_pending: int = 256, max_group_size: int = 64
+    ) -> None:
+        self._durability = durability
+        self._max_pending = max_pending
+        self._max_group_size = max_group_size
+        self._queue: asyncio.Queue[PendingWrite] | None = None
+        self._worker: asyncio.Task[None] | None = None
+
+    @property
+    def durability(self) -> Durability:
+        return self._durability
+
+    async def write(self, path: Path, data: bytes) -> None:
+        if self._queue is None or self._worker is None:
+            self._queue = asyncio.Queue(self._max_pending)
+            self._worker = asyncio.create_task(self._commit_groups(self._queue))
+
+        done: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        await self._queue.put(PendingWrite(path, data, done))
+        await done
+
+    async def close(self) -> None:
+        """Wait for the queued writes and stop the worker."""
+        if self._queue is None or self._worker is None:
+            return
+
+        await self._queue.join()
+        self._worker.cancel()
+        self._queue, self._worker = None, None
+
+    async def _commit_groups(self, queue: asyncio.Queue[PendingWrite]) -> None:
+        while True:
+            group = [ await queue.get() ]
+            while len(group) < self._max_group_size and not queue.empty():
+                group.append(queue.get_nowait())
+
+            try:
+                errors = await asyncio.to_thread(self._write_group, { pending.path: pending for pending in group })
+            except Exception as err:
+                errors = { pending.path: err for pending in group }
+            finally:
+                for _ in group:
+                    queue.task_done()
+
+            for pending in group:
+                if pending.done.done():
+                    continue
+                if (error := errors.get(pending.path)) is not None:
+                    pending.done.set_exception(error)
+                else:
+                    pending.done.set_result(None)
+
+    def _write_group(self, group: dict[Path, PendingWrite]) -> dict[Path, Exception]:
+        if self._durability != Durability.batch:
+            errors: dict[Path, Exception] = {}
+            for path, pending in group.items():
+                try:
+                    write_file_atomically(path, pending.data, self._durability == Durability.write)
+                except OSError as err:
+                    errors[path] = err
+            return errors
+
+        # all files are written and fsynced before any of them is renamed, then every directory is fsynced once
+        errors = {}
+        for path, pending in group.items():
+            try:
+                with open(get_temp_path(path), 'wb') as fopen:
+                    fopen.write(pending.data)
+                    fopen.flush()
+                    os.fsync(fopen.fileno())
+            except OSError as err:
+                errors[path] = err
+
+        for path in group:
+            if path not in errors:
+                try:
+                    os.replace(get_temp_path(path), path)
+                except OSError as err:
+                    errors[path] = err
+
+        for directory in { path.parent for path in group if path not in errors }:
+            try:
+                fsync_directory(directory)
+            except OSError as err:
+                errors.update({ path: err for path in group if path.parent == directory and path not in errors })
+
+        return errors
@@ -1,7 +1,8 @@
-from .message import Message, Role, SceneArchivingThread
+from .message import FewShotsBundle, Message, Role, SceneArchivingThread
 
 
 __all__ = [
+    'FewShotsBundle',
     'Message',
     'Role',
     'SceneArchivingThread'
@@ -1,7 +1,7 @@
 from enum import StrEnum
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 
 class Role(StrEnum):
@@ -18,6 +18,16 @@ class Message(BaseModel):
     role: Role
     text: str
     archive_for: list[int] | None = None
+    # counted by the server only, so it's neither taken from requests nor sent in responses
+    _tokens_number: int | None = PrivateAttr(default=None)
+
+    @property
+    def tokens_number(self) -> int | None:
+        return self._tokens_number
+
+    @tokens_number.setter
+    def tokens_number(self, tokens_number: int | None) -> None:
+        self._tokens_number = tokens_number
 
     def __str__(self):
         if self.role == Role.hidden:
@@ -31,3 +41,14 @@ class SceneArchivingThread:
     background: list[Message]
     messages: list[Message]
     archive: Message | None = None
+    # the background rendered from a compiled thread snapshot and its token number, reused instead of rendering it
+    rendered_background: str | None = None
+    background_tokens_number: int | None = None
+
+
+@dataclass(frozen=True)
+class FewShotsBundle:
+    threads: tuple[SceneArchivingThread, ...]
+    tokens_number: int | None = None
+    # LLM messages rendered from the threads, filled once by every LLM API class that uses the bundle
+    rendered: dict[str, list[dict[str, str]]] = field(default_factory=dict, compare=False, hash=False)
@@ -1,30 +1,61 @@
+import asyncio
 import datetime as dt
+import json
 import os
 import uvicorn
-from dataclasses import asdict
+from contextlib import AsyncExitStack
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from typing import Annotated, cast, Iterable, Literal
+from typing import Annotated, Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, cast, Iterable, Literal
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from starlette.types import Receive, Scope, Send
 
-from llm_toolkit.dialog_manager import DialogManager, DialogManagerError
-from llm_toolkit.llm_api import MockLLMAPI, OpenAIAPI
+from llm_toolkit.dialog_manager import ArchivingScheduler, ArchivingStatus, DialogManager, DialogManagerError
+from llm_toolkit.llm_api import (
+    LLMAPIError, MockLLMAPI, OpenAIAPI, PromptEstimate, PromptIsTooLargeError, ResponseCache, TokenCountCache
+)
 from llm_toolkit.message_broker import FileMessageBroker
+from llm_toolkit.message_broker.file_layout_migration import find_flat_thread_files, migrate as migrate_flat_layout
 from llm_toolkit.pydantic_models import Message, Role, SceneArchivingThread
 from llm_toolkit.utils import config as _CONFIG
 
 app = FastAPI()
-message_broker = FileMessageBroker(storage_path = Path(__file__).parent / 'llm_toolkit' / 'dialog')
-dialog_manager = DialogManager(message_broker = message_broker)
+
+# upper bound of LLM calls a batch archive suggestion makes at once, whatever the request asks for
+MAX_SUGGEST_CONCURRENCY = 16
+
+storage_path = Path(__file__).parent / 'llm_toolkit' / 'dialog'
+# kept out of storage_path, where every directory is a thread
+cache_path = Path(__file__).parent / 'llm_toolkit' / 'cache'
+
+# a dialog directory from before threads got their own directories has its thread moved into one on the first start
+if find_flat_thread_files(storage_path):
+    flat_thread_uid = os.environ.get('LLM_FLAT_THREAD_UID')
+    assert flat_thread_uid, f'{storage_path} has flat thread files, set LLM_FLAT_THREAD_UID to move them into a thread'
+    migrate_flat_layout(storage_path, flat_thread_uid)
 
 openai_api_key = os.environ.get('OPENAI_API_KEY')
 assert openai_api_key, "There's no OpenAI API key provided"
 llm_api = OpenAIAPI(
-    api_key = _CONFIG.get_openai_api_key(), proxy_uri=os.environ.get('LLM_PROXY_URI')
+    api_key = _CONFIG.get_openai_api_key(), proxy_uri=os.environ.get('LLM_PROXY_URI'),
+    token_count_cache = TokenCountCache(cache_path / 'token_counts.tsv'),
+    response_cache = ResponseCache(cache_path / 'response_cache'), prefix_stable_layout = True
 ) if True else MockLLMAPI()
 
+message_broker = FileMessageBroker(
+    storage_path = storage_path, token_counter = llm_api.count_single_message_tokens, watch = True
+)
+dialog_manager = DialogManager(
+    message_broker = message_broker, token_counter = llm_api.count_single_message_tokens,
+    batch_token_counter = llm_api.count_messages_tokens
+)
+# archives are generated as pending suggestions, a human reviews and commits them
+archiving_scheduler = ArchivingScheduler(dialog_manager, llm_api, auto_commit = False)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=['*'],  # React app's URL TODO: restrict
@@ -36,18 +67,120 @@ app.add_middleware(
 @app.on_event('startup')
 async def startup_event() -> None:
     # await init_db(remove_old_data=False)
-    pass
+    await message_broker.start_watching()
 
 
 @app.on_event('shutdown')
 async def shutdown_event() -> None:
     # await stop_engine()
-    pass
+    await archiving_scheduler.close()
+    await message_broker.close()
+    await llm_api.close()
+
+
+async def make_ndjson_response(messages: AsyncIterator[Message]) -> StreamingResponse:
+    # the first message is awaited before responding, so a missing thread is still reported with its status code
+    try:
+        first_message = await anext(messages, None)
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
+
+    async def generate() -> AsyncIterator[str]:
+        if first_message is None:
+            return
+        yield first_message.model_dump_json() + '\n'
+        async for message in messages:
+            yield message.model_dump_json() + '\n'
+
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+
+def format_sse_event(event: str, data: str) -> str:
+    return f'event: {event}\ndata: {data}\n\n'
 
 
+async def start_llm_stream(deltas: AsyncGenerator[str, None]) -> str | None:
+    # the first delta is awaited before responding, so a rejected prompt is still reported with its status code
+    try:
+        return await anext(deltas, None)
+    except PromptIsTooLargeError as err:
+        raise HTTPException(status_code=413, detail=str(err))
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """Closes ``exit_stack`` once the response is sent or fails to be, whether its body was iterated or not."""
+
+    def __init__(self, content: AsyncGenerator[str, None], exit_stack: AsyncExitStack, **kwargs: Any) -> None:
+        super().__init__(content, **kwargs)
+        self.exit_stack = exit_stack
+        exit_stack.push_async_callback(content.aclose)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        async with self.exit_stack:
+            await super().__call__(scope, receive, send)
+
+
+def make_sse_response(
+    first_delta: str | None, deltas: AsyncGenerator[str, None], make_message: Callable[[str], Awaitable[Message]],
+    exit_stack: AsyncExitStack | None = None
+) -> StreamingResponse:
+    """Stream ``token`` events with text deltas as the LLM generates them, then a ``message`` event with the message
+       ``make_message`` makes of the whole text, or an ``error`` event if the stream fails midway. The LLM stream
+       and ``exit_stack`` are closed once the response is done, the client disconnecting included."""
+    exit_stack = exit_stack or AsyncExitStack()
+    exit_stack.push_async_callback(deltas.aclose)
+
+    async def generate() -> AsyncGenerator[str, None]:
+        texts: list[str] = []
+        try:
+            if first_delta is not None:
+                texts.append(first_delta)
+                yield format_sse_event('token', json.dumps({ 'text': first_delta }))
+            async for delta in deltas:
+                texts.append(delta)
+                yield format_sse_event('token', json.dumps({ 'text': delta }))
+
+            message = await make_message(''.join(texts))
+        except (Exception, DialogManagerError, LLMAPIError) as err:
+            yield format_sse_event('error', json.dumps({ 'detail': f'{type(err).__name__}: {err}' }))
+            return
+
+        yield format_sse_event('message', message.model_dump_json())
+
+    return ClosingStreamingResponse(
+        generate(), exit_stack, media_type='text/event-stream', headers={ 'Cache-Control': 'no-cache' }
+    )
+
+
+@app.get('/api/message_broker/body_cache')
+async def get_body_cache_stats() -> dict[str, int]:
+    return asdict(message_broker.get_body_cache_stats())
+
+
+@app.get('/api/llm_api/response_cache')
+async def get_response_cache_stats() -> dict[str, int]:
+    if (stats := llm_api.get_response_cache_stats()) is None:
+        raise HTTPException(status_code=404, detail="The LLM API doesn't cache responses")
+    return asdict(stats)
+
+
+@app.get('/api/llm_api/prompt_cache')
+async def get_prompt_cache_stats() -> dict[str, int | float]:
+    if (stats := llm_api.get_prompt_cache_stats()) is None:
+        raise HTTPException(status_code=404, detail="The LLM API doesn't report prompt caching")
+    return asdict(stats)
+
 @app.get('/api/threads/{thread_uid}/messages')
 async def get_thread_messages(thread_uid: str | int) -> list[Message]:
-    return await dialog_manager.create_thread(thread_uid)
+    try:
+        return await dialog_manager.create_thread(thread_uid)
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
+
+# declared before /messages/{message_order}, which would take 'stream' for an order
+@app.get('/api/threads/{thread_uid}/messages/stream')
+async def stream_thread_messages(thread_uid: str | int) -> StreamingResponse:
+    return await make_ndjson_response(dialog_manager.iter_thread(thread_uid))
 
 @app.get('/api/threads/{thread_uid}/messages/{message_order}')
 async def get_thread_message_by_order(thread_uid: str | int, message_order: int) -> Message:
@@ -61,93 +194,391 @@ async def get_thread_archiving_instruction(thread_uid: str | int) -> Message:
     return await dialog_manager.get_thread_archiving_instruction(thread_uid)
 
 @app.get('/api/threads/{thread_uid}/archives/suggest')
-async def suggest_archiving_message(thread_uid: str | int, messages_orders: Annotated[list[int], Query()]) -> Message:
+async def suggest_archiving_message(
+    thread_uid: str | int, messages_orders: Annotated[list[int], Query()], dry_run: bool = False,
+    use_cache: bool = True
+) -> Message | PromptEstimate:
     archiving_instruction = await dialog_manager.get_thread_archiving_instruction(thread_uid)
     few_shots_threads = await dialog_manager.compile_few_shot_threads(thread_uid)
-    current_scene_thread = await dialog_manager.compile_current_scene_thread(thread_uid, messages_orders)
+    try:
+        current_scene_thread = await dialog_manager.compile_current_scene_thread(thread_uid, messages_orders)
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
 
-    response = await llm_api.get_archving_message(
-        archiving_instruction, current_scene_thread, few_shots_threads
-    )
+    if dry_run:
+        return llm_api.estimate_archiving_message(archiving_instruction, current_scene_thread, few_shots_threads)
+
+    try:
+        response = await llm_api.get_archving_message(
+            archiving_instruction, current_scene_thread, few_shots_threads, use_cache=use_cache
+        )
+    except PromptIsTooLargeError as err:
+        raise HTTPException(status_code=413, detail=str(err))
 
     return response
 
+
+class ArchiveSuggestion(BaseModel):
+    # index of the scene in the request
+    index: int
+    archive: Message | None = None
+    # the estimate of the scene's prompt, set instead of the archive in a dry run
+    estimate: PromptEstimate | None = None
+    error: str | None = None
+
+
+@app.post('/api/threads/{thread_uid}/archives/suggest/batch')
+async def suggest_archiving_messages(
+    thread_uid: str | int, scenes_orders: list[list[int]], max_concurrency: int = 4, dry_run: bool = False,
+    use_cache: bool = True
+) -> StreamingResponse:
+    """Stream a suggestion for every scene as NDJSON in the order they finish, the instruction, few-shots and
+       background snapshot are loaded once for all scenes. A dry run streams prompt estimates instead."""
+    if any(not scene_orders for scene_orders in scenes_orders):
+        raise HTTPException(status_code=400, detail='Every scene needs at least one message order')
+
+    try:
+        archiving_instruction = await dialog_manager.get_thread_archiving_instruction(thread_uid)
+        few_shots_threads = await dialog_manager.compile_few_shot_threads(thread_uid)
+        scene_threads = await dialog_manager.compile_current_scene_threads(thread_uid, scenes_orders)
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
+
+    semaphore = asyncio.Semaphore(max(1, min(max_concurrency, MAX_SUGGEST_CONCURRENCY)))
+
+    async def suggest(index: int, scene_thread: SceneArchivingThread) -> ArchiveSuggestion:
+        if dry_run:
+            return ArchiveSuggestion(
+                index=index,
+                estimate=llm_api.estimate_archiving_message(archiving_instruction, scene_thread, few_shots_threads)
+            )
+
+        async with semaphore:
+            try:
+                archive = await llm_api.get_archving_message(
+                    archiving_instruction, scene_thread, few_shots_threads, use_cache=use_cache
+                )
+            except (Exception, LLMAPIError) as err:
+                # one failed scene doesn't stop the others
+                return ArchiveSuggestion(index=index, error=f'{type(err).__name__}: {err}')
+        return ArchiveSuggestion(index=index, archive=archive)
+
+    async def generate() -> AsyncIterator[str]:
+        tasks = [
+            asyncio.create_task(suggest(index, scene_thread)) for index, scene_thread in enumerate(scene_threads)
+        ]
+        try:
+            for next_finished in asyncio.as_completed(tasks):
+                yield (await next_finished).model_dump_json() + '\n'
+        finally:
+            # a client that disconnects cancels the calls not made yet
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+
 @app.post('/api/threads/{thread_uid}/messages')
 async def post_archiving_message(thread_uid: str | int, messages: list[Message]) -> list[Message]:
     if any(msg.thread_uid != thread_uid for msg in messages):
         raise HTTPException(status_code=409, detail='Some message and route thread_uid are not equal')
 
     for msg in messages:
-        if msg.role == Role.archive:
-            await message_broker.set_archiving_message(msg)
-        else:
+        if msg.role != Role.archive:
             raise HTTPException(status_code=400, detail=f"There's no handler for {msg.role} yet")
 
-    return messages
+    try:
+        return await dialog_manager.set_archiving_messages(messages)
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
+
+@app.get('/api/threads/{thread_uid}/archives/pending')
+async def get_archiving_status(thread_uid: str | int) -> ArchivingStatus:
+    return archiving_scheduler.get_status(thread_uid)
+
+@app.post('/api/threads/{thread_uid}/archives/pending/commit')
+async def commit_pending_archives(thread_uid: str | int) -> list[Message]:
+    try:
+        return await archiving_scheduler.commit_pending_archives(thread_uid)
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
+
+@app.delete('/api/threads/{thread_uid}/archives/pending')
+async def discard_pending_archives(thread_uid: str | int) -> list[Message]:
+    return archiving_scheduler.discard_pending_archives(thread_uid)
 
 @app.get('/api/threads/{thread_uid}/compiled')
-async def get_compiled_threads_messages(thread_uid: str | int) -> list[Message]:
-    return await dialog_manager.compile_and_get_thread(thread_uid)
+async def get_compiled_threads_messages(
+    thread_uid: str | int, order_from: int = 0, order_to: int | None = None
+) -> list[Message]:
+    try:
+        return await dialog_manager.compile_and_get_thread(thread_uid, order_from, order_to)
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
+
+@app.get('/api/threads/{thread_uid}/compiled/stream')
+async def stream_compiled_threads_messages(thread_uid: str | int) -> StreamingResponse:
+    return await make_ndjson_response(dialog_manager.iter_compiled_thread(thread_uid))
 
 @app.get('/api/threads/{thread_uid}/analysis')
 async def get_current_thread_analysis(
-    thread_uid: str | int, order_from: int = 0, order_to: int | None = None
-) -> Message:
+    thread_uid: str | int, order_from: int = 0, order_to: int | None = None, dry_run: bool = False,
+    use_cache: bool = True
+) -> Message | PromptEstimate:
+    analysis_instruction = await dialog_manager.get_thread_analysis_instruction(thread_uid)
+    try:
+        full_origin_thread = await dialog_manager.get_origin_thread(thread_uid, order_from, order_to)
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
+
+    if dry_run:
+        return llm_api.estimate_thread_response([ analysis_instruction ] + full_origin_thread)
+
+    try:
+        return await llm_api.get_thread_response([ analysis_instruction ] + full_origin_thread, use_cache=use_cache)
+    except PromptIsTooLargeError as err:
+        raise HTTPException(status_code=413, detail=str(err))
+
+
+@app.get('/api/threads/{thread_uid}/analysis/stream', response_model=None)
+async def stream_current_thread_analysis(
+    thread_uid: str | int, order_from: int = 0, order_to: int | None = None, dry_run: bool = False
+) -> StreamingResponse | PromptEstimate:
+    """Stream the analysis as server-sent events, see ``make_sse_response``. It isn't stored, like the one of
+       ``/analysis``."""
     analysis_instruction = await dialog_manager.get_thread_analysis_instruction(thread_uid)
-    full_origin_thread = await dialog_manager.get_origin_thread(thread_uid, order_from, order_to)
+    try:
+        full_origin_thread = await dialog_manager.get_origin_thread(thread_uid, order_from, order_to)
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
 
-    return await llm_api.get_thread_response([ analysis_instruction ] + full_origin_thread)
+    if dry_run:
+        return llm_api.estimate_thread_response([ analysis_instruction ] + full_origin_thread)
+
+    deltas = llm_api.stream_thread_response([ analysis_instruction ] + full_origin_thread)
+    first_delta = await start_llm_stream(deltas)
+
+    async def make_analysis_message(text: str) -> Message:
+        return Message(
+            thread_uid=thread_uid, order=max(msg.order for msg in full_origin_thread) + 1, role=Role.assistant,
+            text=text
+        )
+
+    return make_sse_response(first_delta, deltas, make_analysis_message)
 
 
 class HiddenContextCreationStatus(BaseModel):
     error: int
     tokens_number: int
+    # tokens of the prompt sent to the LLM, counted on it as assembled
+    prompt_tokens_number: int | None = None
     consistency_score: float | None = None
     hook_alignment_score: float | None = None
     logical_coherence_score: float | None = None
     token_efficiency_score: float | None = None
 
 
+async def get_thread_context(thread_uid: str | int, max_context_tokens: int | None) -> list[Message]:
+    """Return the compiled thread, or the part of it planned to fit ``max_context_tokens``."""
+    try:
+        if max_context_tokens is None:
+            return await dialog_manager.compile_and_get_thread(thread_uid)
+
+        return (await dialog_manager.plan_thread_context(thread_uid, max_context_tokens)).messages
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
+
 @app.post('/api/threads/{thread_uid}/hidden_context')
 async def create_hidden_context_for_thread(
-    thread_uid: str | int, context_message: Message
-) -> HiddenContextCreationStatus:
+    thread_uid: str | int, context_message: Message, max_context_tokens: int | None = None, dry_run: bool = False
+) -> HiddenContextCreationStatus | PromptEstimate:
+    if context_message.thread_uid != thread_uid:
+        raise HTTPException(status_code=409, detail='Context message and route thread_uid are not equal')
 
     hidden_context_creation_instruciton = await dialog_manager.get_thread_hidden_context_creation_instruction(
         thread_uid
     )
-    current_thread = await dialog_manager.compile_and_get_thread(thread_uid)
+    current_thread = await get_thread_context(thread_uid, max_context_tokens)
     # current_thread = [ msg for msg in current_thread if msg.order <= 100]
-    hidden_context = await llm_api.make_hidden_context_message(
+    prompt_estimate = llm_api.estimate_hidden_context_message(
         hidden_context_creation_instruciton, current_thread, context_message
     )
+    if dry_run:
+        return prompt_estimate
+
+    try:
+        hidden_context = await llm_api.make_hidden_context_message(
+            hidden_context_creation_instruciton, current_thread, context_message
+        )
+    except PromptIsTooLargeError as err:
+        raise HTTPException(status_code=413, detail=str(err))
 
     await message_broker.store_hidden_context_message(hidden_context)
     hidden_context_tokens_number = llm_api.count_single_message_tokens(hidden_context)
 
-    return HiddenContextCreationStatus(error=0, tokens_number=hidden_context_tokens_number)
+    return HiddenContextCreationStatus(
+        error=0, tokens_number=hidden_context_tokens_number, prompt_tokens_number=prompt_estimate.tokens_number
+    )
 
 @app.get('/api/threads/{thread_uid}/hidden_context/consistency_check')
-async def check_consistancy_of_created_hidden_context(thread_uid: str | int) -> HiddenContextCreationStatus:
+async def check_consistancy_of_created_hidden_context(
+    thread_uid: str | int, max_context_tokens: int | None = None, dry_run: bool = False, use_cache: bool = True
+) -> HiddenContextCreationStatus | PromptEstimate:
 
     hidden_context_consistency_check_instruciton = (
         await dialog_manager.get_thread_hidden_context_consistency_check_instruciton(thread_uid)
     )
-    current_thread = await dialog_manager.compile_and_get_thread(thread_uid)
+    current_thread = await get_thread_context(thread_uid, max_context_tokens)
     hidden_context = await dialog_manager.get_hidden_context_message(thread_uid)
-    hidden_context_tokens_number = llm_api.count_single_message_tokens(hidden_context)
-    hidden_context_check_result = await llm_api.make_hidden_context_check(
+    prompt_estimate = llm_api.estimate_hidden_context_check(
         hidden_context_consistency_check_instruciton, current_thread, hidden_context
     )
+    if dry_run:
+        return prompt_estimate
+
+    hidden_context_tokens_number = (
+        hidden_context.tokens_number if hidden_context.tokens_number is not None
+        else llm_api.count_single_message_tokens(hidden_context)
+    )
+    try:
+        hidden_context_check_result = await llm_api.make_hidden_context_check(
+            hidden_context_consistency_check_instruciton, current_thread, hidden_context, use_cache=use_cache
+        )
+    except PromptIsTooLargeError as err:
+        raise HTTPException(status_code=413, detail=str(err))
 
     return HiddenContextCreationStatus(
-        error=0, tokens_number=hidden_context_tokens_number, **asdict(hidden_context_check_result)
+        error=0, tokens_number=hidden_context_tokens_number, prompt_tokens_number=prompt_estimate.tokens_number,
+        **asdict(hidden_context_check_result)
     )
 
+@app.get('/api/threads/{thread_uid}/version')
+async def get_thread_version(thread_uid: str | int) -> dict[str, int]:
+    try:
+        return { 'version': await dialog_manager.get_thread_version(thread_uid) }
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
+
 @app.get('/api/threads/{thread_uid}/continuation')
-async def get_continuation_message(thread_uid: str | int) -> Message:
-    message_broker._filesystem_cache = message_broker._build_fiesystem_cache(thread_uid)
+async def get_continuation_message(
+    thread_uid: str | int, response: Response, expected_version: int | None = None,
+    max_context_tokens: int | None = None, dry_run: bool = False
+) -> Message | PromptEstimate:
+    try:
+        if dry_run:
+            # nothing is appended, so the thread isn't reserved
+            return await estimate_continuation(thread_uid, max_context_tokens)
+
+        # a concurrent continuation of the thread gets 409 here, before the LLM is called
+        async with dialog_manager.reserve_thread(thread_uid, expected_version) as version:
+            message, prompt_tokens_number = await continue_thread(thread_uid, version, max_context_tokens)
+    except DialogManagerError as err:
+        raise HTTPException(status_code=err.status_code, detail=str(err))
+    except PromptIsTooLargeError as err:
+        raise HTTPException(status_code=413, detail=str(err))
+
+    # the message is stored, notify keeps its own failures in the archiving status instead of raising them
+    await archiving_scheduler.notify(thread_uid)
+
+    if prompt_tokens_number is not None:
+        response.headers['X-Prompt-Tokens'] = str(prompt_tokens_number)
+    return message
+
+@app.get('/api/threads/{thread_uid}/continuation/stream', response_model=None)
+async def stream_continuation_message(
+    thread_uid: str | int, expected_version: int | None = None, max_context_tokens: int | None = None,
+    dry_run: bool = False
+) -> StreamingResponse | PromptEstimate:
+    """Stream the continuation as server-sent events, see ``make_sse_response``. The thread stays reserved until
+       the generated message is appended when the stream completes, a disconnected client appends nothing."""
+    if dry_run:
+        # nothing is appended, so the thread isn't reserved
+        try:
+            return await estimate_continuation(thread_uid, max_context_tokens)
+        except DialogManagerError as err:
+            raise HTTPException(status_code=err.status_code, detail=str(err))
+
+    async with AsyncExitStack() as exit_stack:
+        try:
+            version = await exit_stack.enter_async_context(
+                dialog_manager.reserve_thread(thread_uid, expected_version)
+            )
+            current_thread = await dialog_manager.compile_and_get_thread(thread_uid)
+            last_msg = current_thread[-1]
+            if last_msg.role != Role.user:
+                # the empty user message is appended without calling the LLM, so there are no tokens to stream
+                message, _ = await continue_thread(thread_uid, version, max_context_tokens)
+                await archiving_scheduler.notify(thread_uid)
+                return StreamingResponse(
+                    iter([ format_sse_event('message', message.model_dump_json()) ]), media_type='text/event-stream'
+                )
+
+            prompt = await make_continuation_prompt(thread_uid, current_thread, max_context_tokens)
+        except DialogManagerError as err:
+            raise HTTPException(status_code=err.status_code, detail=str(err))
+
+        deltas = llm_api.stream_conversation_continuation_message(
+            prompt.narration_instruction, prompt.hidden_context, prompt.archive_subthread, prompt.conversation_subthread
+        )
+        first_delta = await start_llm_stream(deltas)
+
+        async def append_continuation_message(text: str) -> Message:
+            message = await dialog_manager.compare_and_append_message(
+                Message(thread_uid=last_msg.thread_uid, order=last_msg.order + 1, role=Role.assistant, text=text),
+                version
+            )
+            await archiving_scheduler.notify(thread_uid)
+            return message
+
+        # the reservation is handed over to the response, which releases it once it's done
+        return make_sse_response(first_delta, deltas, append_continuation_message, exit_stack.pop_all())
+
+
+@dataclass
+class ContinuationPrompt:
+    narration_instruction: Message
+    hidden_context: Message
+    archive_subthread: list[Message]
+    conversation_subthread: list[Message]
+
+
+async def make_continuation_prompt(
+    thread_uid: str | int, current_thread: list[Message], max_context_tokens: int | None
+) -> ContinuationPrompt:
+    narration_instruction = await dialog_manager.get_conversation_instruction(thread_uid)
+    hidden_context = await dialog_manager.get_hidden_context_message(thread_uid)
+
+    context = await get_thread_context(thread_uid, max_context_tokens)
+    if not context or context[-1].order != current_thread[-1].order:
+        raise HTTPException(status_code=400, detail='max_context_tokens is too small for the last message')
+
+    archive_subthread = [ msg for msg in context if (msg.role is Role.archive) or msg.order == 1 ]
+    conversation_subthread = [ msg for msg in context if msg.role is not Role.archive and msg.order != 1 ]
+
+    # a planned context may leave out the messages between the archives and the recent ones
+    if len(context) == len(current_thread):
+        assert max(cast(list[int], archive_subthread[-1].archive_for)) + 1 == conversation_subthread[0].order
+
+    return ContinuationPrompt(narration_instruction, hidden_context, archive_subthread, conversation_subthread)
+
+async def estimate_continuation(thread_uid: str | int, max_context_tokens: int | None = None) -> PromptEstimate:
+    current_thread = await dialog_manager.compile_and_get_thread(thread_uid)
+
+    last_msg = current_thread[-1]
+    if last_msg.role == Role.assistant:
+        # an empty user message is appended without calling the LLM
+        return PromptEstimate(tokens_number=0)
+
+    elif last_msg.role == Role.user:
+        prompt = await make_continuation_prompt(thread_uid, current_thread, max_context_tokens)
+        return llm_api.estimate_conversation_continuation_message(
+            prompt.narration_instruction, prompt.hidden_context, prompt.archive_subthread, prompt.conversation_subthread
+        )
+
+    raise HTTPException(status_code=500, detail=f"Last thread's message has {last_msg.role} role")
 
+async def continue_thread(
+    thread_uid: str | int, version: int, max_context_tokens: int | None = None
+) -> tuple[Message, int | None]:
     current_thread = await dialog_manager.compile_and_get_thread(thread_uid)
 
     last_msg = current_thread[-1]
@@ -155,26 +586,24 @@ async def get_continuation_message(thread_uid: str | int) -> Message:
         new_user_message = Message(
             thread_uid=thread_uid, order=last_msg.order + 1, role=Role.user, text=''
         )
-        await dialog_manager.add_message(new_user_message)
-        return new_user_message
+        await dialog_manager.compare_and_append_message(new_user_message, version)
+        return new_user_message, None
 
     elif last_msg.role == Role.user:
-        narration_instruction = await dialog_manager.get_conversation_instruction(thread_uid)
-        hidden_context = await dialog_manager.get_hidden_context_message(thread_uid)
-
-        archive_subthread = [ msg for msg in current_thread if (msg.role is Role.archive) or msg.order == 1 ]
-        conversation_subthread = [ msg for msg in current_thread[1:] if msg.role is not Role.archive ]
-
-        assert max(cast(list[int], archive_subthread[-1].archive_for)) + 1 == conversation_subthread[0].order
+        prompt = await make_continuation_prompt(thread_uid, current_thread, max_context_tokens)
+        # counted on the prompt as sent, where archives are joined into one message
+        prompt_estimate = llm_api.estimate_conversation_continuation_message(
+            prompt.narration_instruction, prompt.hidden_context, prompt.archive_subthread, prompt.conversation_subthread
+        )
 
         new_assistant_message = await llm_api.make_conversation_continuation_message(
-            narration_instruction, hidden_context, archive_subthread, conversation_subthread
+            prompt.narration_instruction, prompt.hidden_context, prompt.archive_subthread, prompt.conversation_subthread
         )
         assert new_assistant_message.role is Role.assistant
 
-        await dialog_manager.add_message(new_assistant_message)
+        await dialog_manager.compare_and_append_message(new_assistant_message, version)
 
-        return new_assistant_message
+        return new_assistant_message, prompt_estimate.tokens_number
 
     raise HTTPException(status_code=500, detail=f"Last thread's message has {last_msg.role} role")
 
@@ -0,0 +1,27 @@
+import asyncio
+from pathlib import Path
+
+from llm_toolkit.message_broker import SegmentLogMessageBroker
+from llm_toolkit.message_broker.segment_log_message_broker import INDEX_ENTRY
+from llm_toolkit.pydantic_models import Message, Role
+
+
+def test_append_after_torn_index_tail(tmp_path: Path) -> None:
+    async def store(*orders: int) -> None:
+        message_broker = SegmentLogMessageBroker(tmp_path)
+        for order in orders:
+            await message_broker.add_message(Message(thread_uid='thread', order=order, role=Role.user, text=f'{order}'))
+
+    async def read() -> list[Message]:
+        return await SegmentLogMessageBroker(tmp_path).get_messages_by_thread_uid('thread')
+
+    asyncio.run(store(1, 2))
+    index_path = tmp_path / 'thread' / 'index.bin'
+    with open(index_path, 'ab') as fopen:
+        fopen.write(b'\x01\x02\x03')
+
+    # the torn entry is ignored after a restart and cut off by the next append
+    assert [ message.order for message in asyncio.run(read()) ] == [ 1, 2 ]
+    asyncio.run(store(3))
+    assert index_path.stat().st_size == 3 * INDEX_ENTRY.size
+    assert [ (message.order, message.text) for message in asyncio.run(read()) ] == [ (1, '1'), (2, '2'), (3, '3') ]